@@ -1,19 +1,44 @@
 import csv
-from typing import List
+import sys
+from functools import partial
+from itertools import chain
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from parallel import map_sentences, process_file_in_blocks
+from cache import run_file_stage
+from fileio import open_file, strip_compression, write_sentences, format_rows, is_joined_plainly
+from profiling import profiled, count_sentences
 
+ARG_FILTER = ["det", "punct", "mark", "parataxis"]  # relations of dependents of a predicate which aren't ARGs
+BASE_COLUMNS = 12  # the columns of a token shared by all its per-predicate sentences: CoNLL-U, gold and predicted PRED
+COMPACT_SUFFIX = '-compact.tsv'  # the end of the name of a file of argument identification in the compact format
 
+
+def parse_sentences_from_tsv(lines: Iterable[str]) -> Iterator[List[List[str]]]:
+    """Parse sentences from the lines of a tsv file one at a time"""
+    csvreader = csv.reader(lines, delimiter='\t', quotechar='\\')
+    sentence = []  # prepare a container for the first sentence
+    for row in csvreader:
+        if row:  # if the line is not empty
+            sentence.append(row)  # append info for this token
+        else:  # empty lines indicate sentence boundaries
+            yield sentence
+            sentence = []  # prepare a container for the next sentence
+
+
+def is_tsv_sentence_boundary(line: str) -> bool:
+    """Check whether a line of a tsv file is the empty line ending a sentence"""
+    return line == '\n'
+
+
+def iter_sentences_from_tsv(path: str) -> Iterator[List[List[str]]]:
+    """Read in sentences from a tsv file one at a time"""
+    with open_file(path) as infile:
+        yield from parse_sentences_from_tsv(infile)
+
+
+@profiled(counts=count_sentences)
 def read_sentences_from_tsv(path: str) -> List[List[List[str]]]:
-    sentences = []
-    with open(path, encoding='utf-8') as infile:
-        csvreader = csv.reader(infile, delimiter='\t', quotechar='\\')
-        sentence = []  # prepare a container for the first sentence
-        for row in csvreader:
-            if row:  # if the line is not empty
-                sentence.append(row)  # append info for this token
-            else:  # empty lines indicate sentence boundaries
-                sentences.append(sentence)
-                sentence = []  # prepare a container for the next sentence
-    return sentences
+    return list(iter_sentences_from_tsv(path))
 
 
 def count_predicates(labels: List[str]) -> int:
@@ -24,13 +49,78 @@ def extract_predicate_labels(sentence: List[List[str]], predicate_column: int) -
     return [token[predicate_column] for token in sentence]
 
 
-def identify_arguments(sent: List[List], p_id: int) -> List:
+class DependencyIndex:
+    """
+    The dependency tree of a sentence, built once per sentence, so the dependents of a token are looked up in
+    O(number of dependents) instead of by scanning the whole sentence for every predicate. The rows are grouped by the
+    head column in a single pass, and only the ids of the dependents which are looked up are converted to integers.
+    The span of the subtree of every token (its first and last token id) is computed in a single pass over the tree
+    the first time it is needed.
+    """
+
+    __slots__ = ('rows_by_head', 'spans')
+
+    def __init__(self, sentence: List[List[str]]):
+        rows_by_head = {}  # the head column of a row -> the rows with that head, in sentence order
+        for row in sentence:
+            head = row[6]
+            if head in rows_by_head:
+                rows_by_head[head].append(row)
+            else:
+                rows_by_head[head] = [row]
+        self.rows_by_head = rows_by_head
+        self.spans = None
+
+    def get_dependents(self, head_id: int) -> List[Tuple[int, str]]:
+        """Return the ids and dependency relations of the dependents of a token, in sentence order."""
+        return [(int(row[0]), row[7]) for row in self.rows_by_head.get(str(head_id), [])]
+
+    def get_subtree_span(self, token_id: int) -> Tuple[int, int]:
+        """Return the first and last token id in the subtree of a token."""
+        if self.spans is None:
+            self.spans = self.compute_subtree_spans()
+        return self.spans.get(token_id, (token_id, token_id))
+
+    def compute_subtree_spans(self) -> Dict[int, Tuple[int, int]]:
+        """
+        Compute the span of the subtree of every token, children before their heads. Tokens which can't be reached from
+        the root (in a malformed tree with a cycle) are visited after those which can.
+        """
+        spans = {}
+        visited = {0}
+        token_ids = [int(row[0]) for head, rows in self.rows_by_head.items() if head.isdigit() for row in rows]
+        stack = [(token_id, False) for token_id in reversed(token_ids)] + [(0, False)]  # the root comes first
+        while stack:
+            token_id, children_done = stack.pop()
+            if token_id in spans:
+                continue
+            if not children_done:
+                visited.add(token_id)
+                stack.append((token_id, True))
+                for dependent, _ in self.get_dependents(token_id):
+                    if dependent not in visited:  # a malformed tree can have cycles
+                        visited.add(dependent)
+                        stack.append((dependent, False))
+                continue
+            first = last = token_id
+            for dependent, _ in self.get_dependents(token_id):
+                if dependent in spans:
+                    first, last = min(first, spans[dependent][0]), max(last, spans[dependent][1])
+            spans[token_id] = (first, last)
+        del spans[0]  # the root isn't a token
+        return spans
+
+
+def identify_arguments(sent: List[List], p_id: int, arg_id: Optional[List[int]] = None,
+                       index: Optional[DependencyIndex] = None, spans: bool = False) -> List:
     """
     A list of input sentences -> List of rows,
                                 with predicate and argument labels for each token
-    """
-    # ! Looping each sentence, each predicate!
 
+    The ids of the arguments can be passed in if they have been found beforehand, e.g. by the vectorized rules, and so
+    can the dependency index of the sentence, if it is shared by all its predicates. In the span mode, every token in
+    the subtree of an argument is labeled as ARG, so arguments are full constituents instead of their heads.
+    """
     arg_label = "_ " * len(sent)  # Assign "_" to all tokens first
     arg_label = arg_label.strip().split()
 
@@ -38,32 +128,133 @@ def identify_arguments(sent: List[List], p_id: int) -> List:
         arg_label[(p_id - 1)] = "V"  # The label for that predicate = "V"
         # (p_id-1) = index in the list
 
-        # Find its argument(s)
-        ## Rule: ARG if head==V and not det or punct or mark or parataxis
-        arg_filter = ["det", "punct", "mark", "parataxis"]
-        arg_id = []
-        for row in sent:
-            if (row[6] == str(p_id)) and (row[7] not in arg_filter):
-                arg_id.append(int(row[0]))
+        if index is None and (arg_id is None or spans):
+            index = DependencyIndex(sent)
+        if arg_id is None:
+            # Find its argument(s)
+            ## Rule: ARG if head==V and not det or punct or mark or parataxis
+            arg_id = [i for i, deprel in index.get_dependents(p_id) if deprel not in ARG_FILTER]
         ## if cop -> nsubj=ARG1, head=ARG2?
         #
         for i in arg_id:
-            arg_label[(i - 1)] = "ARG"
+            if spans:
+                first, last = index.get_subtree_span(i)
+                for j in range(first, last + 1):
+                    if arg_label[(j - 1)] != "V":
+                        arg_label[(j - 1)] = "ARG"
+            else:
+                arg_label[(i - 1)] = "ARG"
 
     return arg_label  # As one column for one predicate in a sentence
 
 
-def predict_arguments_for_sentences(sentence, gold_pred_column, pred_pred_column, method):
-    """For each sentence, predict arguments for each of its predicates. Store all sentences with
-    predicted labels to a list and return it."""
+class PredicateInstances:
+    """
+    The per-predicate sentences of a sentence, one for each of its gold or identified predicates. Instead of a copy of
+    every token row for every predicate, they share one list of rows of the tokens, and every predicate only has its
+    own label columns: the gold and identified argument labels. The rows of a per-predicate sentence are the shared
+    rows followed by its label columns, and are only built when it is iterated over.
+    """
+
+    __slots__ = ('rows', 'columns')
+
+    def __init__(self, rows: List[List[str]], columns: List[Tuple[Sequence[str], ...]]):
+        self.rows = rows
+        self.columns = columns  # the label columns of every per-predicate sentence, with a label for every token
+
+    def __len__(self) -> int:
+        return len(self.columns)
+
+    def __iter__(self) -> Iterator[List[List[str]]]:
+        for i in range(len(self.columns)):
+            yield self.get_sentence(i)
+
+    def get_sentence(self, i: int) -> List[List[str]]:
+        """Return the rows of the i-th per-predicate sentence."""
+        return [row + list(labels) for row, labels in zip(self.rows, zip(*self.columns[i]))]
+
+    def format_sentences(self) -> str:
+        """
+        Return the text of all per-predicate sentences in the tab-separated format of the output files, each followed
+        by an empty line. The shared rows are joined once and only the label columns are added to them for every
+        per-predicate sentence, unless a cell needs quoting.
+        """
+        try:
+            shared_lines = list(map('\t'.join, self.rows))
+            texts = ['\n'.join(map('\t'.join, zip(shared_lines, *labels))) for labels in self.columns]
+        except TypeError:  # a cell which isn't a string
+            texts = None
+        if texts is not None:
+            text = '\n\n'.join(texts) + '\n\n' if self.rows else '\n' * len(self.columns)
+            num_cells = sum(map(len, self.rows))
+            num_tabs = sum(num_cells + len(self.rows) * (len(labels) - 1) for labels in self.columns)
+            if is_joined_plainly(text, len(self.columns) * (len(self.rows) + 1), num_tabs):
+                return text.replace('\n', '\r\n')
+        return format_rows(list(chain.from_iterable(sentence + [[]] for sentence in self)))
+
+    def get_column(self, i: int, column: int) -> Sequence[str]:
+        """Return a column of the i-th per-predicate sentence, counted from the end like row[column]."""
+        labels = self.columns[i]
+        if column >= -len(labels):
+            return labels[column]
+        return [row[column + len(labels)] for row in self.rows]
+
+    def iter_label_rows(self, width: int = 2) -> Iterator[List[str]]:
+        """Yield the last width columns of every row of every per-predicate sentence, without building the rows."""
+        for i in range(len(self.columns)):
+            yield from map(list, zip(*[self.get_column(i, column) for column in range(-width, 0)]))
+
+    def get_compact_rows(self) -> List[List[str]]:
+        """Return every shared row followed by the label columns of all per-predicate sentences."""
+        columns = [column for labels in self.columns for column in labels]
+        return [row + list(labels) for row, labels in zip(self.rows, zip(*columns))]
+
+    @classmethod
+    def from_compact_rows(cls, rows: List[List[str]]) -> 'PredicateInstances':
+        """
+        Split rows in the compact format into the shared rows and the label columns. A sentence without predicates has
+        a single per-predicate sentence with one label column, the others have two label columns for every predicate.
+        """
+        if not rows:
+            return cls([], [([],)])
+        num_labels = len(rows[0]) - BASE_COLUMNS
+        width = 1 if num_labels % 2 else 2
+        start = len(rows[0]) - (num_labels if width == 2 else 1)
+        columns = list(zip(*[row[start:] for row in rows]))
+        return cls([row[:start] for row in rows], [tuple(columns[j:j + width]) for j in range(0, len(columns), width)])
+
+
+def iter_label_rows(groups: Iterable[PredicateInstances], width: int = 2) -> Iterator[List[str]]:
+    """Yield the last width columns of every row of the per-predicate sentences of all sentences."""
+    for group in groups:
+        yield from group.iter_label_rows(width)
+
+
+def get_argument_ids(arguments, pred_id):
+    """Return the ids of the arguments of a predicate found beforehand, or None if they haven't been."""
+    if arguments is None:
+        return None
+    return arguments.get(pred_id, [])
+
+
+def predict_arguments_for_sentences(sentence, gold_pred_column, pred_pred_column, method,
+                                    arguments=None) -> PredicateInstances:
+    """For each sentence, predict arguments for each of its predicates with the rules ('rule'), the rules with the
+    arguments spanning their whole subtrees ('span') or the gold labels ('gold'). Return the sentences with predicted
+    labels for every predicate, sharing the rows of the sentence. The ids of the arguments of every predicate, by
+    predicate id, can be passed in if they have been found beforehand."""
     gold_pred_labels = extract_predicate_labels(sentence, gold_pred_column)
     pred_pred_labels = extract_predicate_labels(sentence, pred_pred_column)
     num_pred_gold, num_pred_pred = count_predicates(gold_pred_labels), count_predicates(pred_pred_labels)
     if num_pred_gold == 0 and num_pred_pred == 0:  # if there are no predicates, "predict" label _ for each token
-        return [[token + ['_'] for token in sentence]]
-        # list for consistency, so we can iterate through all sents in the same way
+        return PredicateInstances(sentence, [(['_'] * len(sentence),)])
+        # a single sentence for consistency, so we can iterate through all sents in the same way
     else:
-        new_sentences = []  # we will create a separate sentence for every predicate and append it to this list
+        rows = [token[:pred_pred_column + 1] for token in sentence]  # + 1 to include the predicate column
+        columns = []  # we will add the label columns of a separate sentence for every predicate to this list
+        spans = method == 'span'
+        # the dependents of every token are indexed once for all predicates, unless their arguments are known already
+        index = DependencyIndex(sentence) if num_pred_pred and (arguments is None or spans) else None
         pred_id = 1  # keep track of token index (column[0] of each row; starts with 1)
         i = 1  # count number of gold predicates to know which column to extract for the labels
         for gold_pred_label, pred_pred_label in zip(gold_pred_labels, pred_pred_labels):
@@ -71,49 +262,138 @@ def predict_arguments_for_sentences(sentence, gold_pred_column, pred_pred_column
                 pred_id += 1
                 continue
             elif gold_pred_label == 'PRED' and pred_pred_label == '_':
-                this_sentence = [token[:pred_pred_column + 1]  # + 1 because we want to include the predicate column
-                                 + [token[pred_pred_column + i]] for token in sentence]
-                new_sentences.append([token + ['_'] for token in this_sentence])  # no predicate identified, so no args
+                gold_arg_labels = [token[pred_pred_column + i] for token in sentence]
+                columns.append((gold_arg_labels, ['_'] * len(sentence)))  # no predicate identified, so no args
                 # can be predicted for this sent
                 pred_id += 1
                 i += 1
             elif gold_pred_label == '_' and pred_pred_label == 'PRED':
-                this_sentence = [token[:pred_pred_column + 1] + ['_'] for token in sentence]  # there were no args in gold
-                pred_arg_labels = identify_arguments(sentence, pred_id)
-                new_sentences.append([token + [label] for token, label in zip(this_sentence, pred_arg_labels)])
+                gold_arg_labels = ['_'] * len(sentence)  # there were no args in gold
+                pred_arg_labels = identify_arguments(sentence, pred_id, get_argument_ids(arguments, pred_id), index,
+                                                     spans)
+                columns.append((gold_arg_labels, pred_arg_labels))
                 pred_id += 1
             else:
-                this_sentence = [token[:pred_pred_column + 1] + [token[pred_pred_column + i]] for token in sentence]
-                if method == 'rule':
-                    pred_arg_labels = identify_arguments(sentence, pred_id)
+                gold_arg_labels = [token[pred_pred_column + i] for token in sentence]
+                if method in ['rule', 'span']:
+                    pred_arg_labels = identify_arguments(sentence, pred_id, get_argument_ids(arguments, pred_id),
+                                                         index, spans)
                 else:
-                    pred_arg_labels = ['ARG' if token[-1] not in ['_', 'V'] else token[-1] for token in
-                                       this_sentence]
-                new_sentences.append([token + [label] for token, label in zip(this_sentence, pred_arg_labels)])
+                    pred_arg_labels = ['ARG' if label not in ['_', 'V'] else label for label in gold_arg_labels]
+                columns.append((gold_arg_labels, pred_arg_labels))
                 pred_id += 1
                 i += 1
-        return new_sentences
+        return PredicateInstances(rows, columns)
+
 
+def write_arg_ident_results(sents, outfile):
+    """Write results of argument identification to an open file"""
+    for sent in sents:
+        if isinstance(sent, PredicateInstances):
+            outfile.write(sent.format_sentences())
+        else:
+            write_sentences(outfile, sent)
 
+
+@profiled()
 def write_results_arg_ident_to_tsv(sents, path):
     """Write results of argument identification to a file"""
-    with open(path, 'w', newline='') as outfile:
-        csvwriter = csv.writer(outfile, delimiter='\t', quotechar='\\', quoting=csv.QUOTE_MINIMAL)
-        for sent in sents:
-            for s in sent:
-                for token in s:
-                    csvwriter.writerow(token)
-                csvwriter.writerow([])  # keep an empty line between every sentence
+    with open_file(path, 'w', newline='') as outfile:
+        write_arg_ident_results(sents, outfile)
 
 
-def identify_arguments_and_return_output_path(path, method):
-    """Read in all sentences from the file and for each predicate, identify arguments using a rule-based approach or
-    gold labels. Write the predictions to a file and return the file path."""
-    sentences = read_sentences_from_tsv(path)
+def write_compact_arg_ident_results(groups: Iterable[PredicateInstances], outfile):
+    """
+    Write results of argument identification to an open file in the compact format: the rows of every sentence once,
+    each followed by the gold and identified argument labels for all predicates of the sentence.
+    """
+    write_sentences(outfile, (group.get_compact_rows() for group in groups))
+
+
+@profiled()
+def write_compact_results_arg_ident_to_tsv(groups: Iterable[PredicateInstances], path):
+    """Write results of argument identification to a file in the compact format"""
+    with open_file(path, 'w', newline='') as outfile:
+        write_compact_arg_ident_results(groups, outfile)
+
+
+def parse_compact_sentences_from_tsv(lines: Iterable[str]) -> Iterator[PredicateInstances]:
+    """Parse the per-predicate sentences of every sentence from the lines of a file in the compact format"""
+    return map(PredicateInstances.from_compact_rows, parse_sentences_from_tsv(lines))
+
+
+def iter_compact_sentences_from_tsv(path: str) -> Iterator[PredicateInstances]:
+    """Read in the per-predicate sentences of every sentence from a file in the compact format one at a time"""
+    with open_file(path) as infile:
+        yield from parse_compact_sentences_from_tsv(infile)
+
+
+def is_compact_arg_ident_path(path: str) -> bool:
+    return strip_compression(path).endswith(COMPACT_SUFFIX)
+
+
+def get_compact_arg_ident_output_path(path: str) -> str:
+    """Return the path of the compact version of a file with the results of argument identification."""
+    return path.replace('.tsv', COMPACT_SUFFIX)
+
+
+def identify_arguments_in_lines(lines, outfile, method, compact=False):
+    """Identify arguments in the sentences in lines of a file with identified predicates and write the results to an
+    open file, in the compact format if requested."""
+    write = write_compact_arg_ident_results if compact else write_arg_ident_results
+    write(iter_identify_arguments(parse_sentences_from_tsv(lines), method), outfile)
+
+
+def iter_identify_arguments(sentences: Iterable[List[List[str]]], method: str,
+                            workers: int = 1) -> Iterator[PredicateInstances]:
+    """For each sentence with identified predicates, predict arguments for each of its predicates using a rule-based
+    approach or gold labels. Yield the per-predicate sentences of one input sentence at a time. Sentences are
+    processed on a pool of worker processes if more than one worker is requested."""
     gold_pred_column = 10
     pred_pred_column = 11
-    all_sent_output = [predict_arguments_for_sentences(sent, gold_pred_column, pred_pred_column, method) for sent in
-                       sentences]
-    output_path = path.replace('.tsv', f'-arg_iden-{method}.tsv')
-    write_results_arg_ident_to_tsv(all_sent_output, output_path)
+    return map_sentences(partial(predict_arguments_for_sentences, gold_pred_column=gold_pred_column,
+                                 pred_pred_column=pred_pred_column, method=method), sentences, workers)
+
+
+@profiled(counts=lambda output: {'sentences': len(output)})
+def identify_arguments_in_sentences(sentences, method, workers=1):
+    """For each sentence with identified predicates, predict arguments for each of its predicates using a rule-based
+    approach or gold labels. Return a list containing the per-predicate sentences of every input sentence."""
+    return list(iter_identify_arguments(sentences, method, workers))
+
+
+def iter_predicate_sentences(all_sent_output) -> Iterator[List[List[str]]]:
+    """Yield the per-predicate sentences from the output of argument identification one at a time, the way they are
+    read back in from the output file."""
+    for sent in all_sent_output:
+        yield from sent
+
+
+def flatten_predicate_sentences(all_sent_output):
+    """Flatten the output of argument identification to a list of per-predicate sentences, the way they are read back
+    in from the output file."""
+    return list(iter_predicate_sentences(all_sent_output))
+
+
+def get_arg_ident_output_path(path, method):
+    """Return the path of the file the results of argument identification on the input file are written to."""
+    return path.replace('.tsv', f'-arg_iden-{method}.tsv')
+
+
+@profiled()
+def identify_arguments_and_return_output_path(path, method, workers=1, stage_cache=None, compact=False):
+    """Read in all sentences from the file and for each predicate, identify arguments using a rule-based approach or
+    gold labels. Write the predictions to a file, in the compact format if requested, and return the file path."""
+    output_path = get_arg_ident_output_path(path, method)
+    if compact:
+        output_path = get_compact_arg_ident_output_path(output_path)
+
+    def identify_arguments_in_file():
+        # the file is read, processed and written in blocks of sentences, on a pool of worker processes if requested
+        process_file_in_blocks(partial(identify_arguments_in_lines, method=method, compact=compact), path,
+                               output_path, is_tsv_sentence_boundary, workers)
+
+    # the output file is copied from the stage cache if the input file, method and code haven't changed
+    run_file_stage(stage_cache, 'argument_identification', path, output_path, {'method': method, 'compact': compact},
+                   [sys.modules[__name__]], identify_arguments_in_file)
     return output_path
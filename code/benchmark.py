@@ -0,0 +1,253 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+from predicate_identification import read_sentences_from_connlu, identify_predicates
+from arg_identification import predict_arguments_for_sentences, write_results_arg_ident_to_tsv
+from feature_extraction import FEATURE_NAMES, extract_features_from_instances, write_results_feature_extraction_to_tsv
+from classification import create_classifier, get_predictions
+from evaluation import evaluate_file
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmark_baseline.json')
+THRESHOLD = 0.2  # a stage regresses if its throughput drops or its peak memory grows by more than this fraction
+STAGE_THRESHOLDS = {'predict_arguments_for_sentences': 0.35, 'extract_features_from_instances': 0.35,
+                    'create_classifier': 0.35}  # stages whose times vary more between runs
+
+UPOS_TAGS = ['NOUN', 'PROPN', 'PRON', 'DET', 'ADJ', 'ADP', 'ADV', 'PUNCT', 'CCONJ', 'NUM']
+XPOS_TAGS = {'NOUN': 'NN', 'PROPN': 'NNP', 'PRON': 'PRP', 'DET': 'DT', 'ADJ': 'JJ', 'ADP': 'IN', 'ADV': 'RB',
+             'PUNCT': '.', 'CCONJ': 'CC', 'NUM': 'CD', 'VERB': 'VB', 'AUX': 'MD'}
+ARGUMENT_DEPRELS = ['nsubj', 'obj', 'obl', 'iobj', 'advmod', 'ccomp', 'xcomp', 'nsubj:pass']
+OTHER_DEPRELS = ['det', 'amod', 'case', 'nmod', 'punct', 'mark', 'cc', 'conj', 'compound', 'parataxis']
+ROLES = {'nsubj': 'ARG0', 'obj': 'ARG1', 'nsubj:pass': 'ARG1', 'iobj': 'ARG2', 'obl': 'ARGM-LOC',
+         'advmod': 'ARGM-TMP', 'ccomp': 'ARG1', 'xcomp': 'ARG2'}
+
+
+def generate_sentence(rnd: random.Random, sentence_length: int, predicate_density: float,
+                      vocabulary_size: int) -> List[List[str]]:
+    """
+    Generate a random sentence in the format of Universal PropBank: a dependency tree rooted in a predicate, whose
+    tokens are predicates (verbs) with probability predicate_density. Dependents of predicates get an argument
+    relation and a role in the predicate's column most of the time.
+    """
+    length = max(1, min(3 * sentence_length, round(rnd.gauss(sentence_length, sentence_length / 2))))
+    is_predicate = [i == 0 or rnd.random() < predicate_density for i in range(length)]
+    rnd.shuffle(is_predicate)
+    order = list(range(length))
+    rnd.shuffle(order)
+    heads = [0] * length
+    for n, i in enumerate(order[1:], 1):
+        heads[i] = order[rnd.randrange(n)] + 1  # attach to a token already in the tree, so there are no cycles
+    rows = []
+    for i in range(length):
+        upos = rnd.choice(['VERB', 'VERB', 'AUX']) if is_predicate[i] else rnd.choice(UPOS_TAGS)
+        head_is_predicate = heads[i] > 0 and is_predicate[heads[i] - 1]
+        if heads[i] == 0:
+            deprel = 'root'
+        elif head_is_predicate and rnd.random() < 0.7:
+            deprel = rnd.choice(ARGUMENT_DEPRELS)
+        else:
+            deprel = rnd.choice(OTHER_DEPRELS)
+        lemma = f'lemma{int(rnd.paretovariate(1.2)) % vocabulary_size}'  # a few frequent lemmas and a long tail
+        feats = rnd.choice(['VerbForm=Fin', 'Voice=Pass|VerbForm=Part', 'Mood=Ind|Tense=Past']) \
+            if is_predicate[i] else '_'
+        rows.append([str(i + 1), lemma + 's', lemma, upos, XPOS_TAGS[upos], feats, str(heads[i]), deprel,
+                     f'{heads[i]}:{deprel}', '_', f'{lemma}.01' if is_predicate[i] else '_'])
+    for p in [i for i in range(length) if is_predicate[i]]:
+        for i, row in enumerate(rows):
+            if i == p:
+                row.append('V')
+            elif heads[i] == p + 1 and row[7] in ROLES:
+                row.append(ROLES[row[7]])
+            else:
+                row.append('_')
+    return rows
+
+
+def generate_corpus(path: str, num_sentences: int, sentence_length: int = 20, predicate_density: float = 0.15,
+                    vocabulary_size: int = 5000, seed: int = 42) -> None:
+    """Write a synthetic .conllu file with num_sentences sentences of on average sentence_length tokens."""
+    rnd = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as outfile:
+        for s in range(num_sentences):
+            outfile.write(f'# sent_id = synthetic-{s}\n')
+            for row in generate_sentence(rnd, sentence_length, predicate_density, vocabulary_size):
+                outfile.write('\t'.join(row) + '\n')
+            outfile.write('\n')
+
+
+def measure(func: Callable, repeat: int) -> Dict:
+    """
+    Return the best wall time of running a function repeat times, and the peak memory allocated while running it
+    once more under tracemalloc (which slows it down, so it isn't timed).
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': min(times), 'peak_mb': peak / 1024 ** 2}
+
+
+def run_benchmarks(directory: str, num_sentences: int, sentence_length: int, predicate_density: float,
+                   repeat: int = 3) -> Dict[str, Dict]:
+    """
+    Generate a corpus in a directory and measure every stage of the pipeline on it, each one on the output of the
+    previous one. Return the measurements of every stage, with its throughput in tokens (or, for the classifier,
+    instances) per second.
+    """
+    path = os.path.join(directory, 'benchmark.conllu')
+    generate_corpus(path, num_sentences, sentence_length, predicate_density)
+    sentences = read_sentences_from_connlu(path)
+    predicate_sentences = [identify_predicates(sentence, 'rule') for sentence in sentences]
+    argument_groups = [predict_arguments_for_sentences(sentence, 10, 11, 'rule') for sentence in predicate_sentences]
+    argument_sentences = [s for group in argument_groups for s in group]
+    features = [f for group in argument_groups for f in extract_features_from_instances(group)]
+    rows = [row for sentence in features for row in sentence]
+    arguments_path = os.path.join(directory, 'benchmark-arguments.tsv')
+    write_results_arg_ident_to_tsv([argument_sentences], arguments_path)
+    features_path = os.path.join(directory, 'benchmark-features.tsv')
+    write_results_feature_extraction_to_tsv(features, features_path)
+    classifier, encoder = create_classifier(rows, FEATURE_NAMES)
+
+    num_tokens = sum(map(len, sentences))
+    num_argument_tokens = sum(map(len, argument_sentences))
+    stages = {
+        'read_sentences_from_connlu': (lambda: read_sentences_from_connlu(path), num_tokens, 'tokens'),
+        'identify_predicates': (lambda: [identify_predicates(sentence, 'rule') for sentence in sentences],
+                                num_tokens, 'tokens'),
+        'predict_arguments_for_sentences': (lambda: [predict_arguments_for_sentences(sentence, 10, 11, 'rule')
+                                                     for sentence in predicate_sentences], num_tokens, 'tokens'),
+        'extract_features_from_instances': (lambda: [extract_features_from_instances(group)
+                                                     for group in argument_groups], num_argument_tokens, 'tokens'),
+        'create_classifier': (lambda: create_classifier(rows, FEATURE_NAMES), len(rows), 'instances'),
+        'get_predictions': (lambda: get_predictions(features_path, encoder, classifier), len(rows), 'instances'),
+        'evaluate_file': (lambda: evaluate_file(arguments_path, 'argument_identification'), num_argument_tokens,
+                          'tokens'),
+    }
+    results = {}
+    for name, (func, count, unit) in stages.items():
+        result = measure(func, repeat)
+        result.update({'count': count, 'unit': unit, 'per_second': count / result['seconds']})
+        results[name] = result
+    return results
+
+
+def find_mismatches(config: Dict, results: Dict[str, Dict], baseline: Dict) -> List[str]:
+    """
+    Return a description of every difference between the settings and the corpus the results and the baseline were
+    measured on: their config, the stages measured and the number of tokens or instances of every stage. Timings of
+    different corpora can't be compared.
+    """
+    mismatches = [f"{key}: {baseline['config'].get(key)} in the baseline, {value} in this run"
+                  for key, value in config.items() if baseline['config'].get(key) != value]
+    for name in results.keys() - baseline['stages'].keys():
+        mismatches.append(f'{name}: not in the baseline')
+    for name in baseline['stages'].keys() - results.keys():
+        mismatches.append(f'{name}: in the baseline, but not measured')
+    for name, result in results.items():
+        base = baseline['stages'].get(name)
+        if base is not None and base['count'] != result['count']:
+            mismatches.append(f"{name}: {base['count']} {base['unit']} in the baseline, {result['count']} "
+                              f"{result['unit']} in this run")
+    return mismatches
+
+
+def find_regressions(results: Dict[str, Dict], baseline: Dict[str, Dict]) -> List[str]:
+    """
+    Compare the results with the baseline and return a description of every regression. Every stage in the baseline
+    can have its own threshold, otherwise the one in STAGE_THRESHOLDS or THRESHOLD is used.
+    """
+    regressions = []
+    for name, base in baseline.items():
+        if name not in results:
+            continue
+        threshold = base.get('threshold', STAGE_THRESHOLDS.get(name, THRESHOLD))
+        result = results[name]
+        if result['per_second'] < base['per_second'] * (1 - threshold):
+            regressions.append(f"{name}: {result['per_second']:.0f} {result['unit']}/s, baseline "
+                               f"{base['per_second']:.0f} (threshold {threshold:.0%})")
+        if result['peak_mb'] > base['peak_mb'] * (1 + threshold) + 1:  # ignore changes below 1 MB
+            regressions.append(f"{name}: peak memory {result['peak_mb']:.1f} MB, baseline {base['peak_mb']:.1f} MB "
+                               f"(threshold {threshold:.0%})")
+    return regressions
+
+
+def describe_machine() -> str:
+    """Describe the machine and Python version the benchmark runs on, which the times depend on."""
+    return f'{platform.node()} ({platform.machine()}, {os.cpu_count()} CPUs), Python {platform.python_version()}'
+
+
+def print_results(results: Dict[str, Dict]) -> None:
+    print(f"{'stage':<34}{'seconds':>10}{'throughput':>22}{'peak MB':>10}")
+    for name, result in results.items():
+        print(f"{name:<34}{result['seconds']:>10.3f}{result['per_second']:>13.0f} {result['unit'] + '/s':<8}"
+              f"{result['peak_mb']:>10.1f}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Benchmark every stage of the pipeline on a synthetic corpus, and compare the results with a stored baseline.
+    Return 1 if any stage regressed, or if there is no baseline measured on the same corpus and machine, so the
+    benchmark can fail a build. Times depend on the machine, so the baseline is stored on every machine it runs on.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark every stage of the pipeline on a synthetic corpus.')
+    parser.add_argument('--sentences', type=int, default=5000, help='number of sentences in the corpus')
+    parser.add_argument('--sentence-length', type=int, default=20, help='average number of tokens in a sentence')
+    parser.add_argument('--predicate-density', type=float, default=0.15,
+                        help='fraction of the tokens which are predicates')
+    parser.add_argument('--repeat', type=int, default=3, help='number of times every stage is timed')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='path to the .json file with the baseline')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the new baseline instead of comparing them with it')
+    parser.add_argument('--output', help='path to a .json file the results are written to')
+    args = parser.parse_args(argv)
+
+    config = {'sentences': args.sentences, 'sentence_length': args.sentence_length,
+              'predicate_density': args.predicate_density, 'machine': describe_machine()}
+    with tempfile.TemporaryDirectory() as directory:
+        results = run_benchmarks(directory, args.sentences, args.sentence_length, args.predicate_density,
+                                 args.repeat)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump({'config': config, 'stages': results}, outfile, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as outfile:
+            json.dump({'config': config, 'stages': results}, outfile, indent=2)
+        print(f'Baseline written to {args.baseline}')
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f'No baseline in {args.baseline}, run with --save-baseline to store one for this machine')
+        return 1
+    with open(args.baseline) as infile:
+        baseline = json.load(infile)
+    mismatches = find_mismatches(config, results, baseline)
+    if mismatches:
+        for mismatch in mismatches:
+            print(f'MISMATCH {mismatch}')
+        print(f'The baseline in {args.baseline} was measured on another corpus or machine, run with its settings or '
+              f'with --save-baseline to store a new one')
+        return 1
+    regressions = find_regressions(results, baseline['stages'])
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    if not regressions:
+        print('No regressions')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,282 @@
+import argparse
+import ast
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import shutil
+import tempfile
+from types import ModuleType
+from typing import Any, BinaryIO, Callable, Dict, Iterable, List, Optional, Set
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))  # the directory of the modules of the pipeline
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.cache')
+STAGE_CACHE_DIR = os.path.join(CACHE_DIR, 'stages')
+MAX_BYTES = 2 * 1024 ** 3  # size of a cache above which the least recently used entries are evicted
+
+
+class HashingFile:
+    """A write-only file object which computes the hash of the text written to it, e.g. by a csv writer."""
+
+    def __init__(self):
+        self.hash = hashlib.sha256()
+
+    def write(self, text: str) -> None:
+        self.hash.update(text.encode('utf-8'))
+
+    def hexdigest(self) -> str:
+        return self.hash.hexdigest()
+
+
+def hash_file(path: str) -> str:
+    """Return the hash of the contents of a file."""
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(1 << 20), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def hash_json(value: Any) -> str:
+    """Return the hash of a value that can be written to .json, e.g. a dictionary of parameters."""
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def write_atomically(path: str, write: Callable[[BinaryIO], Any]) -> None:
+    """
+    Write a file with a function writing to a binary file object. The file is written to a temporary file first, so a
+    crash or another process never sees it half-written.
+    """
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-')
+    try:
+        with os.fdopen(handle, 'wb') as outfile:
+            write(outfile)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def get_local_imports(path: str, directory: str = SOURCE_DIR) -> Set[str]:
+    """
+    Return the paths of the modules in a directory which the module at path imports, also inside functions (the
+    modules of the pipeline import each other by their bare names, and some only when they are used).
+    """
+    with open(path, 'rb') as infile:
+        tree = ast.parse(infile.read(), path)
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names.add(node.module.split('.')[0])
+    paths = (os.path.join(directory, f'{name}.py') for name in names)
+    return {path for path in paths if os.path.exists(path)}
+
+
+def get_source_files(paths: Iterable[str], directory: str = SOURCE_DIR) -> List[str]:
+    """Return the paths of modules and of all modules in a directory they import, directly or indirectly, sorted."""
+    found = set()
+    waiting = [os.path.abspath(path) for path in paths]
+    while waiting:
+        path = waiting.pop()
+        if path not in found:
+            found.add(path)
+            waiting.extend(get_local_imports(path, directory) - found)
+    return sorted(found)
+
+
+def hash_source(*modules: ModuleType, directory: str = SOURCE_DIR) -> str:
+    """
+    Return the hash of the source code of modules and of every module of the pipeline they import, directly or
+    indirectly, so that cached results are invalidated when any code a stage runs (e.g. the writing of files in
+    fileio) is edited.
+    """
+    paths = get_source_files([inspect.getsourcefile(module) for module in modules], directory)
+    return hash_json({os.path.relpath(path, directory): hash_file(path) for path in paths})
+
+
+class DiskCache:
+    """
+    A directory of files stored under keys (e.g. hashes of their inputs). When the total size of the files grows above
+    max_bytes, the least recently used ones are removed.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the path of the file stored under a key, or None if there is none."""
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)  # mark the file as recently used
+        return path
+
+    def put_file(self, key: str, source_path: str) -> str:
+        """Store a copy of a file under a key and return the path of the copy."""
+        def copy(outfile):
+            with open(source_path, 'rb') as infile:
+                shutil.copyfileobj(infile, outfile)
+        return self._put(key, copy)
+
+    def put_object(self, key: str, value: Any) -> str:
+        """Store a pickled object under a key and return the path of the file."""
+        return self._put(key, lambda outfile: pickle.dump(value, outfile, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def get_object(self, key: str) -> Optional[Any]:
+        """Return the object stored under a key, or None if there is none."""
+        path = self.get(key)
+        if path is None:
+            return None
+        with open(path, 'rb') as infile:
+            return pickle.load(infile)
+
+    def _put(self, key: str, write) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        write_atomically(self.path(key), write)
+        self.evict()
+        return self.path(key)
+
+    def entries(self) -> List[os.DirEntry]:
+        """Return the entries of the cache, least recently used first."""
+        if not os.path.isdir(self.directory):
+            return []
+        entries = [entry for entry in os.scandir(self.directory) if entry.is_file() and
+                   not entry.name.startswith('.tmp-')]
+        return sorted(entries, key=lambda entry: entry.stat().st_mtime)
+
+    def size(self) -> int:
+        return sum(entry.stat().st_size for entry in self.entries())
+
+    def evict(self) -> List[str]:
+        """Remove the least recently used entries until the cache fits in max_bytes. Return their keys."""
+        entries = self.entries()
+        total = sum(entry.stat().st_size for entry in entries)
+        evicted = []
+        for entry in entries[:-1]:  # never evict the most recent entry
+            if total <= self.max_bytes:
+                break
+            total -= entry.stat().st_size
+            os.remove(entry.path)
+            evicted.append(entry.name)
+        return evicted
+
+    def remove(self, keys: Iterable[str]) -> None:
+        for key in keys:
+            if os.path.exists(self.path(key)):
+                os.remove(self.path(key))
+
+    def clear(self) -> int:
+        """Remove all entries and return how many there were."""
+        entries = self.entries()
+        for entry in entries:
+            os.remove(entry.path)
+        return len(entries)
+
+
+class StageCache:
+    """
+    Cache the outputs of the stages of the pipeline on disk.
+
+    The output of a stage is stored under a fingerprint of its inputs, its parameters and the source code of the
+    modules implementing it and of all modules of the pipeline those import. Outputs are named, e.g. by the path of
+    the file the file-based pipeline would write them to, and the fingerprint of a named output is used as the
+    fingerprint of the input of the stages that use it. Any other input is a file whose contents are hashed. Changing
+    a stage's parameters or code therefore changes its fingerprint and the fingerprints of all stages downstream of
+    it, while the stages upstream of it are still served from the cache.
+    """
+
+    def __init__(self, cache: DiskCache, source_dir: str = SOURCE_DIR):
+        self.cache = cache
+        self.source_dir = source_dir  # the directory of the modules of the pipeline whose code is hashed
+        self.fingerprints = {}  # name of an output -> fingerprint of the stage that produced it
+        self.hits = []
+        self.misses = []
+
+    def fingerprint_of(self, name: str) -> str:
+        """Return the fingerprint of a named output, or the hash of the contents of a file."""
+        if name not in self.fingerprints:
+            self.fingerprints[name] = hash_file(name)
+        return self.fingerprints[name]
+
+    def fingerprint(self, stage: str, input_names: List[str], params: Dict, modules: List[ModuleType]) -> str:
+        return hash_json({'stage': stage, 'inputs': [self.fingerprint_of(name) for name in input_names],
+                          'params': params, 'code': hash_source(*modules, directory=self.source_dir)})
+
+    def merge(self, other: 'StageCache') -> None:
+        """Add the outputs another copy of the cache, e.g. on a worker process, fingerprinted, loaded and computed."""
+        self.fingerprints.update(other.fingerprints)
+        self.hits.extend(name for name in other.hits if name not in self.hits)
+        self.misses.extend(name for name in other.misses if name not in self.misses)
+
+    def run(self, stage: str, output_name: str, input_names: List[str], params: Dict, modules: List[ModuleType],
+            compute: Callable[[], Any]) -> Any:
+        """Return the output of a stage from the cache, or compute it and store it in the cache."""
+        key = self.fingerprint(stage, input_names, params, modules)
+        self.fingerprints[output_name] = key
+        if self.cache.get(key) is not None:
+            self.hits.append(output_name)
+            return self.cache.get_object(key)
+        self.misses.append(output_name)
+        output = compute()
+        self.cache.put_object(key, output)
+        return output
+
+    def run_file(self, stage: str, input_path: str, output_path: str, params: Dict, modules: List[ModuleType],
+                 compute: Callable[[], Any]) -> None:
+        """
+        Copy the output file of a file-based stage from the cache, or compute it (compute writes the file) and store
+        it in the cache. The input file is always fingerprinted by its contents, so the stages downstream of a stage
+        whose output didn't change are served from the cache too.
+        """
+        self.fingerprints.pop(input_path, None)
+        key = self.fingerprint(stage, [input_path], params, modules)
+        cached_path = self.cache.get(key)
+        if cached_path is not None:
+            self.hits.append(output_path)
+            shutil.copyfile(cached_path, output_path)
+            return
+        self.misses.append(output_path)
+        compute()
+        self.cache.put_file(key, output_path)
+
+
+def run_file_stage(stage_cache: Optional[StageCache], stage: str, input_path: str, output_path: str, params: Dict,
+                   modules: List[ModuleType], compute: Callable[[], Any]) -> None:
+    """Run a file-based stage through the stage cache, or just run it if no cache is used."""
+    if stage_cache is None:
+        compute()
+    else:
+        stage_cache.run_file(stage, input_path, output_path, params, modules, compute)
+
+
+def create_stage_cache(directory: str = STAGE_CACHE_DIR, max_megabytes: int = 2048) -> StageCache:
+    """Create the cache of outputs of the stages of the pipeline."""
+    return StageCache(DiskCache(directory, max_megabytes * 1024 ** 2))
+
+
+def main():
+    """Show or clear the contents of the caches."""
+    parser = argparse.ArgumentParser(description='Show or clear the contents of the caches.')
+    parser.add_argument('command', choices=['info', 'clear'])
+    parser.add_argument('--dir', default=CACHE_DIR, help='directory of the caches')
+    args = parser.parse_args()
+    if not os.path.isdir(args.dir):
+        print(f'No cache in {args.dir}')
+        return
+    for name in sorted(os.listdir(args.dir)):
+        cache = DiskCache(os.path.join(args.dir, name))
+        if args.command == 'clear':
+            print(f'{name}: removed {cache.clear()} entries')
+        else:
+            print(f'{name}: {len(cache.entries())} entries, {cache.size() / 1024 ** 2:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
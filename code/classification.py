@@ -1,62 +1,280 @@
-from sklearn.svm import LinearSVC
-from sklearn.feature_extraction import DictVectorizer
+from collections import deque
+from cache import CACHE_DIR, DiskCache, HashingFile, hash_file, hash_json, write_atomically
+from fileio import open_file, write_rows
+from itertools import chain
+from parallel import iter_chunks
+from profiling import profiled, profile_stage
+import argparse
 import csv
+import importlib
+import os
+import pickle
+
+MODEL_CACHE_DIR = os.path.join(CACHE_DIR, 'models')
+BATCH_SIZE = 10000  # number of rows of features in every minibatch of incremental training
 
 
 # reusing parts of our code from https://github.com/LahiLuk/TMgp4-negation-cue-detection/blob/main/code/SVM.py
 
-def extract_features_and_labels(file_path):
-    """Extract a set of features and labels from file."""
-    features = []
-    labels = []
-    with open(file_path, 'r', encoding='utf8') as infile:
-        # restval specifies value to be used for missing values
-        reader = csv.DictReader(infile, restval='', delimiter='\t', quotechar='\\')
-        features_list = reader.fieldnames[:-1]
-        label_column = reader.fieldnames[-1]
-        for row in reader:
-            feature_dict = {}
-            for feature_name in features_list:
-                if row[feature_name]:  # if there is a value for this feature
-                    feature_dict[feature_name] = row[feature_name]
-            features.append(feature_dict)
-            labels.append(row[label_column])
-    return features, labels
-
-
-def create_classifier(train_features, train_labels):
-    """Vectorize features and create classifier from training data."""
-    classifier = LinearSVC(random_state=42)
-    vec = DictVectorizer()
-    train_features_vectorized = vec.fit_transform(train_features)
-    classifier.fit(train_features_vectorized, train_labels)
-    return classifier, vec
-
-
-def get_predictions(test_path, vectorizer, classifier):
-    """Vectorize test features and get predictions."""
-    test_features = extract_features_and_labels(test_path)[0]
-    test_features_vectorized = vectorizer.transform(test_features)
-    predictions = classifier.predict(test_features_vectorized)
+def read_feature_names(file_path):
+    """Read in the feature names from the header row of a file."""
+    with open_file(file_path) as infile:
+        return next(csv.reader(infile, delimiter='\t', quotechar='\\'))[:-1]
+
+
+@profiled(counts=lambda output: {'instances': len(output[1])})
+def read_feature_rows(file_path):
+    """Read in the feature names and the rows of features, each ending with a label, from a file."""
+    with open_file(file_path) as infile:
+        reader = csv.reader(infile, delimiter='\t', quotechar='\\')
+        feature_names = next(reader)[:-1]
+        return feature_names, [row for row in reader if row]  # like csv.DictReader, skip empty rows
+
+
+def get_labels(rows):
+    """Return the label at the end of every row of features."""
+    return [row[-1] for row in rows]
+
+
+# linear models to choose from; scikit-learn (and numpy and scipy with it) is only imported once a model is created,
+# so the stages which don't need it start quickly
+MODELS = {'svm': 'sklearn.svm.LinearSVC', 'logistic': 'sklearn.linear_model.LogisticRegression',
+          'sgd': 'sklearn.linear_model.SGDClassifier'}
+
+
+def create_model(name='svm', **params):
+    """Create the (untrained) classifier: a linear SVM by default, or another linear model of MODELS, with the given
+    hyperparameters."""
+    module_name, class_name = MODELS[name].rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)(random_state=42, **params)
+
+
+def create_encoder(feature_names, n_hashed_features=None):
+    """Create the (unfitted) feature encoder, which hashes the features into n_hashed_features columns if given."""
+    from feature_encoding import FeatureEncoder
+    return FeatureEncoder(feature_names, n_hashed_features)
+
+
+@profiled()
+def create_classifier(train_rows, feature_names, n_hashed_features=None):
+    """Encode features and create classifier from rows of training data."""
+    classifier = create_model()
+    encoder = create_encoder(feature_names, n_hashed_features)
+    with profile_stage('vectorization', instances=len(train_rows)):
+        train_features_encoded = encoder.fit_transform(train_rows)
+    with profile_stage('fit', instances=len(train_rows)):
+        classifier.fit(train_features_encoded, get_labels(train_rows))
+    return classifier, encoder
+
+
+def hash_feature_rows(rows, feature_names):
+    """Return the hash of rows of features, computed over the same text as they are written to a file with."""
+    outfile = HashingFile()
+    write_rows(outfile, chain([feature_names + ['label']], rows))
+    return outfile.hexdigest()
+
+
+def get_model_key(features_hash, feature_names, n_hashed_features=None):
+    """Return the key of a classifier trained on features with the given hash in the model cache. The key also
+    depends on the hyperparameters of the classifier and the encoder and the version of scikit-learn."""
+    import sklearn
+    model = create_model()
+    return hash_json({'features': features_hash, 'model': type(model).__name__, 'params': model.get_params(),
+                      'encoder': create_encoder(feature_names, n_hashed_features).get_params(),
+                      'sklearn': sklearn.__version__})
+
+
+def load_or_create_classifier(features_hash, get_train_rows, feature_names, model_cache=None,
+                              n_hashed_features=None):
+    """Load the classifier and encoder trained on features with the given hash from the model cache. If they are
+    not in the cache (or no cache is used), get the rows of training data, create the classifier and store it in the
+    cache."""
+    if model_cache is None:
+        return create_classifier(get_train_rows(), feature_names, n_hashed_features)
+    key = get_model_key(features_hash, feature_names, n_hashed_features)
+    cached = model_cache.get_object(key)
+    if cached is not None:
+        return cached
+    classifier, encoder = create_classifier(get_train_rows(), feature_names, n_hashed_features)
+    model_cache.put_object(key, (classifier, encoder))
+    return classifier, encoder
+
+
+def create_model_cache(directory=MODEL_CACHE_DIR, max_megabytes=2048):
+    """Create the cache of trained classifiers."""
+    return DiskCache(directory, max_megabytes * 1024 ** 2)
+
+
+@profiled(counts=lambda predictions: {'instances': len(predictions)})
+def get_predictions(test_path, encoder, classifier):
+    """Encode test features and get predictions."""
+    test_rows = read_feature_rows(test_path)[1]
+    test_features_encoded = encoder.transform(test_rows)
+    predictions = classifier.predict(test_features_encoded)
     return predictions
 
 
 def write_predictions_to_features_file(predictions, in_path, out_path):
     """Write predictions to a file containing features."""
-    with open(in_path, encoding='utf-8') as infile:
+    with open_file(in_path) as infile:
+        reader = csv.reader(infile, delimiter='\t', quotechar='\\')
+        with open_file(out_path, 'w', newline='') as outfile:
+            header = next(reader) + ['prediction']
+            write_rows(outfile, chain([header], (row + [prediction] for row, prediction in zip(reader, predictions))))
+
+
+@profiled()
+def classify_arguments(train_rows, test_rows, feature_names, model_cache=None, n_hashed_features=None):
+    """Train an SVM classifier on rows of training set features, or load it from the model cache. Return predictions
+    of the classifier on rows of test set features."""
+    classifier, encoder = load_or_create_classifier(
+        hash_feature_rows(train_rows, feature_names) if model_cache is not None else None,
+        lambda: train_rows, feature_names, model_cache, n_hashed_features)
+    with profile_stage('prediction', instances=len(test_rows)):
+        predictions = classifier.predict(encoder.transform(test_rows))
+    return predictions
+
+
+def classify_arguments_and_return_predictions(train_features_path, test_features_path, model_cache=None,
+                                              n_hashed_features=None):
+    """Train an SVM classifier on training set arguments, or load it from the model cache. Return predictions of the
+    classifier on test set arguments."""
+    classifier, encoder = load_or_create_classifier(
+        hash_file(train_features_path) if model_cache is not None else None,
+        lambda: read_feature_rows(train_features_path)[1], read_feature_names(train_features_path), model_cache,
+        n_hashed_features)
+    predictions = get_predictions(test_features_path, encoder, classifier)
+    write_predictions_to_features_file(predictions, test_features_path,
+                                       test_features_path.replace('.tsv', '-predictions.tsv'))
+    return predictions
+
+
+def iter_feature_row_batches(file_path, batch_size=BATCH_SIZE):
+    """Read in the rows of features from a file one batch of batch_size rows at a time, skipping the header row."""
+    with open_file(file_path) as infile:
         reader = csv.reader(infile, delimiter='\t', quotechar='\\')
-        with open(out_path, 'w', newline='') as outfile:
-            writer = csv.writer(outfile, delimiter='\t', quotechar='\\', quoting=csv.QUOTE_MINIMAL)
-            writer.writerow(next(reader) + ['prediction'])  # write header row
-            for row, prediction in zip(reader, predictions):
-                writer.writerow(row + [prediction])
-
-
-def classify_arguments_and_return_predictions(train_features_path, test_features_path):
-    """Train an SVM classifier on training set arguments. Return predictions of the classifier on test set arguments."""
-    train_features, gold_labels = extract_features_and_labels(train_features_path)
-    classifier, vectorizer = create_classifier(train_features, gold_labels)
-    predictions = get_predictions(test_features_path, vectorizer, classifier)
+        next(reader)
+        yield from iter_chunks((row for row in reader if row), batch_size)
+
+
+def create_incremental_model():
+    """Create the (untrained) classifier for incremental training: a linear SVM trained with stochastic gradient
+    descent, which can be updated one minibatch at a time. Averaging the weights over all updates makes it far less
+    sensitive to the order of the rows and brings it close to LinearSVC."""
+    return create_model('sgd', loss='hinge', average=True)
+
+
+def load_checkpoint(checkpoint_path, params, epochs):
+    """
+    Load the state of incremental training saved with the given parameters (which include the hash of the training
+    data), or return None if there is none. A checkpoint of more epochs than requested can't be undone, so it is
+    ignored too.
+    """
+    if checkpoint_path is None or not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path, 'rb') as infile:
+        checkpoint = pickle.load(infile)
+    return checkpoint if checkpoint['params'] == params and checkpoint['epoch'] <= epochs else None
+
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    """Save the state of incremental training, replacing the previous checkpoint only once it is fully written."""
+    write_atomically(checkpoint_path,
+                     lambda outfile: pickle.dump(checkpoint, outfile, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+@profiled()
+def train_classifier_incrementally(get_row_batches, feature_names, n_hashed_features=None, epochs=1,
+                                   checkpoint_path=None, train_hash=None):
+    """
+    Train a linear classifier on batches of rows of training data with partial_fit, so only one batch has to be in
+    memory at a time. get_row_batches is called for every pass over the data and returns an iterator over the
+    batches. The first pass collects the labels and, unless the features are hashed, fits the encoder. The classifier
+    is then trained for the given number of epochs.
+
+    If a checkpoint path is given, the state of training is saved to it after every epoch, and training resumes after
+    the last saved epoch (e.g. after a crash, or to train for more epochs), as long as the training data is the same:
+    train_hash is the hash of the training data (e.g. of the file it is read from), which is computed from the
+    batches if it isn't given. Return the classifier and the encoder.
+    """
+    if checkpoint_path is not None and train_hash is None:
+        train_hash = hash_feature_rows(chain.from_iterable(get_row_batches()), list(feature_names))
+    params = {'train': train_hash, 'encoder': create_encoder(feature_names, n_hashed_features).get_params(),
+              'model': create_incremental_model().get_params()}
+    checkpoint = load_checkpoint(checkpoint_path, params, epochs)
+    if checkpoint is None:
+        encoder = create_encoder(feature_names, n_hashed_features)
+        labels = set()
+
+        def iter_batches_collecting_labels():
+            for rows in get_row_batches():
+                labels.update(get_labels(rows))
+                yield rows
+
+        batches = iter_batches_collecting_labels()
+        encoder.fit_batches(batches)
+        deque(batches, maxlen=0)  # in the hashing mode, the encoder doesn't read the batches itself
+        checkpoint = {'params': params, 'epoch': 0, 'classifier': create_incremental_model(), 'encoder': encoder,
+                      'classes': sorted(labels)}
+    classifier, encoder, classes = checkpoint['classifier'], checkpoint['encoder'], checkpoint['classes']
+    for epoch in range(checkpoint['epoch'], epochs):
+        for rows in get_row_batches():
+            classifier.partial_fit(encoder.transform(rows), get_labels(rows), classes=classes)
+        checkpoint['epoch'] = epoch + 1
+        if checkpoint_path is not None:
+            save_checkpoint(checkpoint_path, checkpoint)
+    return classifier, encoder
+
+
+@profiled(counts=lambda predictions: {'instances': len(predictions)})
+def predict_in_batches(row_batches, encoder, classifier):
+    """Return the predictions of the classifier on batches of rows of features."""
+    import numpy as np
+    predictions = [classifier.predict(encoder.transform(rows)) for rows in row_batches]
+    return np.concatenate(predictions) if predictions else np.array([])
+
+
+def classify_arguments_incrementally(train_rows, test_rows, feature_names, n_hashed_features=None, epochs=1,
+                                     batch_size=BATCH_SIZE, checkpoint_path=None):
+    """Train a linear classifier incrementally on minibatches of rows of training set features. Return predictions
+    of the classifier on rows of test set features."""
+    classifier, encoder = train_classifier_incrementally(lambda: iter_chunks(train_rows, batch_size), feature_names,
+                                                         n_hashed_features, epochs, checkpoint_path)
+    return predict_in_batches(iter_chunks(test_rows, batch_size), encoder, classifier)
+
+
+def classify_arguments_incrementally_and_return_predictions(train_features_path, test_features_path,
+                                                            n_hashed_features=None, epochs=1, batch_size=BATCH_SIZE,
+                                                            checkpoint_path=None):
+    """Train a linear classifier incrementally on training set arguments streamed from the file in minibatches, so
+    the training set doesn't need to fit in memory. Return predictions of the classifier on test set arguments."""
+    classifier, encoder = train_classifier_incrementally(
+        lambda: iter_feature_row_batches(train_features_path, batch_size), read_feature_names(train_features_path),
+        n_hashed_features, epochs, checkpoint_path, hash_file(train_features_path) if checkpoint_path else None)
+    predictions = predict_in_batches(iter_feature_row_batches(test_features_path, batch_size), encoder, classifier)
     write_predictions_to_features_file(predictions, test_features_path,
                                        test_features_path.replace('.tsv', '-predictions.tsv'))
     return predictions
+
+
+def main():
+    """Train a classifier incrementally on a file of training set features and classify the arguments in a file of
+    test set features."""
+    parser = argparse.ArgumentParser(description='Train a classifier on training set features streamed from a file in '
+                                                 'minibatches and write its predictions on test set features.')
+    parser.add_argument('train_path', help='path to the file with the training set features')
+    parser.add_argument('test_path', help='path to the file with the test set features')
+    parser.add_argument('--hash-features', type=int, metavar='N',
+                        help='hash the features into N columns instead of fitting a vocabulary in a first pass')
+    parser.add_argument('--epochs', type=int, default=1, help='number of passes over the training set')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='number of rows in every minibatch')
+    parser.add_argument('--checkpoint', help='path of a file the state of training is saved to after every epoch, '
+                                             'and resumed from if it exists')
+    args = parser.parse_args()
+    classify_arguments_incrementally_and_return_predictions(args.train_path, args.test_path, args.hash_features,
+                                                            args.epochs, args.batch_size, args.checkpoint)
+    print(f"Predictions written to {args.test_path.replace('.tsv', '-predictions.tsv')}")
+
+
+if __name__ == '__main__':
+    main()
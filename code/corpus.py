@@ -0,0 +1,336 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+from array import array
+from functools import lru_cache
+from itertools import chain
+from typing import Dict, Iterable, Iterator, List, Optional
+import numpy as np
+from predicate_identification import iter_sentences_from_connlu
+from arg_identification import iter_sentences_from_tsv
+from fileio import strip_compression
+from profiling import profiled, count_sentences
+
+# the columns every token row starts with; the remaining columns (identified predicates, argument labels) vary
+FIXED_COLUMNS = ['ID', 'FORM', 'LEMMA', 'UPOS', 'XPOS', 'FEATS', 'HEAD', 'DEPREL', 'DEPS', 'MISC', 'PRED']
+COLUMN_INDEX = {name: i for i, name in enumerate(FIXED_COLUMNS)}
+MISSING = -1  # code of a cell that is missing from a row
+CELLS_PER_BATCH = 1 << 20  # number of cells collected before they are split into columns when building a corpus
+
+# a compiled corpus file starts with MAGIC, followed by the length of a .json header describing the arrays stored in
+# the rest of the file, every one of which starts at a multiple of ALIGNMENT bytes
+MAGIC = b'CONLLC1\n'
+ALIGNMENT = 64
+COMPILED_EXTENSION = '.conllc'
+ARRAY_DTYPES = {'columns': np.int32, 'label_codes': np.int32, 'label_offsets': np.int64,
+                'sentence_offsets': np.int64, 'strings': np.uint8}
+
+
+class Vocabulary:
+    """Map strings to integer codes and back. Every distinct string is stored only once."""
+
+    def __init__(self, strings: Iterable[str] = ()):
+        self.strings = []
+        self.codes = {}
+        for string in strings:
+            self.encode(string)
+
+    def __len__(self) -> int:
+        return len(self.strings)
+
+    def encode(self, string: str) -> int:
+        """Return the code of a string, adding it to the vocabulary if it is new."""
+        code = self.codes.get(string)
+        if code is None:
+            code = self.codes[string] = len(self.strings)
+            self.strings.append(string)
+        return code
+
+    def decode(self, code: int) -> str:
+        return self.strings[code]
+
+    @classmethod
+    def from_unique_strings(cls, strings: List[str]) -> 'Vocabulary':
+        """Create a vocabulary from a list of distinct strings, which get the codes 0, 1, ... in that order."""
+        vocabulary = cls()
+        vocabulary.strings = strings
+        vocabulary.codes = dict(zip(strings, range(len(strings))))
+        return vocabulary
+
+
+def split_cells(cell_codes: array, row_lengths: array, fixed_batches: List[np.ndarray], label_batches: List[np.ndarray],
+                label_length_batches: List[np.ndarray]) -> None:
+    """
+    Split the codes of the cells of a batch of token rows into the fixed columns and the remaining cells, and append
+    them (and the number of remaining cells in every row) to the lists of batches.
+    """
+    num_fixed = len(FIXED_COLUMNS)
+    cells = np.frombuffer(cell_codes, dtype=np.int32) if len(cell_codes) else np.zeros(0, dtype=np.int32)
+    lengths = np.frombuffer(row_lengths, dtype=np.int64) if len(row_lengths) else np.zeros(0, dtype=np.int64)
+    row_starts = np.cumsum(lengths) - lengths
+    positions = row_starts[:, None] + np.arange(num_fixed)[None, :]
+    present = np.arange(num_fixed)[None, :] < lengths[:, None]  # rows are not supposed to be shorter, but can be
+    fixed = np.full((len(lengths), num_fixed), MISSING, dtype=np.int32)
+    fixed[present] = cells[positions[present]]
+    is_label = np.ones(len(cells), dtype=bool)
+    is_label[positions[present]] = False
+    fixed_batches.append(fixed.T.copy())
+    label_batches.append(cells[is_label].copy())
+    label_length_batches.append(np.maximum(lengths - num_fixed, 0))
+
+
+class ColumnarCorpus:
+    """
+    A corpus of sentences stored column by column in integer-coded NumPy arrays instead of lists of lists of strings.
+
+    All strings are interned in one vocabulary shared by all columns. The fixed columns (FIXED_COLUMNS) are stored in
+    a 2D array with one row per column. The remaining cells of every token row (identified predicates and argument
+    labels), whose number varies between sentences, are stored one after another in a flat array, with the offsets of
+    every token's cells in another one. Sentences are indexed by the offsets of their first tokens.
+
+    Sentences are turned back into lists of token rows one at a time, so the corpus can be passed to every stage of
+    the pipeline in place of a list of sentences.
+
+    A corpus opened from a compiled file (see compile_corpus) reads its arrays straight from the memory-mapped file.
+    It is pickled as the path of that file, so worker processes map the same pages instead of receiving copies.
+    """
+
+    def __init__(self, vocabulary: Vocabulary, columns: np.ndarray, label_codes: np.ndarray,
+                 label_offsets: np.ndarray, sentence_offsets: np.ndarray, mapped_path: Optional[str] = None):
+        self.vocabulary = vocabulary
+        self.columns = columns  # shape (len(FIXED_COLUMNS), number of tokens)
+        self.label_codes = label_codes
+        self.label_offsets = label_offsets  # number of tokens + 1 offsets into label_codes
+        self.sentence_offsets = sentence_offsets  # number of sentences + 1 offsets into the tokens
+        self.mapped_path = mapped_path  # the compiled file the arrays are mapped from, if any
+
+    def __reduce__(self):
+        if self.mapped_path is None:
+            return super().__reduce__()
+        return load_shared_corpus, (self.mapped_path,)
+
+    @classmethod
+    def from_sentences(cls, sentences: Iterable[List[List[str]]],
+                       vocabulary: Optional[Vocabulary] = None) -> 'ColumnarCorpus':
+        """
+        Build a corpus from sentences, reading them one at a time. The codes of all cells of a batch of sentences are
+        collected in a flat array first and split into the columns with NumPy, which is much faster than doing it row
+        by row.
+        """
+        vocabulary = vocabulary if vocabulary is not None else Vocabulary()
+        encode, lookup = vocabulary.encode, vocabulary.codes.get
+        fixed_batches, label_batches, label_length_batches = [], [], []
+        cell_codes = array('i')  # the codes of all cells of the current batch, one row after another
+        row_lengths = array('q')
+        sentence_offsets = array('q', [0])
+        num_tokens = 0
+        for sentence in sentences:
+            codes = list(map(lookup, chain.from_iterable(sentence)))  # much faster than calling encode for every cell
+            if None in codes:  # there are new strings in this sentence
+                codes = [encode(cell) for cell in chain.from_iterable(sentence)]
+            cell_codes.extend(codes)
+            row_lengths.extend(map(len, sentence))
+            num_tokens += len(sentence)
+            sentence_offsets.append(num_tokens)
+            if len(cell_codes) >= CELLS_PER_BATCH:
+                split_cells(cell_codes, row_lengths, fixed_batches, label_batches, label_length_batches)
+                cell_codes, row_lengths = array('i'), array('q')
+        split_cells(cell_codes, row_lengths, fixed_batches, label_batches, label_length_batches)
+        label_offsets = np.concatenate([[0], np.cumsum(np.concatenate(label_length_batches))]).astype(np.int64)
+        return cls(vocabulary, np.concatenate(fixed_batches, axis=1), np.concatenate(label_batches), label_offsets,
+                   np.frombuffer(sentence_offsets, dtype=np.int64).copy())
+
+    def __len__(self) -> int:
+        return len(self.sentence_offsets) - 1
+
+    @property
+    def num_tokens(self) -> int:
+        return len(self.label_offsets) - 1
+
+    @property
+    def nbytes(self) -> int:
+        """Return the number of bytes taken up by the arrays (not counting the vocabulary)."""
+        return self.columns.nbytes + self.label_codes.nbytes + self.label_offsets.nbytes + \
+            self.sentence_offsets.nbytes
+
+    def __getitem__(self, i: int) -> List[List[str]]:
+        """Return the i-th sentence as a list of token rows."""
+        if not 0 <= i < len(self):
+            raise IndexError('sentence index out of range')
+        start, end = self.sentence_offsets[i], self.sentence_offsets[i + 1]
+        strings = self.vocabulary.strings
+        fixed = self.columns[:, start:end].T.tolist()
+        labels = self.label_codes[self.label_offsets[start]:self.label_offsets[end]].tolist()
+        label_offsets = (self.label_offsets[start:end + 1] - self.label_offsets[start]).tolist()
+        sentence = []
+        for j, codes in enumerate(fixed):
+            row = [strings[code] for code in codes if code != MISSING]
+            row.extend([strings[code] for code in labels[label_offsets[j]:label_offsets[j + 1]]])
+            sentence.append(row)
+        return sentence
+
+    def __iter__(self) -> Iterator[List[List[str]]]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def column(self, name: str) -> np.ndarray:
+        """Return the codes of a fixed column for all tokens."""
+        return self.columns[COLUMN_INDEX[name]]
+
+    def label_column(self, index: int) -> np.ndarray:
+        """
+        Return the codes of the cells at a position after the fixed columns (0 for the first one) for all tokens, with
+        MISSING for tokens whose rows don't have that many cells.
+        """
+        starts = self.label_offsets[:-1] + index
+        present = starts < self.label_offsets[1:]
+        codes = np.full(self.num_tokens, MISSING, dtype=np.int32)
+        codes[present] = self.label_codes[starts[present]]
+        return codes
+
+    def integer_column(self, name: str) -> np.ndarray:
+        """
+        Return the values of a fixed column holding integers (ID, HEAD) for all tokens, with MISSING for values that
+        aren't written as plain integers (e.g. 8.1 or 01).
+        """
+        values = np.array([int(string) if string.isdigit() and str(int(string)) == string else MISSING
+                           for string in self.vocabulary.strings] + [MISSING], dtype=np.int64)
+        return values[self.column(name)]  # MISSING codes pick the MISSING value appended at the end
+
+    def with_column(self, name: str, codes: np.ndarray) -> 'ColumnarCorpus':
+        """Return a corpus with the codes of a fixed column replaced, sharing the other arrays with this one."""
+        columns = self.columns.copy()
+        columns[COLUMN_INDEX[name]] = codes
+        return ColumnarCorpus(self.vocabulary, columns, self.label_codes, self.label_offsets, self.sentence_offsets)
+
+    def with_label_column(self, codes: np.ndarray, index: int = 0) -> 'ColumnarCorpus':
+        """
+        Return a corpus with a cell inserted in every token row at a position after the fixed columns (0 for right
+        after them), like list.insert on every row.
+        """
+        lengths = np.diff(self.label_offsets)
+        positions = self.label_offsets[:-1] + np.minimum(index, lengths)  # where the cells go in the old array
+        label_offsets = self.label_offsets + np.arange(self.num_tokens + 1)
+        inserted = positions + np.arange(self.num_tokens)  # where the cells go in the new array
+        label_codes = np.empty(len(self.label_codes) + self.num_tokens, dtype=np.int32)
+        kept = np.ones(len(label_codes), dtype=bool)
+        kept[inserted] = False
+        label_codes[inserted] = codes
+        label_codes[kept] = self.label_codes
+        return ColumnarCorpus(self.vocabulary, self.columns, label_codes, label_offsets, self.sentence_offsets)
+
+    def sentence_ids(self) -> np.ndarray:
+        """Return the index of the sentence every token belongs to."""
+        return np.repeat(np.arange(len(self)), np.diff(self.sentence_offsets))
+
+    def codes_of(self, strings: Iterable[str]) -> Dict[str, int]:
+        """Return the codes of those strings that are in the vocabulary."""
+        return {string: self.vocabulary.codes[string] for string in strings if string in self.vocabulary.codes}
+
+
+@profiled(counts=count_sentences)
+def read_corpus_from_connlu(path: str) -> ColumnarCorpus:
+    """Read in all sentences from a connlu file into a columnar corpus"""
+    return ColumnarCorpus.from_sentences(iter_sentences_from_connlu(path))
+
+
+@profiled(counts=count_sentences)
+def read_corpus_from_tsv(path: str) -> ColumnarCorpus:
+    """Read in all sentences from a tsv file into a columnar corpus"""
+    return ColumnarCorpus.from_sentences(iter_sentences_from_tsv(path))
+
+
+def get_compiled_output_path(path: str) -> str:
+    """Return the path of the compiled corpus file for a connlu file."""
+    return os.path.splitext(strip_compression(path))[0] + COMPILED_EXTENSION
+
+
+def write_compiled_corpus(corpus: ColumnarCorpus, path: str, source: Optional[str] = None) -> None:
+    """
+    Write a corpus to a compiled file: the integer-coded columns, the offsets of the sentences and the labels, and a
+    table of the strings of the vocabulary, which are separated by newlines (cells never contain them).
+    """
+    arrays = {'columns': corpus.columns, 'label_codes': corpus.label_codes, 'label_offsets': corpus.label_offsets,
+              'sentence_offsets': corpus.sentence_offsets,
+              'strings': np.frombuffer('\n'.join(corpus.vocabulary.strings).encode('utf-8'), dtype=np.uint8)}
+    header = {'source': source, 'num_strings': len(corpus.vocabulary), 'arrays': {}}
+    offset = 0
+    for name, values in arrays.items():
+        values = np.ascontiguousarray(values, dtype=ARRAY_DTYPES[name])
+        arrays[name] = values
+        header['arrays'][name] = {'shape': list(values.shape), 'offset': offset}
+        offset += -(-values.nbytes // ALIGNMENT) * ALIGNMENT
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+    with open(path, 'wb') as outfile:
+        outfile.write(MAGIC + struct.pack('<Q', len(header_bytes)) + header_bytes)
+        for name, values in arrays.items():
+            outfile.seek(data_start + header['arrays'][name]['offset'])
+            outfile.write(values.tobytes())
+        outfile.truncate(data_start + offset)
+
+
+def compile_corpus(path: str, output_path: Optional[str] = None) -> str:
+    """Compile a connlu file into a corpus file which can be opened without parsing it again. Return its path."""
+    output_path = output_path or get_compiled_output_path(path)
+    write_compiled_corpus(read_corpus_from_connlu(path), output_path, os.path.basename(path))
+    return output_path
+
+
+def is_compiled_corpus(path: str) -> bool:
+    """Check whether a file is a compiled corpus file."""
+    with open(path, 'rb') as infile:
+        return infile.read(len(MAGIC)) == MAGIC
+
+
+@profiled(counts=count_sentences)
+def open_compiled_corpus(path: str) -> ColumnarCorpus:
+    """
+    Open a compiled corpus file. The arrays are not read in but mapped into memory, so opening even a large corpus is
+    almost instant and the pages are shared by all processes which open the file. Only the string table is decoded.
+    """
+    with open(path, 'rb') as infile:
+        if infile.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a compiled corpus file')
+        header_length, = struct.unpack('<Q', infile.read(8))
+        header = json.loads(infile.read(header_length).decode('utf-8'))
+        data_start = -(-(len(MAGIC) + 8 + header_length) // ALIGNMENT) * ALIGNMENT
+        buffer = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    arrays = {}
+    for name, info in header['arrays'].items():
+        dtype = np.dtype(ARRAY_DTYPES[name])
+        count = int(np.prod(info['shape']))
+        arrays[name] = np.frombuffer(buffer, dtype=dtype, count=count,
+                                     offset=data_start + info['offset']).reshape(info['shape'])
+    strings = arrays.pop('strings').tobytes().decode('utf-8').split('\n') if header['num_strings'] else []
+    return ColumnarCorpus(Vocabulary.from_unique_strings(strings), mapped_path=path, **arrays)
+
+
+@lru_cache(maxsize=None)
+def load_shared_corpus(path: str) -> ColumnarCorpus:
+    """Open a compiled corpus file once per process, e.g. in worker processes unpickling a corpus mapped from it."""
+    return open_compiled_corpus(path)
+
+
+def main():
+    """Compile connlu files into corpus files, or show the size of compiled ones."""
+    parser = argparse.ArgumentParser(description='Compile connlu files into corpus files which can be opened without '
+                                                 'parsing them again.')
+    parser.add_argument('command', choices=['compile', 'info'])
+    parser.add_argument('paths', nargs='+', help='paths to .conllu files to compile or compiled files to describe')
+    parser.add_argument('-o', '--output', help='path of the compiled file (only if a single file is compiled)')
+    args = parser.parse_args()
+    if args.output and len(args.paths) > 1:
+        parser.error('--output can only be used when compiling a single file')
+    for path in args.paths:
+        if args.command == 'compile':
+            print(f'{path} -> {compile_corpus(path, args.output)}')
+        else:
+            corpus = open_compiled_corpus(path)
+            print(f'{path}: {len(corpus)} sentences, {corpus.num_tokens} tokens, {len(corpus.vocabulary)} strings')
+
+
+if __name__ == '__main__':
+    main()
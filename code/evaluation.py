@@ -1,61 +1,243 @@
-from sklearn.metrics import classification_report, confusion_matrix
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 import csv
-import pandas as pd
+import numpy as np
+from fileio import open_file, strip_compression
+from profiling import profiled
+from arg_identification import is_compact_arg_ident_path, parse_compact_sentences_from_tsv, iter_label_rows
 
+BATCH_SIZE = 65536  # number of (gold, predicted) label pairs added to the confusion matrix at once
+HEADERS = ['precision', 'recall', 'f1-score', 'support']
 
+
+def iter_gold_and_pred(rows, task: str):
+    """Yield the gold and predicted label of every row of the output of a task which is evaluated."""
+    if task == "predicate_identification":
+        for row in rows:
+            if row:
+                if row[10] == 'PRED' or row[11] == 'PRED':   # if gold or predicted label is PRED
+                    yield row[10], row[11]
+    if task == "argument_identification":
+        for row in rows:
+            if row:
+                if row[-2] not in ['_', 'V'] or row[-1] == 'ARG':   # if gold or predicted label is an ARG label
+                    if row[-2] == "_":
+                        yield "_", row[-1]
+                    elif row[-2] == "V":
+                        yield "V", row[-1]
+                    else:
+                        yield "ARG", row[-1]
+    if task == "argument_classification":
+        for row in rows:
+            if row:
+                # if row[-3] not in ['V', '_']:   # if gold label is ARG label
+                if row[-3] not in ['V', '_'] or row[-2] == 'ARG':   # if gold label is ARG label or if it was an
+                    # argument we identified
+                    yield row[-3], row[-1]
+
+
+class ConfusionAccumulator:
+    """
+    Count the pairs of gold and predicted labels in a confusion matrix which is updated while they are produced, so
+    they are never kept in memory and only a single pass over them is needed. Labels get a code the first time they
+    are seen, and every batch of pairs is added with a single bincount over the codes.
+
+    Precision, recall, F1-score and support, the classification report and the confusion matrix table are all derived
+    from the matrix, and are the same as Scikit-learn's classification_report (with zero_division=0) and
+    confusion_matrix give for the lists of labels.
+    """
+
+    def __init__(self):
+        self.codes = {}  # label -> its row (gold) and column (predicted) in the matrix
+        self.matrix = np.zeros((0, 0), dtype=np.int64)
+
+    def __len__(self) -> int:
+        return int(self.matrix.sum())
+
+    def encode(self, labels: Sequence[str]) -> np.ndarray:
+        codes = self.codes
+        return np.fromiter((codes.setdefault(label, len(codes)) for label in labels), dtype=np.intp,
+                           count=len(labels))
+
+    def update(self, gold_labels: Sequence[str], predictions: Sequence[str]) -> None:
+        """Add pairs of gold and predicted labels to the matrix."""
+        gold, pred = self.encode(gold_labels), self.encode(predictions)
+        n = len(self.codes)
+        if n > len(self.matrix):  # new labels get a row and a column
+            matrix = np.zeros((n, n), dtype=np.int64)
+            matrix[:len(self.matrix), :len(self.matrix)] = self.matrix
+            self.matrix = matrix
+        self.matrix += np.bincount(gold * n + pred, minlength=n * n).reshape(n, n)
+
+    def update_from_pairs(self, pairs: Iterable[Tuple[str, str]]) -> 'ConfusionAccumulator':
+        """Add (gold, predicted) label pairs from an iterable, a batch at a time."""
+        pairs = iter(pairs)
+        for batch in iter(lambda: list(islice(pairs, BATCH_SIZE)), []):
+            self.update(*zip(*batch))
+        return self
+
+    @classmethod
+    @profiled(counts=lambda accumulator: {'labels': len(accumulator)})
+    def from_rows(cls, rows, task: str) -> 'ConfusionAccumulator':
+        """Count the gold and predicted labels in rows of the output of a task."""
+        return cls().update_from_pairs(iter_gold_and_pred(rows, task))
+
+    @classmethod
+    def from_labels(cls, gold_labels: Sequence[str], predictions: Sequence[str]) -> 'ConfusionAccumulator':
+        accumulator = cls()
+        accumulator.update(gold_labels, predictions)
+        return accumulator
+
+    @property
+    def labels(self) -> List[str]:
+        """All gold and predicted labels, sorted."""
+        return sorted(self.codes)
+
+    def get_sorted_matrix(self) -> np.ndarray:
+        """Return the matrix with the rows and columns in the order of the sorted labels."""
+        order = [self.codes[label] for label in self.labels]
+        return self.matrix[np.ix_(order, order)]
+
+    def get_scores(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Return the precision, recall, F1-score and support of every label, in the order of the sorted labels."""
+        matrix = self.get_sorted_matrix()
+        true_positives = np.diag(matrix).astype(float)
+        support = matrix.sum(axis=1)
+        predicted = matrix.sum(axis=0)
+        precision = divide(true_positives, predicted)
+        recall = divide(true_positives, support)
+        f1 = divide(2 * true_positives, support + predicted)
+        return precision, recall, f1, support
+
+    def get_report(self) -> Dict:
+        """Return the classification report as a dictionary, like classification_report with output_dict=True."""
+        precision, recall, f1, support = self.get_scores()
+        report = {label: dict(zip(HEADERS, map(float, scores)))
+                  for label, *scores in zip(self.labels, precision, recall, f1, support)}
+        total = int(support.sum())
+        report['accuracy'] = float(np.trace(self.matrix) / total) if total else 0.0
+        for average, weights in [('macro avg', None), ('weighted avg', support)]:
+            report[average] = dict(zip(HEADERS, [float(average_scores(scores, weights))
+                                                 for scores in (precision, recall, f1)] + [float(total)]))
+        return report
+
+    def format_report(self, digits: int = 2) -> str:
+        """Return the classification report as text, like classification_report."""
+        report = self.get_report()
+        width = max(max(map(len, self.labels), default=0), len('weighted avg'), digits)
+        row_format = '{:>{width}s} ' + ' {:>9.{digits}f}' * 3 + ' {:>9}\n'
+        text = ('{:>{width}s} ' + ' {:>9}' * len(HEADERS)).format('', *HEADERS, width=width) + '\n\n'
+        for label in self.labels:
+            scores = report[label]
+            text += row_format.format(label, scores['precision'], scores['recall'], scores['f1-score'],
+                                      int(scores['support']), width=width, digits=digits)
+        text += '\n'
+        total = len(self)
+        text += ('{:>{width}s} ' + ' {:>9.{digits}}' * 2 + ' {:>9.{digits}f}' + ' {:>9}\n').format(
+            'accuracy', '', '', report['accuracy'], total, width=width, digits=digits)
+        for average in ['macro avg', 'weighted avg']:
+            scores = report[average]
+            text += row_format.format(average, scores['precision'], scores['recall'], scores['f1-score'], total,
+                                      width=width, digits=digits)
+        return text
+
+    def get_report_table(self, metric: Optional[str] = None, digits: int = 3):
+        """Return the classification report as a dataframe with rounded scores, or only the row of a metric."""
+        import pandas as pd  # only imported when tables are needed, as it takes long to import
+        df_report = pd.DataFrame(self.get_report()).transpose()
+        df_report = df_report.round(digits)
+        df_report['support'] = df_report['support'].astype(int)
+        if metric:
+            return df_report.loc[metric]
+        return df_report
+
+    def get_confusion_matrix_table(self):
+        """Return the confusion matrix of the gold labels as a dataframe, without labels which are only predicted."""
+        import pandas as pd
+        matrix = self.get_sorted_matrix()
+        gold = matrix.sum(axis=1) > 0
+        labels = [label for label, is_gold in zip(self.labels, gold) if is_gold]
+        return pd.DataFrame(matrix[np.ix_(gold, gold)], index=labels, columns=labels)
+
+
+def divide(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    """Divide, with a result of 0 where the denominator is 0."""
+    return numerator / np.where(denominator == 0, 1, denominator)
+
+
+def average_scores(scores: np.ndarray, weights: Optional[np.ndarray] = None) -> float:
+    if len(scores) == 0:
+        return np.nan
+    if weights is None or weights.sum() == 0:
+        return np.average(scores)
+    return np.average(scores, weights=weights)
+
+
+@profiled(counts=lambda labels: {'labels': len(labels[0])})
+def get_gold_and_pred_from_rows(rows, task: str):
+    """Extract gold and predicted labels from rows of the output of a task and return them."""
+    gold, pred = [], []
+    for gold_label, pred_label in iter_gold_and_pred(rows, task):
+        gold.append(gold_label)
+        pred.append(pred_label)
+    return gold, pred
+
+
+@profiled()
 def get_gold_and_pred(path: str, task: str):
     """Extract gold and predicted labels from a file and return them."""
-    gold, pred = [], []
-    with open(path, newline='') as csvfile:
+    with open_file(path, newline='') as csvfile:
         reader = csv.reader(csvfile, delimiter='\t', quotechar='\\')
-        if task == "predicate_identification":
-            for row in reader:
-                if row:
-                    if row[10] == 'PRED' or row[11] == 'PRED':   # if gold or predicted label is PRED
-                        gold.append(row[10])
-                        pred.append(row[11])
-        if task == "argument_identification":
-            for row in reader:
-                if row:
-                    if row[-2] not in ['_', 'V'] or row[-1] == 'ARG':   # if gold or predicted label is an ARG label
-                        if row[-2] == "_":
-                            gold.append("_")
-                        elif row[-2] == "V":
-                            gold.append("V")
-                        else:
-                            gold.append("ARG")
-                        pred.append(row[-1])
         if task == "argument_classification":
             next(reader)  # skip header row
-            for row in reader:
-                if row:
-                    # if row[-3] not in ['V', '_']:   # if gold label is ARG label
-                    if row[-3] not in ['V', '_'] or row[-2] == 'ARG':   # if gold label is ARG label or if it was an
-                        # argument we identified
-                        gold.append(row[-3])
-                        pred.append(row[-1])
-    return gold, pred
+        return get_gold_and_pred_from_rows(reader, task)
+
+
+def iter_file_rows(path: str, task: str) -> Iterator[List[str]]:
+    """
+    Yield the rows of a file of the output of a task, without the header of the predictions of argument classification.
+    The results of argument identification can be in the expanded or the compact format.
+    """
+    if task == "argument_identification" and is_compact_arg_ident_path(path):
+        with open_file(path) as infile:
+            yield from iter_label_rows(parse_compact_sentences_from_tsv(infile))
+        return
+    with open_file(path, newline='') as csvfile:
+        reader = csv.reader(csvfile, delimiter='\t', quotechar='\\')
+        if task == "argument_classification":
+            next(reader)  # skip header row
+        yield from reader
+
+
+def get_task_of_path(path: str) -> str:
+    """Return the task whose output is in a file, from the name the pipeline gives the file."""
+    path = strip_compression(path)
+    if '-features' in path:
+        raise ValueError(f'{path} is a file of features, evaluate the predictions for the arguments instead')
+    if path.endswith('-predictions.tsv'):
+        return 'argument_classification'
+    if '-arg_iden-' in path and path.endswith('.tsv'):
+        return 'argument_identification'
+    if '-pred_iden-' in path and path.endswith('.tsv'):
+        return 'predicate_identification'
+    raise ValueError(f'Can\'t tell which task {path} is the output of, pass --task')
+
+
+@profiled()
+def evaluate_file(path: str, task: str) -> ConfusionAccumulator:
+    """Count the gold and predicted labels in a file in a single pass, without keeping them in memory."""
+    return ConfusionAccumulator.from_rows(iter_file_rows(path, task), task)
 
 
 # reusing parts of my code from https://github.com/LahiLuk/TMgp4-negation-cue-detection/blob/main/code/utils.py
 
+@profiled()
 def calculate_precision_recall_f1_score(gold_labels, predictions, metric=None, digits=3):
     """Calculate evaluation metrics."""
-    # get the report in dictionary form
-    report = classification_report(gold_labels, predictions, zero_division=0, output_dict=True)
-    # transform dictionary into a dataframe and round the results
-    df_report = pd.DataFrame(report).transpose()
-    df_report = df_report.round(digits)
-    df_report['support'] = df_report['support'].astype(int)
-    if metric:
-        return df_report.loc[metric]
-    return df_report
+    return ConfusionAccumulator.from_labels(gold_labels, predictions).get_report_table(metric, digits)
 
 
+@profiled()
 def generate_confusion_matrix(gold_labels, predictions):
     """Generate a confusion matrix."""
-    labels = sorted(set(gold_labels))
-    cf_matrix = confusion_matrix(gold_labels, predictions, labels=labels)
-    # transform confusion matrix into a dataframe
-    df_cf_matrix = pd.DataFrame(cf_matrix, index=labels, columns=labels)
-    return df_cf_matrix
+    return ConfusionAccumulator.from_labels(gold_labels, predictions).get_confusion_matrix_table()
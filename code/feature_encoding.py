@@ -0,0 +1,100 @@
+from itertools import repeat, zip_longest
+from typing import Dict, Iterable, List, Optional, Sequence
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.utils import murmurhash3_32
+
+MISSING = -1  # index of a missing or unknown value, which doesn't get a column
+
+
+def hash_feature(feature: str, n_features: int) -> int:
+    """Return the column of a feature in the hashing mode, the same as sklearn's FeatureHasher puts it in."""
+    h = murmurhash3_32(feature, seed=0)
+    if h == -2 ** 31:  # abs() would overflow in FeatureHasher, which handles this value separately
+        return (2 ** 31 - 1 - (n_features - 1)) % n_features
+    return abs(h) % n_features
+
+
+class FeatureEncoder:
+    """
+    Encode rows of categorical feature values straight into a sparse matrix with one column for every feature=value
+    pair, without building a dictionary for every row like DictVectorizer does.
+
+    The rows are split into columns once, and every column is encoded with a single lookup table of its distinct
+    values. In the vocabulary mode (the default), the lookup tables are fitted on the training rows and the columns are
+    the sorted feature=value names, so the matrix is the same as DictVectorizer produces for the rows' dictionaries.
+    In the hashing mode (if n_features is given), nothing needs to be fitted and the feature=value names are hashed
+    into n_features columns, the same as FeatureHasher(n_features, alternate_sign=False) does.
+
+    Like the dictionaries of the rows, empty values and None are left out, and so are values not seen in training.
+    """
+
+    def __init__(self, feature_names: Sequence[str], n_features: Optional[int] = None):
+        self.feature_names = list(feature_names)
+        self.n_features = n_features
+        self.vocabularies = None  # a lookup table from values to columns for every feature, once fitted
+        self.feature_names_ = None  # the name of every column, once fitted
+
+    @property
+    def hashing(self) -> bool:
+        return self.n_features is not None
+
+    def get_columns(self, rows: Sequence[Sequence[str]]) -> List[Sequence[str]]:
+        """Split rows (whose first cells are the feature values) into a column of values for every feature."""
+        num_features = len(self.feature_names)
+        # like csv.DictReader's restval, missing cells at the end of short rows are empty values, also when every row
+        # is shorter than the features
+        columns = list(zip_longest(*rows, fillvalue=''))[:num_features]
+        columns.extend([''] * len(rows) for _ in range(num_features - len(columns)))
+        return columns
+
+    def fit(self, rows: Sequence[Sequence[str]]) -> 'FeatureEncoder':
+        """Find the distinct values of every feature in the rows and give every feature=value pair a column."""
+        return self.fit_batches([rows])
+
+    def fit_batches(self, batches: Iterable[Sequence[Sequence[str]]]) -> 'FeatureEncoder':
+        """Fit the encoder on batches of rows read one at a time, e.g. from a file that doesn't fit in memory."""
+        if self.hashing:
+            return self
+        distinct_values = [set() for _ in self.feature_names]
+        for rows in batches:
+            for values, column in zip(distinct_values, self.get_columns(rows)):
+                values.update(column)
+        distinct_values = [values - {'', None} for values in distinct_values]
+        self.feature_names_ = sorted(f'{name}={value}' for name, values in zip(self.feature_names, distinct_values)
+                                     for value in values)
+        index = {feature: i for i, feature in enumerate(self.feature_names_)}
+        self.vocabularies = [{value: index[f'{name}={value}'] for value in values}
+                             for name, values in zip(self.feature_names, distinct_values)]
+        return self
+
+    def get_lookup_table(self, i: int, column: Sequence[str]) -> Dict[str, int]:
+        """Return a table of the columns of the values of the i-th feature."""
+        if not self.hashing:
+            return self.vocabularies[i]
+        name = self.feature_names[i]
+        return {value: hash_feature(f'{name}={value}', self.n_features) for value in set(column) - {'', None}}
+
+    def transform(self, rows: Sequence[Sequence[str]]) -> csr_matrix:
+        """Encode rows into a sparse matrix with a row of ones in the columns of their feature=value pairs."""
+        if not self.hashing and self.vocabularies is None:
+            raise ValueError('The encoder needs to be fitted before rows can be transformed')
+        columns = self.get_columns(rows)
+        num_rows = len(rows)
+        indices = np.full((len(self.feature_names), num_rows), MISSING, dtype=np.int64)
+        for i, column in enumerate(columns):
+            indices[i] = list(map(self.get_lookup_table(i, column).get, column, repeat(MISSING)))
+        indices = indices.T  # the columns of the features of every row, one row after another
+        present = indices != MISSING
+        indptr = np.concatenate([[0], np.cumsum(present.sum(axis=1))])
+        matrix = csr_matrix((np.ones(indptr[-1]), indices[present], indptr),
+                            shape=(num_rows, self.n_features if self.hashing else len(self.feature_names_)))
+        matrix.sum_duplicates()  # sort the columns of every row and add up features hashed into the same column
+        return matrix
+
+    def fit_transform(self, rows: Sequence[Sequence[str]]) -> csr_matrix:
+        return self.fit(rows).transform(rows)
+
+    def get_params(self) -> Dict:
+        """Return the parameters of the encoder, e.g. to include them in the key of a cached model."""
+        return {'feature_names': self.feature_names, 'n_features': self.n_features}
@@ -1,25 +1,54 @@
-import csv
+import sys
+from itertools import chain
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence
+from arg_identification import PredicateInstances, iter_sentences_from_tsv, parse_sentences_from_tsv, \
+    parse_compact_sentences_from_tsv, is_tsv_sentence_boundary, is_compact_arg_ident_path
+from parallel import map_sentences, process_file_in_blocks, write_to_string
+from cache import StageCache, run_file_stage
+from fileio import open_file, write_rows
+from profiling import profiled
+
+FEATURE_NAMES = ['lemma', 'arg_pos', 'head_word', 'dep_rel', 'pred_lemma', 'pred_pos', 'position', 'voice']
 
 
 def read_sentences_from_tsv(path):
-    sentences = []
-    with open(path, encoding='utf-8') as infile:
-        csvreader = csv.reader(infile, delimiter='\t', quotechar='\\')
-        sentence = []  # prepare a container for the first sentence
-        for row in csvreader:
-            if row:  # if the line is not empty
-                sentence.append(row)  # append info for this token
-            else:  # empty lines indicate sentence boundaries
-                sentences.append(sentence)
-                sentence = []  # prepare a container for the next sentence
-    return sentences
-
-
-def extract_predicate_lemma(sentence):
-    # iterate through all the tokens in the sentence until you find the predicate, then return its lemma
+    return list(iter_sentences_from_tsv(path))
+
+
+class SentenceIndex(NamedTuple):
+    """Lookups built once per sentence, so features can be extracted for every argument without rescanning it."""
+    rows_by_id: Dict[str, List[str]]  # the row of every token, by token id
+    predicate: Optional[List[str]]  # the row of the predicate, None if there is no predicate
+    predicate_position: Optional[float]  # the token id of the predicate as a number
+
+
+def index_rows(sentence) -> Dict[str, List[str]]:
+    """Look up the row of every token of a sentence by its id."""
+    rows_by_id = {}
     for token in sentence:
-        if token[-1] == 'V':
-            return token[2].lower()
+        rows_by_id.setdefault(token[0], token)  # like a scan over the sentence, use the first token with this id
+    return rows_by_id
+
+
+def index_sentence(sentence, labels: Optional[Sequence[str]] = None,
+                   rows_by_id: Optional[Dict[str, List[str]]] = None):
+    """
+    Build the lookups used for feature extraction. The argument labels of the tokens are the last column of the
+    sentence, unless they are passed in, and the rows by id can be passed in if they are shared with other sentences.
+    """
+    if labels is None:
+        labels = [token[-1] for token in sentence]
+    if rows_by_id is None:
+        rows_by_id = index_rows(sentence)
+    predicate = next((token for token, label in zip(sentence, labels) if label == 'V'), None)
+    predicate_position = float(predicate[0]) if predicate is not None else None
+    return SentenceIndex(rows_by_id, predicate, predicate_position)
+
+
+def extract_predicate_lemma(sentence_index):
+    # return the lemma of the predicate of the sentence
+    if sentence_index.predicate is not None:
+        return sentence_index.predicate[2].lower()
     # if there are no predicates, returns None
 
 
@@ -31,84 +60,154 @@ def extract_POS(token):
     return token[3]
 
 
-def extract_head_word(token, sentence):
-    head_index = token[6]
-    for token in sentence:
-        if token[0] == head_index:
-            head_word = token[2].lower()
-            return head_word
+def extract_head_word(token, sentence_index):
+    head = sentence_index.rows_by_id.get(token[6])
+    if head is not None:
+        head_word = head[2].lower()
+        return head_word
 
 
 def extract_dependency_relation(token):
     return token[7]
 
 
-def extract_position_arg(token, sentence):
-    for tok in sentence:
-        if tok[-1] == "V":
-            predicate_id = tok[0]
-            break
-    if float(token[0]) < float(predicate_id):
+def extract_position_arg(token, sentence_index):
+    if float(token[0]) < sentence_index.predicate_position:
         position = "before"
     else:
         position = "after"
     return position
 
 
-def extract_predicate_POS(sentence):
-    for token in sentence:
-        if token[-1] == 'V':
-            return token[3]
+def extract_predicate_POS(sentence_index):
+    if sentence_index.predicate is not None:
+        return sentence_index.predicate[3]
 
 
-def extract_voice(sentence):
-    for token in sentence:
-        if token[-1] == 'V':
-            if 'Voice=Pass' in token[5]:
-                voice = 'passive'
-            else:
-                voice = 'active'
-            return voice
+def extract_voice(sentence_index):
+    if sentence_index.predicate is not None:
+        if 'Voice=Pass' in sentence_index.predicate[5]:
+            voice = 'passive'
+        else:
+            voice = 'active'
+        return voice
 
 
-def extract_features_and_labels(sentence):
-    """Extract a list of features for every predicate in a sentence as well as the gold label."""
+def extract_features_for_labels(sentence, gold_labels: Sequence[str], labels: Sequence[str], sentence_index):
+    """Extract a list of features for every token of a sentence labeled as an argument as well as its gold label."""
     output = []
     # extract features that depend on the whole sentence and are the same for all tokens
-    predicate_lemma = extract_predicate_lemma(sentence)  # extract lemma of the predicate as feature
-    predicate_POS = extract_predicate_POS(sentence)  # extract POS of the predicate as feature
-    voice = extract_voice(sentence)  # extract voice of the predicate as feature
-    for token in sentence:
+    predicate_lemma = extract_predicate_lemma(sentence_index)  # extract lemma of the predicate as feature
+    predicate_POS = extract_predicate_POS(sentence_index)  # extract POS of the predicate as feature
+    voice = extract_voice(sentence_index)  # extract voice of the predicate as feature
+    for token, gold_label, label in zip(sentence, gold_labels, labels):
         # check if token is an argument > we only extract features for arguments
-        if token[-1] not in ['V', '_']:
+        if label not in ['V', '_']:
             # extract features that only depend on this token
             lemma = extract_lemma(token)   # extract lemma as feature
-            head_word = extract_head_word(token, sentence)
+            head_word = extract_head_word(token, sentence_index)
             dep_rel = extract_dependency_relation(token)
             arg_POS = extract_POS(token)   # extract POS of arguments as feature
-            position = extract_position_arg(token, sentence)
-            label = token[-2]
+            position = extract_position_arg(token, sentence_index)
             output.append([lemma, arg_POS, head_word, dep_rel, predicate_lemma, predicate_POS, position, voice,
-                           label])
+                           gold_label])
+    return output
+
+
+def extract_features_and_labels(sentence):
+    """Extract a list of features for every predicate in a sentence as well as the gold label."""
+    labels = [token[-1] for token in sentence]
+    sentence_index = index_sentence(sentence, labels)  # look up tokens by id and find the predicate only once
+    return extract_features_for_labels(sentence, [token[-2] for token in sentence], labels, sentence_index)
+
+
+def extract_features_from_instances(instances: PredicateInstances):
+    """
+    Extract features for every per-predicate sentence of a sentence straight from the rows they share, which are
+    looked up by id only once. Return a list of features for every per-predicate sentence.
+    """
+    rows_by_id = index_rows(instances.rows)
+    output = []
+    for i in range(len(instances)):
+        labels = instances.get_column(i, -1)
+        output.append(extract_features_for_labels(instances.rows, instances.get_column(i, -2), labels,
+                                                  index_sentence(instances.rows, labels, rows_by_id)))
     return output
 
 
+def write_feature_extraction_results(sents, outfile, write_header=True):
+    """Write result of feature extraction to an open file"""
+    if write_header:
+        write_rows(outfile, [FEATURE_NAMES + ['label']])  # write header row with feature names
+    write_rows(outfile, chain.from_iterable(sents))
+
+
+@profiled()
 def write_results_feature_extraction_to_tsv(sents, path):
     """Write result of feature extraction to a file"""
-    with open(path, 'w', newline='') as outfile:
-        csvwriter = csv.writer(outfile, delimiter='\t', quotechar='\\', quoting=csv.QUOTE_MINIMAL)
-        csvwriter.writerow(['lemma', 'arg_pos', 'head_word', 'dep_rel', 'pred_lemma', 'pred_pos', 'position', 'voice',
-                            'label'])  # write header row with feature names
-        for sent in sents:
-            for token in sent:
-                csvwriter.writerow(token)
-
-
-def extract_features_and_return_output_path(path: str) -> str:
-    """From a file with predicates and arguments identified, extract selected features for every argument.
-    Write results to a file and return a path to it"""
-    sentences = read_sentences_from_tsv(path)
-    all_sent_output = [extract_features_and_labels(sentence) for sentence in sentences]
-    output_path = path.replace('.tsv', '-features.tsv')
-    write_results_feature_extraction_to_tsv(all_sent_output, output_path)
+    with open_file(path, 'w', newline='') as outfile:
+        write_feature_extraction_results(sents, outfile)
+
+
+def extract_features_in_lines(lines, outfile):
+    """Extract features from the per-predicate sentences in lines of a file with identified arguments and write them
+    to an open file, without the header row."""
+    write_feature_extraction_results(iter_extract_features(parse_sentences_from_tsv(lines)), outfile, False)
+
+
+def extract_features_in_compact_lines(lines, outfile):
+    """Extract features from the per-predicate sentences in lines of a file with identified arguments in the compact
+    format and write them to an open file, without the header row."""
+    write_feature_extraction_results(iter_extract_features_from_instances(parse_compact_sentences_from_tsv(lines)),
+                                     outfile, False)
+
+
+def iter_extract_features(sentences, workers=1):
+    """Extract selected features for every argument in per-predicate sentences and yield them one sentence at a
+    time. Sentences are processed on a pool of worker processes if more than one worker is requested."""
+    return map_sentences(extract_features_and_labels, sentences, workers)
+
+
+def iter_extract_features_from_instances(groups: Iterable[PredicateInstances], workers=1):
+    """Extract selected features for every argument in the per-predicate sentences of every sentence and yield them
+    one per-predicate sentence at a time. Sentences are processed on a pool of worker processes if requested."""
+    return chain.from_iterable(map_sentences(extract_features_from_instances, groups, workers))
+
+
+@profiled(counts=lambda output: {'instances': sum(map(len, output))})
+def extract_features_from_sentences(sentences, workers=1):
+    """Extract selected features for every argument in a list of per-predicate sentences and return them, grouped by
+    sentence."""
+    return list(iter_extract_features(sentences, workers))
+
+
+@profiled(counts=lambda output: {'instances': sum(map(len, output))})
+def extract_features_from_predicate_instances(groups: Iterable[PredicateInstances], workers=1):
+    """Extract selected features for every argument in the per-predicate sentences of a list of sentences and return
+    them, grouped by per-predicate sentence."""
+    return list(iter_extract_features_from_instances(groups, workers))
+
+
+def get_features_output_path(path: str) -> str:
+    """Return the path of the file the features extracted from the input file are written to."""
+    return path.replace('.tsv', '-features.tsv')
+
+
+@profiled()
+def extract_features_and_return_output_path(path: str, workers: int = 1,
+                                            stage_cache: Optional[StageCache] = None) -> str:
+    """From a file with predicates and arguments identified, in the expanded or compact format, extract selected
+    features for every argument. Write results to a file and return a path to it"""
+    output_path = get_features_output_path(path)
+    extract_features = extract_features_in_compact_lines if is_compact_arg_ident_path(path) else \
+        extract_features_in_lines
+
+    def extract_features_from_file():
+        # the file is read, processed and written in blocks of sentences, on a pool of worker processes if requested
+        process_file_in_blocks(extract_features, path, output_path, is_tsv_sentence_boundary, workers,
+                               header=write_to_string(write_feature_extraction_results, []))
+
+    # the output file is copied from the stage cache if the input file and code haven't changed
+    run_file_stage(stage_cache, 'feature_extraction', path, output_path, {}, [sys.modules[__name__]],
+                   extract_features_from_file)
     return output_path
@@ -0,0 +1,96 @@
+import bz2
+import csv
+import gzip
+import io
+import lzma
+from functools import partial
+from itertools import islice
+from typing import Iterable, List, Optional, Sequence, TextIO
+
+# extensions of compressed files -> functions opening them in binary mode; gzip's default level 9 is several times
+# slower than level 6 and makes files only slightly smaller
+COMPRESSIONS = {'.gz': partial(gzip.open, compresslevel=6), '.xz': lzma.open, '.bz2': bz2.open}
+BUFFER_SIZE = 1 << 20  # number of bytes buffered when reading and writing files
+ROWS_PER_BLOCK = 4096  # number of rows serialized and written at once
+
+
+def get_compression(path: str) -> str:
+    """Return the extension of a compressed file (one of COMPRESSIONS), or '' if the file isn't compressed."""
+    for extension in COMPRESSIONS:
+        if path.endswith(extension):
+            return extension
+    return ''
+
+
+def strip_compression(path: str) -> str:
+    """Return the path of a file without the extension of its compression, e.g. 'train.conllu' for 'train.conllu.gz'."""
+    compression = get_compression(path)
+    return path[:-len(compression)] if compression else path
+
+
+def open_file(path: str, mode: str = 'r', newline: Optional[str] = None) -> TextIO:
+    """
+    Open a UTF-8 text file for reading ('r') or writing ('w') with a large buffer. Files whose names end in .gz, .xz
+    or .bz2 are decompressed while they are read and compressed while they are written, so compressed files can be
+    used anywhere plain ones can.
+    """
+    compression = get_compression(path)
+    if not compression:
+        return open(path, mode, encoding='utf-8', newline=newline, buffering=BUFFER_SIZE)
+    binary = COMPRESSIONS[compression](path, mode + 'b')
+    buffered = io.BufferedReader(binary, BUFFER_SIZE) if mode == 'r' else io.BufferedWriter(binary, BUFFER_SIZE)
+    return io.TextIOWrapper(buffered, encoding='utf-8', newline=newline)
+
+
+def format_rows_with_csv(rows: Iterable[Sequence]) -> str:
+    output = io.StringIO(newline='')
+    csv.writer(output, delimiter='\t', quotechar='\\', quoting=csv.QUOTE_MINIMAL).writerows(rows)
+    return output.getvalue()
+
+
+def is_joined_plainly(text: str, num_newlines: int, num_tabs: int) -> bool:
+    """
+    Check whether cells joined with tabs and lines joined with newlines are the same as a csv writer writes them (but
+    with newlines instead of \\r\\n): no cell contains a quote character or a line break, which the text would contain
+    more newlines than expected for, or a tab, which it would contain more tabs than expected for.
+    """
+    return '\\' not in text and '\r' not in text and text.count('\n') == num_newlines and text.count('\t') == num_tabs
+
+
+def format_rows(rows: List[Sequence]) -> str:
+    """
+    Return the text a csv writer with the tab-separated format of the pipeline's files writes for rows. The rows are
+    joined in bulk, which is much faster, unless a cell isn't a string or needs quoting (it contains a tab, a quote
+    character or a line break, or it is the only cell of its row and empty); then the csv writer formats them.
+    """
+    try:
+        text = '\n'.join(map('\t'.join, rows))
+    except TypeError:  # a cell which isn't a string, e.g. None
+        return format_rows_with_csv(rows)
+    num_tabs = sum(map(len, rows)) - len(rows) + rows.count([]) + rows.count(())
+    if not is_joined_plainly(text, len(rows) - 1, num_tabs) or [''] in rows or ('',) in rows:
+        return format_rows_with_csv(rows)
+    return text.replace('\n', '\r\n') + '\r\n' if rows else ''
+
+
+def write_rows(outfile: TextIO, rows: Iterable[Sequence]) -> None:
+    """Write rows to an open file in the tab-separated format, a block of rows at a time."""
+    rows = iter(rows)
+    block = list(islice(rows, ROWS_PER_BLOCK))
+    while block:
+        outfile.write(format_rows(block))
+        block = list(islice(rows, ROWS_PER_BLOCK))
+
+
+def write_sentences(outfile: TextIO, sentences: Iterable[Sequence[Sequence]]) -> None:
+    """Write the rows of sentences to an open file in the tab-separated format, with an empty line after every
+    sentence, a block of sentences at a time."""
+    block = []
+    for sentence in sentences:
+        block.extend(sentence)
+        block.append([])  # keep an empty line between every sentence
+        if len(block) >= ROWS_PER_BLOCK:
+            outfile.write(format_rows(block))
+            block = []
+    if block:
+        outfile.write(format_rows(block))
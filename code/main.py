@@ -1,40 +1,525 @@
+import argparse
 import csv
+import os
+import pickle
 import sys
-from predicate_identification import identify_predicates_and_return_output_path
-from arg_identification import identify_arguments_and_return_output_path
-from feature_extraction import extract_features_and_return_output_path
-from classification import classify_arguments_and_return_predictions
-from evaluation import get_gold_and_pred, generate_confusion_matrix, calculate_precision_recall_f1_score
-from sklearn.metrics import classification_report
-from numpy import ndarray as ndarray
+from functools import partial
+from itertools import chain
+from typing import TYPE_CHECKING
+from parallel import process_file_in_blocks, write_to_string
+from predicate_identification import read_sentences_from_connlu, parse_sentences_from_connlu, \
+    is_connlu_sentence_boundary, iter_identify_predicates, identify_predicates_in_sentences, \
+    get_pred_ident_output_path, write_results_pred_ident_to_tsv, identify_predicates_and_return_output_path
+from arg_identification import COMPACT_SUFFIX, iter_identify_arguments, identify_arguments_in_sentences, \
+    iter_predicate_sentences, iter_label_rows, get_arg_ident_output_path, get_compact_arg_ident_output_path, \
+    write_results_arg_ident_to_tsv, write_compact_results_arg_ident_to_tsv, is_compact_arg_ident_path, \
+    iter_compact_sentences_from_tsv, identify_arguments_and_return_output_path
+from feature_extraction import FEATURE_NAMES, iter_extract_features_from_instances, \
+    extract_features_from_predicate_instances, get_features_output_path, write_feature_extraction_results, \
+    write_results_feature_extraction_to_tsv, extract_features_and_return_output_path
+from classification import MODEL_CACHE_DIR, BATCH_SIZE, classify_arguments, classify_arguments_incrementally, \
+    create_model_cache, write_predictions_to_features_file, load_or_create_classifier, train_classifier_incrementally, \
+    read_feature_names, read_feature_rows, iter_feature_row_batches, get_predictions
+from cache import STAGE_CACHE_DIR, create_stage_cache, hash_file, write_atomically
+from fileio import open_file, strip_compression, write_rows
+from scheduler import StageGraph
+from profiling import profiled, count_sentences, start_profiling, stop_profiling, write_profile_report
+import predicate_identification
+import arg_identification
+import feature_extraction
+import classification
 
+# numpy, scipy, scikit-learn and pandas take long to import, so the modules using them (corpus, rules,
+# feature_encoding and evaluation) are only imported by the stages which need them
+if TYPE_CHECKING:
+    from evaluation import ConfusionAccumulator
+    from numpy import ndarray
 
-def write_predictions_to_file(in_path: str, out_path: str, predictions: ndarray):
+# The experiments which are run and evaluated on the test set, in the order their evaluations are printed. Predicates
+# and arguments are identified by the rules ('rule') or taken from the gold labels ('gold'), and the classifier is
+# trained on the arguments in the training set identified the same way.
+EXPERIMENTS = [
+    {'title': "-----Evaluation on rule-based predicate identification------",
+     'task': 'predicate_identification', 'predicates': 'rule'},
+    {'title': "-----Evaluation on rule-based argument identification (predicates: rules)------",
+     'task': 'argument_identification', 'predicates': 'rule', 'arguments': 'rule'},
+    # of all gold arguments, how many did we classify correctly?
+    {'title': "-----Evaluation on argument classification (predicates: rules; arguments: rules)------",
+     'task': 'argument_classification', 'predicates': 'rule', 'arguments': 'rule'},
+    {'title': "-----Evaluation on rule-based argument identification (predicates: gold)------",
+     'task': 'argument_identification', 'predicates': 'gold', 'arguments': 'rule'},
+    # use all gold arguments to train the classifier, and test on all gold arguments from the test set
+    {'title': "-----Evaluation on argument classification (predicatse: gold; arguments: gold)------",
+     'task': 'argument_classification', 'predicates': 'gold', 'arguments': 'gold'},
+]
+
+PREDICTIONS_HEADER = ['ID', 'FORM', 'LEMMA', 'UPOSTAG', 'XPOSTAG', 'FEATS', 'HEAD', 'DEPREL',
+                      'DEPS', 'MISC', 'gold_PRED_label', 'identified_PRED_label',
+                      'gold_ARG_class_label', 'identified_ARG_label', 'predicted_ARG_class_label']
+
+
+def add_predictions_to_rows(rows, predictions: 'ndarray'):
+    """
+    Append a label obtained after argument classification to every row identified as an argument, and '_' to all
+    other rows. Empty rows are kept as they are.
+    """
+    i = 0
+    for row in rows:
+        if not row:  # empty line
+            yield []
+        elif row[-1] != 'ARG':
+            yield row + ['_']  # indicate this instance was not identified as an argument, thus we haven't classified it
+        else:
+            yield row + [predictions[i]]
+            i += 1
+
+
+@profiled()
+def write_predictions(rows, out_path: str, predictions: 'ndarray'):
+    """
+    Write rows of the results of argument identification to a new file, changing 'ARG' label to a label obtained after
+    argument classification.
+    """
+    with open_file(out_path, 'w', newline='') as outfile:
+        write_rows(outfile, chain([PREDICTIONS_HEADER], add_predictions_to_rows(rows, predictions)))
+
+
+def write_predictions_to_file(in_path: str, out_path: str, predictions: 'ndarray'):
     """
     Read in a file containing results of argument identification and write the contents to a new file, changing
     'ARG' label to a label obtained after argument classification.
     """
-    with open(in_path, encoding='utf-8') as infile:
-        reader = csv.reader(infile, delimiter='\t', quotechar='\\')
-        with open(out_path, 'w', newline='') as outfile:
-            writer = csv.writer(outfile, delimiter='\t', quotechar='\\', quoting=csv.QUOTE_MINIMAL)
-            # write header row
-            writer.writerow(['ID', 'FORM', 'LEMMA', 'UPOSTAG', 'XPOSTAG', 'FEATS', 'HEAD', 'DEPREL',
-                             'DEPS', 'MISC', 'gold_PRED_label', 'identified_PRED_label',
-                             'gold_ARG_class_label', 'identified_ARG_label', 'predicted_ARG_class_label'])
-            i = 0
-            for row in reader:
-                if not row:  # empty line
-                    writer.writerow([])
-                elif row[-1] != 'ARG':
-                    writer.writerow(row + ['_'])  # indicate this instance was not identified as an argument, thus we
-                    # haven't classified it
-                else:
-                    writer.writerow(row + [predictions[i]])
-                    i += 1
-
-
-def main():
+    with open_file(in_path) as infile:
+        write_predictions(csv.reader(infile, delimiter='\t', quotechar='\\'), out_path, predictions)
+
+
+def extract_features_from_connlu_lines(lines, outfile, pred_method: str, arg_method: str) -> None:
+    """
+    Pass the sentences in lines of a .conllu file through predicate identification, argument identification and
+    feature extraction one sentence at a time. Write the features to an open file, without the header row.
+    """
+    sents = parse_sentences_from_connlu(lines)
+    sents_with_preds = iter_identify_predicates(sents, pred_method)
+    sents_with_args = iter_identify_arguments(sents_with_preds, arg_method)
+    write_feature_extraction_results(iter_extract_features_from_instances(sents_with_args), outfile, False)
+
+
+def extract_features_from_connlu_and_return_output_path(path: str, pred_method: str, arg_method: str,
+                                                        workers: int = 1) -> str:
+    """
+    Read in sentences from a .conllu file and pass them through predicate identification, argument identification
+    and feature extraction one sentence at a time, so memory use doesn't grow with the size of the file. The file is
+    processed in blocks of sentences on a pool of worker processes if more than one worker is requested. Write the
+    features to the same file as the file-based pipeline and return the path to it.
+    """
+    output_path = get_features_output_path(get_arg_ident_output_path(get_pred_ident_output_path(path, pred_method),
+                                                                     arg_method))
+    process_file_in_blocks(partial(extract_features_from_connlu_lines, pred_method=pred_method, arg_method=arg_method),
+                           path, output_path, is_connlu_sentence_boundary, workers,
+                           header=write_to_string(write_feature_extraction_results, []))
+    return output_path
+
+
+def iter_rows(sentences):
+    """Yield the rows of all tokens in sentences."""
+    for sentence in sentences:
+        yield from sentence
+
+
+def get_rows(sentences):
+    """Return the rows of all tokens in sentences."""
+    return list(iter_rows(sentences))
+
+
+def iter_tsv_rows(sentences):
+    """Yield the rows of all tokens in sentences the way they are read back in from a tsv file, with an empty row after
+    every sentence."""
+    for sentence in sentences:
+        yield from sentence
+        yield []
+
+
+@profiled(counts=count_sentences)
+def read_sentences(path, options):
+    """
+    Read in all sentences from a .conllu file, as a list or, if requested, as a columnar corpus. A compiled corpus file
+    is opened as a columnar corpus, which can be used in place of a list of sentences.
+    """
+    from corpus import read_corpus_from_connlu, is_compiled_corpus, open_compiled_corpus
+    if is_compiled_corpus(path):
+        return open_compiled_corpus(path)
+    if options.columnar:
+        return read_corpus_from_connlu(path)
+    return read_sentences_from_connlu(path)
+
+
+def run_stage(options, stage, output_name, input_names, params, modules, compute):
+    """
+    Return the output of a stage of the pipeline from the stage cache, or compute it and store it in the cache, unless
+    no cache is used. Outputs are named by the path of the file the file-based pipeline would write them to.
+    """
+    if options.stage_cache is None:
+        return compute()
+    return options.stage_cache.run(stage, output_name, input_names, params, modules, compute)
+
+
+@profiled(counts=lambda output: count_sentences(output[0]))
+def run_predicate_identification(sentences, path, method, options):
+    """
+    Identify predicates in sentences read in from the file at path. If requested, write the results to the same file
+    as the file-based pipeline. Return the results and the path of that file.
+    """
+    output_path = get_pred_ident_output_path(path, method)
+    if options.columnar:  # the rules are evaluated for the whole corpus at once
+        import corpus
+        import rules
+        from rules import PREDICATE_RULES, identify_predicates_in_corpus
+        output = run_stage(options, 'predicate_identification', output_path, [path],
+                           {'method': method, 'columnar': True, 'rules': options.predicate_rules or PREDICATE_RULES},
+                           [predicate_identification, corpus, rules],
+                           lambda: identify_predicates_in_corpus(sentences, method, options.predicate_rules))
+    else:
+        output = run_stage(options, 'predicate_identification', output_path, [path], {'method': method},
+                           [predicate_identification],
+                           lambda: identify_predicates_in_sentences(sentences, method, options.workers))
+    if options.write_intermediate:
+        write_results_pred_ident_to_tsv(output_path, output)
+    return output, output_path
+
+
+@profiled(counts=lambda output: {'sentences': len(output[0]), 'instances': sum(map(len, output[0]))})
+def run_argument_identification(sentences, path, method, options):
+    """
+    Identify arguments for every predicate in the output of predicate identification written (or not) to the file at
+    path. If requested, write the results to the same file as the file-based pipeline, or to its compact version.
+    Return the per-predicate sentences of every sentence, which share the rows of the sentence, and the path of the
+    file in the expanded format.
+    """
+    output_path = get_arg_ident_output_path(path, method)
+    if options.columnar:  # the rules are evaluated for the whole corpus at once
+        import corpus
+        import rules
+        from rules import ARGUMENT_RULES, iter_predicate_sentence_groups
+        output = run_stage(options, 'argument_identification', output_path, [path],
+                           {'method': method, 'columnar': True, 'rules': options.argument_rules or ARGUMENT_RULES},
+                           [arg_identification, corpus, rules],
+                           lambda: list(iter_predicate_sentence_groups(sentences, method, options.argument_rules)))
+    else:
+        output = run_stage(options, 'argument_identification', output_path, [path], {'method': method},
+                           [arg_identification],
+                           lambda: identify_arguments_in_sentences(sentences, method, options.workers))
+    if options.write_intermediate and options.compact:
+        write_compact_results_arg_ident_to_tsv(output, get_compact_arg_ident_output_path(output_path))
+    elif options.write_intermediate:
+        write_results_arg_ident_to_tsv(output, output_path)
+    return output, output_path
+
+
+@profiled(counts=lambda output: {'instances': len(output[0])})
+def run_feature_extraction(sentences, path, options):
+    """
+    Extract features for every argument in the per-predicate sentences of every sentence. If requested, write the
+    results to the same file as the file-based pipeline. Return the rows of features and the path of that file.
+    """
+    output_path = get_features_output_path(path)
+    output = run_stage(options, 'feature_extraction', output_path, [path], {}, [feature_extraction],
+                       lambda: extract_features_from_predicate_instances(sentences, options.workers))
+    if options.write_intermediate:
+        write_results_feature_extraction_to_tsv(output, output_path)
+    return get_rows(output), output_path
+
+
+@profiled()
+def run_argument_classification(train_features, test_features, test_sentences, train_features_path,
+                                test_features_path, test_args_path, options):
+    """
+    Train the classifier on training set features and classify test set arguments. If requested, write the
+    predictions to the same files as the file-based pipeline. Return the predictions.
+    """
+    import feature_encoding
+    if options.incremental:
+        params = {'hash_features': options.hash_features, 'incremental': True, 'epochs': options.epochs,
+                  'batch_size': options.batch_size}
+        compute = partial(classify_arguments_incrementally, train_features, test_features, FEATURE_NAMES,
+                          options.hash_features, options.epochs, options.batch_size)
+    else:
+        params = {'hash_features': options.hash_features}
+        compute = partial(classify_arguments, train_features, test_features, FEATURE_NAMES, options.model_cache,
+                          options.hash_features)
+    predictions = run_stage(options, 'argument_classification', test_features_path.replace('.tsv', '-predictions.tsv'),
+                            [train_features_path, test_features_path], params, [classification, feature_encoding],
+                            compute)
+    if options.write_intermediate:
+        write_predictions_to_features_file(predictions, test_features_path,
+                                           test_features_path.replace('.tsv', '-predictions.tsv'))
+        write_predictions(iter_tsv_rows(iter_predicate_sentences(test_sentences)),
+                          test_args_path.replace('.tsv', '-predictions.tsv'), predictions)
+    return predictions
+
+
+def identify_arguments_stage(predicates, method, options):
+    """Identify arguments in the output of the stage identifying predicates, and return them with their path."""
+    return run_argument_identification(*predicates, method, options)
+
+
+def extract_features_stage(arguments, options):
+    """Extract features from the output of the stage identifying arguments, and return them with their path."""
+    return run_feature_extraction(*arguments, options)
+
+
+def classify_arguments_stage(train_features, test_features, test_arguments, options):
+    """Train the classifier on the output of a stage extracting features and classify the arguments of another one."""
+    (train_rows, train_features_path), (test_rows, test_features_path) = train_features, test_features
+    test_sentences, test_args_path = test_arguments
+    return run_argument_classification(train_rows, test_rows, test_sentences, train_features_path, test_features_path,
+                                       test_args_path, options)
+
+
+@profiled()
+def evaluate_identification(identified, task, options) -> 'ConfusionAccumulator':
+    """Evaluate the output of the stage identifying predicates or arguments."""
+    from evaluation import ConfusionAccumulator
+    sentences = identified[0]
+    if task == 'predicate_identification':
+        return ConfusionAccumulator.from_rows(iter_rows(sentences), task)
+    return ConfusionAccumulator.from_rows(iter_label_rows(sentences), task)
+
+
+@profiled()
+def evaluate_classification(arguments, predictions, options) -> 'ConfusionAccumulator':
+    """Evaluate the predictions of the classifier for the arguments identified by a stage."""
+    from evaluation import ConfusionAccumulator
+    # only the gold, identified and predicted labels are needed for the evaluation
+    return ConfusionAccumulator.from_rows(add_predictions_to_rows(iter_label_rows(arguments[0]), predictions),
+                                          'argument_classification')
+
+
+def add_experiment(graph: StageGraph, experiment, options) -> str:
+    """
+    Add the stages of an experiment to the graph, sharing the stages it has in common with the experiments added
+    before, and return the name of the stage evaluating it.
+    """
+    task, pred_method, arg_method = experiment['task'], experiment['predicates'], experiment.get('arguments')
+
+    def add_identification(split, path):
+        sentences = graph.add(f'{split}/sentences', read_sentences, args=[path])
+        predicates = graph.add(f'{split}/predicates-{pred_method}', run_predicate_identification, [sentences],
+                               [path, pred_method])
+        if arg_method is None:
+            return predicates
+        return graph.add(f'{split}/arguments-{pred_method}-{arg_method}', identify_arguments_stage, [predicates],
+                         [arg_method])
+
+    test_identified = add_identification('test', options.test_path)
+    name = f'evaluation/{task}-{pred_method}' + (f'-{arg_method}' if arg_method else '')
+    if task != 'argument_classification':
+        return graph.add(name, evaluate_identification, [test_identified], [task])
+    train_features = graph.add(f'train/features-{pred_method}-{arg_method}', extract_features_stage,
+                               [add_identification('train', options.train_path)])
+    test_features = graph.add(f'test/features-{pred_method}-{arg_method}', extract_features_stage, [test_identified])
+    predictions = graph.add(f'classification-{pred_method}-{arg_method}', classify_arguments_stage,
+                            [train_features, test_features, test_identified])
+    return graph.add(name, evaluate_classification, [test_identified, predictions])
+
+
+def merge_options(options, worker_options):
+    """Merge what a stage run on a worker process added to its copy of the stage cache into the stage cache."""
+    if options.stage_cache is not None:
+        options.stage_cache.merge(worker_options.stage_cache)
+
+
+@profiled()
+def print_identification_evaluation(title, accumulator: 'ConfusionAccumulator', metric):
+    """Print the evaluation of predicate or argument identification."""
+    print(title)
+    print(accumulator.get_report_table(metric=metric))
+    print(accumulator.format_report(digits=3))  # of all gold instances, how many did we identify
+    print(accumulator.get_confusion_matrix_table())
+
+
+def print_evaluation(experiment, accumulator: 'ConfusionAccumulator'):
+    """Print the evaluation of an experiment."""
+    if experiment['task'] == 'predicate_identification':
+        print_identification_evaluation(experiment['title'], accumulator, 'PRED')
+    elif experiment['task'] == 'argument_identification':
+        print_identification_evaluation(experiment['title'], accumulator, 'ARG')
+    else:
+        print(experiment['title'])
+        print(accumulator.format_report(digits=3))
+        # print(accumulator.get_report_table())
+
+
+COMMANDS = ['identify-predicates', 'identify-arguments', 'featurize', 'train', 'predict', 'evaluate']
+
+
+def get_predictions_output_path(path: str) -> str:
+    """Return the path of the file the predictions of the classifier for the arguments in a file of argument
+    identification (in the expanded or compact format) are written to, as the pipeline names it."""
+    if is_compact_arg_ident_path(path):
+        path = path.replace(COMPACT_SUFFIX, '.tsv')
+    return path.replace('.tsv', '-predictions.tsv')
+
+
+def identify_predicates_command(options):
+    for path in options.paths:
+        print(identify_predicates_and_return_output_path(path, options.method, options.workers, options.stage_cache))
+
+
+def identify_arguments_command(options):
+    for path in options.paths:
+        print(identify_arguments_and_return_output_path(path, options.method, options.workers, options.stage_cache,
+                                                        options.compact))
+
+
+def featurize_command(options):
+    """Extract features from files of argument identification, or straight from .conllu files."""
+    for path in options.paths:
+        if strip_compression(path).endswith('.tsv'):
+            print(extract_features_and_return_output_path(path, options.workers, options.stage_cache))
+        else:
+            print(extract_features_from_connlu_and_return_output_path(path, options.predicates, options.arguments,
+                                                                      options.workers))
+
+
+def train_command(options):
+    """Train the classifier on a file of features and save it with its encoder."""
+    if options.incremental:
+        classifier, encoder = train_classifier_incrementally(
+            lambda: iter_feature_row_batches(options.path, options.batch_size), read_feature_names(options.path),
+            options.hash_features, options.epochs)
+    else:
+        classifier, encoder = load_or_create_classifier(
+            hash_file(options.path) if options.model_cache is not None else None,
+            lambda: read_feature_rows(options.path)[1], read_feature_names(options.path), options.model_cache,
+            options.hash_features)
+    write_atomically(options.model,
+                     lambda outfile: pickle.dump((classifier, encoder), outfile, protocol=pickle.HIGHEST_PROTOCOL))
+    print(options.model)
+
+
+def predict_command(options):
+    """Classify the arguments in files of argument identification with a saved classifier, writing the predictions
+    to the same files as the pipeline."""
+    with open(options.model, 'rb') as infile:
+        classifier, encoder = pickle.load(infile)
+    for path in options.paths:
+        features_path = extract_features_and_return_output_path(path, options.workers, options.stage_cache)
+        predictions = get_predictions(features_path, encoder, classifier)
+        write_predictions_to_features_file(predictions, features_path,
+                                           features_path.replace('.tsv', '-predictions.tsv'))
+        output_path = get_predictions_output_path(path)
+        if is_compact_arg_ident_path(path):
+            write_predictions(iter_tsv_rows(iter_predicate_sentences(iter_compact_sentences_from_tsv(path))),
+                              output_path, predictions)
+        else:
+            write_predictions_to_file(path, output_path, predictions)
+        print(output_path)
+
+
+def evaluate_command(options):
+    """Evaluate the output of a task in files, telling the task from the name of every file unless it is given."""
+    from evaluation import evaluate_file, get_task_of_path
+    for path in options.paths:
+        task = options.task or get_task_of_path(path)
+        accumulator = evaluate_file(path, task)
+        if task == 'predicate_identification':
+            print_identification_evaluation(path, accumulator, 'PRED')
+        elif task == 'argument_identification':
+            print_identification_evaluation(path, accumulator, 'ARG')
+        else:
+            print(path)
+            print(accumulator.format_report(digits=3))
+
+
+def create_command_parser():
+    """Create the parser of the commands running a single stage of the pipeline on any number of files."""
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes every file is processed on in blocks of sentences')
+    common.add_argument('--no-stage-cache', action='store_true',
+                        help='always run the stage instead of copying its output from the stage cache')
+    common.add_argument('--stage-cache-dir', default=STAGE_CACHE_DIR, help='directory of the stage cache')
+    common.add_argument('--stage-cache-size', type=int, default=2048,
+                        help='size of the stage cache in MB, above which the least recently used outputs are removed')
+    common.add_argument('--profile', metavar='PATH',
+                        help='write a .json report of the time, CPU time, number of items processed and peak memory '
+                             'of every stage to PATH')
+    parser = argparse.ArgumentParser(
+        prog='main.py', description='Run a single stage of the pipeline on any number of files, writing the output of '
+                                    'every file next to it. Only the libraries the stage needs are imported.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('identify-predicates', parents=[common], help='identify predicates in .conllu files')
+    command.add_argument('paths', nargs='+', help='paths to .conllu files')
+    command.add_argument('--method', choices=['rule', 'gold'], default='rule')
+    command.set_defaults(func=identify_predicates_command)
+
+    command = commands.add_parser('identify-arguments', parents=[common],
+                                  help='identify arguments in the output of identify-predicates')
+    command.add_argument('paths', nargs='+', help='paths to files of predicate identification')
+    command.add_argument('--method', choices=['rule', 'span', 'gold'], default='rule')
+    command.add_argument('--compact', action='store_true', help='write the output in the compact format')
+    command.set_defaults(func=identify_arguments_command)
+
+    command = commands.add_parser('featurize', parents=[common],
+                                  help='extract features from the output of identify-arguments, or from .conllu files')
+    command.add_argument('paths', nargs='+', help='paths to files of argument identification (.tsv) or .conllu files')
+    command.add_argument('--predicates', choices=['rule', 'gold'], default='rule',
+                         help='method identifying the predicates in .conllu files')
+    command.add_argument('--arguments', choices=['rule', 'span', 'gold'], default='rule',
+                         help='method identifying the arguments in .conllu files')
+    command.set_defaults(func=featurize_command)
+
+    command = commands.add_parser('train', parents=[common], help='train the classifier on the output of featurize')
+    command.add_argument('path', help='path to the file of training set features')
+    command.add_argument('--model', required=True, help='path to the .pkl file the classifier is saved to')
+    command.add_argument('--hash-features', type=int, metavar='N',
+                         help='hash the features into N columns instead of fitting a vocabulary')
+    command.add_argument('--incremental', action='store_true',
+                         help='train a linear SVM with stochastic gradient descent on minibatches of features')
+    command.add_argument('--epochs', type=int, default=1, help='number of passes over the training set with '
+                                                               '--incremental')
+    command.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                         help='number of rows of features in every minibatch with --incremental')
+    command.add_argument('--no-model-cache', action='store_true',
+                         help='always train the classifier instead of loading it from the model cache')
+    command.add_argument('--model-cache-dir', default=MODEL_CACHE_DIR, help='directory of the model cache')
+    command.set_defaults(func=train_command)
+
+    command = commands.add_parser('predict', parents=[common],
+                                  help='classify the arguments in the output of identify-arguments')
+    command.add_argument('paths', nargs='+', help='paths to files of argument identification')
+    command.add_argument('--model', required=True, help='path to a .pkl file saved by train')
+    command.set_defaults(func=predict_command)
+
+    command = commands.add_parser('evaluate', parents=[common], help='evaluate the output of a stage')
+    command.add_argument('paths', nargs='+', help='paths to files of predicate identification, argument '
+                                                  'identification or predict')
+    command.add_argument('--task', choices=['predicate_identification', 'argument_identification',
+                                            'argument_classification'],
+                         help='task the files are the output of (by default, told from their names)')
+    command.set_defaults(func=evaluate_command)
+    return parser
+
+
+def run_command(argv):
+    """Run a single stage of the pipeline on any number of files, so the start-up cost is only paid once."""
+    options = create_command_parser().parse_args(argv)
+    options.stage_cache = None if options.no_stage_cache else create_stage_cache(options.stage_cache_dir,
+                                                                                 options.stage_cache_size)
+    if options.command == 'train':
+        options.model_cache = None if options.no_model_cache else create_model_cache(options.model_cache_dir)
+    if options.profile:
+        start_profiling()
+    try:
+        options.func(options)
+    finally:
+        if options.profile:
+            write_profile_report(stop_profiling(), options.profile)
+            print(f'Profile written to {options.profile}', file=sys.stderr)
+
+
+def main(argv=None):
     """
     Accept paths to training and testing datasets from the command line and run and evaluate all the steps of
     the experiment.
@@ -49,75 +534,105 @@ def main():
     5. Evaluate the performance of argument classification after training the classifier on all gold arguments from the
     training set and using it to predict labels for all gold arguments from the test set.
 
+    The experiments are declared in EXPERIMENTS. The output of every step is passed to the next one in memory, and
+    steps shared by several experiments are only run once. The intermediate files are only written if
+    --write-intermediate is passed.
+
+    If the first argument is one of COMMANDS, only that stage of the pipeline is run, on any number of files (see
+    create_command_parser).
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in COMMANDS and not os.path.exists(argv[0]):
+        return run_command(argv)
+    parser = argparse.ArgumentParser(description='Run and evaluate all the steps of the experiment. Run with one of '
+                                                 f'{", ".join(COMMANDS)} as the first argument to only run that stage '
+                                                 'on any number of files.')
+    parser.add_argument('train_path', help='path to the .conllu file (or compiled corpus file) used for training the '
+                                           'classifier')
+    parser.add_argument('test_path', help='path to the .conllu file (or compiled corpus file) used for testing')
+    parser.add_argument('--write-intermediate', action='store_true',
+                        help='write the output of every step to a file, for debugging')
+    parser.add_argument('--compact', action='store_true',
+                        help='with --write-intermediate, write the output of argument identification in the compact '
+                             'format, with the rows of every sentence once instead of once for every predicate')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes used for predicate identification, argument identification '
+                             'and feature extraction')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of worker processes running independent stages of the experiments at once '
+                             '(stages run on worker processes are left out of the --profile report)')
+    parser.add_argument('--columnar', action='store_true',
+                        help='keep sentences in memory in a compact columnar representation and evaluate the rules '
+                             'for all sentences at once')
+    parser.add_argument('--rules', help='path to a .json file with the rules for predicate and argument '
+                                        'identification (see rules.py); implies --columnar')
+    parser.add_argument('--hash-features', type=int, metavar='N',
+                        help='encode the features of the classifier by hashing them into N columns instead of giving '
+                             'every value seen in training its own column')
+    parser.add_argument('--incremental', action='store_true',
+                        help='train a linear SVM with stochastic gradient descent on minibatches of features instead '
+                             'of LinearSVC on all of them at once')
+    parser.add_argument('--epochs', type=int, default=1, help='number of passes over the training set with '
+                                                              '--incremental')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='number of rows of features in every minibatch with --incremental')
+    parser.add_argument('--no-model-cache', action='store_true',
+                        help='always train the classifier instead of loading it from the model cache')
+    parser.add_argument('--model-cache-dir', default=MODEL_CACHE_DIR, help='directory of the model cache')
+    parser.add_argument('--model-cache-size', type=int, default=2048,
+                        help='size of the model cache in MB, above which the least recently used models are removed')
+    parser.add_argument('--clear-model-cache', action='store_true',
+                        help='remove all models from the model cache before running the experiment')
+    parser.add_argument('--no-stage-cache', action='store_true',
+                        help='always run every stage instead of loading its output from the stage cache')
+    parser.add_argument('--stage-cache-dir', default=STAGE_CACHE_DIR, help='directory of the stage cache')
+    parser.add_argument('--stage-cache-size', type=int, default=2048,
+                        help='size of the stage cache in MB, above which the least recently used outputs are removed')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='write a .json report of the time, CPU time, number of items processed and peak memory of '
+                             'every stage to PATH')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='with --profile, trace the memory allocated by every stage and the lines allocating the '
+                             'most of it (much slower)')
+    parser.add_argument('--profile-cprofile', action='store_true',
+                        help='with --profile, also report the functions taking the most time with cProfile')
+    options = parser.parse_args(argv)
+    options.stage_cache = None if options.no_stage_cache else create_stage_cache(options.stage_cache_dir,
+                                                                                 options.stage_cache_size)
+    options.model_cache = None if options.no_model_cache else create_model_cache(options.model_cache_dir,
+                                                                                 options.model_cache_size)
+    if options.clear_model_cache:
+        create_model_cache(options.model_cache_dir).clear()
+    if options.rules:
+        from rules import load_rules
+        options.predicate_rules, options.argument_rules = load_rules(options.rules)
+    else:
+        options.predicate_rules, options.argument_rules = None, None
+    options.columnar = options.columnar or options.rules is not None
+    if options.profile:
+        start_profiling(options.profile_memory, options.profile_cprofile)
+    try:
+        run_experiments(options)
+    finally:
+        if options.profile:
+            write_profile_report(stop_profiling(), options.profile)
+            print(f'Profile written to {options.profile}', file=sys.stderr)
+
+
+def run_experiments(options, experiments=EXPERIMENTS):
+    """
+    Run and evaluate the experiments on the training and test datasets given in the options. The stages of all
+    experiments are run as a graph, in which the stages experiments have in common are only run once, and independent
+    stages are run at once on --jobs worker processes. The evaluations are printed in the order of the experiments.
     """
-    train_path, test_path = sys.argv[1:]
-
-    # identify predicates on the test set - rule-based approach
-    test_preds_path = identify_predicates_and_return_output_path(test_path, 'rule')
-    # evaluate the performance
-    y_true, y_pred = get_gold_and_pred(test_preds_path, 'predicate_identification')
-    report = classification_report(y_true, y_pred, digits=3, output_dict=True)["PRED"]
-    report = classification_report(y_true, y_pred, digits=3)
-    print("-----Evaluation on rule-based predicate identification------")
-    print(calculate_precision_recall_f1_score(y_true, y_pred, metric='PRED'))
-    print(report)  # of all gold predicates, how many did we identify as predicates
-    print(generate_confusion_matrix(y_true, y_pred))
-
-    # identify arguments for the predicates identified in the previous step - rule-based approach
-    test_args_path = identify_arguments_and_return_output_path(test_preds_path, 'rule')
-    # evaluate the performance
-    y_true, y_pred = get_gold_and_pred(test_args_path, 'argument_identification')
-    report = classification_report(y_true, y_pred, digits=3, output_dict=True)["ARG"]
-    report = classification_report(y_true, y_pred, digits=3)
-    print("-----Evaluation on rule-based argument identification (predicates: rules)------")
-    print(calculate_precision_recall_f1_score(y_true, y_pred, metric='ARG'))
-    print(report)  # of all gold arguments, how many did we identify as arguments
-    print(generate_confusion_matrix(y_true, y_pred))
-
-    # identify predicates and arguments in the training dataset - rule-based approach
-    train_preds_path = identify_predicates_and_return_output_path(train_path, 'rule')
-    train_args_path = identify_arguments_and_return_output_path(train_preds_path, 'rule')
-
-    # extract features for only those arguments the rule-based approach identified
-    train_features_path = extract_features_and_return_output_path(train_args_path)
-    test_features_path = extract_features_and_return_output_path(test_args_path)
-
-    # and use them to train the classifier and obtain predictions on the test set
-    predictions = classify_arguments_and_return_predictions(train_features_path, test_features_path)
-    write_predictions_to_file(test_args_path, test_args_path.replace('.tsv', '-predictions.tsv'), predictions)
-
-    # evaluate classifier: of all gold arguments, how many did we classify correctly?
-    y_true, y_pred = get_gold_and_pred(test_args_path.replace('.tsv', '-predictions.tsv'), 'argument_classification')
-    print("-----Evaluation on argument classification (predicates: rules; arguments: rules)------")
-    print(classification_report(y_true, y_pred, digits=3, zero_division=0))
-    # print(calculate_precision_recall_f1_score(y_true, y_pred))
-
-    # evaluate rule-based argument identification after gold predicate identification
-    test_preds_path = identify_predicates_and_return_output_path(test_path, 'gold')
-    test_args_path = identify_arguments_and_return_output_path(test_preds_path, 'rule')
-    y_true, y_pred = get_gold_and_pred(test_args_path, 'argument_identification')
-    report = classification_report(y_true, y_pred, digits=3, output_dict=True)["ARG"]
-    report = classification_report(y_true, y_pred, digits=3)
-    print("-----Evaluation on rule-based argument identification (predicates: gold)------")
-    print(calculate_precision_recall_f1_score(y_true, y_pred, metric='ARG'))
-    print(report)  # of all gold arguments, how many did we identify as arguments
-    print(generate_confusion_matrix(y_true, y_pred))
-
-    # evaluate classification after gold predicate and argument identification
-    # use all arguments to train the classifier, and test on all arguments from the training set
-    train_preds_path = identify_predicates_and_return_output_path(train_path, 'gold')
-    train_args_path = identify_arguments_and_return_output_path(train_preds_path, 'gold')
-    train_features_path = extract_features_and_return_output_path(train_args_path)
-
-    test_args_path = identify_arguments_and_return_output_path(test_preds_path, 'gold')
-    test_features_path = extract_features_and_return_output_path(test_args_path)
-
-    predictions = classify_arguments_and_return_predictions(train_features_path, test_features_path)
-    write_predictions_to_file(test_args_path, test_args_path.replace('.tsv', '-predictions.tsv'), predictions)
-
-    y_true, y_pred = get_gold_and_pred(test_args_path.replace('.tsv', '-predictions.tsv'), 'argument_classification')
-    print("-----Evaluation on argument classification (predicatse: gold; arguments: gold)------")
-    print(classification_report(y_true, y_pred, digits=3, zero_division=0))
+    graph = StageGraph()
+    targets = [add_experiment(graph, experiment, options) for experiment in experiments]
+    for experiment, (_, evaluation) in zip(experiments, graph.run(targets, options.jobs, options, merge_options)):
+        print_evaluation(experiment, evaluation)
+
+    if options.stage_cache is not None:
+        print(f'Stage cache: {len(options.stage_cache.hits)} outputs loaded, {len(options.stage_cache.misses)} '
+              f'computed', file=sys.stderr)
 
 
 if __name__ == '__main__':
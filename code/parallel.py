@@ -0,0 +1,133 @@
+from collections import deque
+from functools import partial
+from io import StringIO
+from multiprocessing import Pool
+from typing import Callable, Iterable, Iterator, List, Sequence, TextIO, Tuple
+from fileio import open_file
+
+CHUNKSIZE = 128  # number of sentences sent to a worker process at once
+SENTENCES_PER_BLOCK = 2048  # number of sentences in every block of lines read from a file
+PENDING_PER_WORKER = 2  # number of chunks or blocks waiting to be processed for every worker
+
+
+def imap_bounded(pool: Pool, func: Callable, items: Iterable, max_pending: int) -> Iterator:
+    """
+    Apply a function to every item on a pool of worker processes and yield the results in the order of the items.
+    Unlike Pool.imap, the items are only taken from the iterable when a place frees up, so no more than max_pending
+    items and results are kept in memory at any time.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def apply_to_chunk(func: Callable, chunk: List) -> List:
+    """Apply a function to every item in a chunk and return the results."""
+    return [func(item) for item in chunk]
+
+
+def apply_to_range(func: Callable, sentences_and_range: Tuple[Sequence, int, int]) -> List:
+    """Apply a function to the sentences with indices in a range and return the results."""
+    sentences, start, end = sentences_and_range
+    return [func(sentences[i]) for i in range(start, end)]
+
+
+def iter_ranges(sentences: Sequence, chunksize: int) -> Iterator[Tuple[Sequence, int, int]]:
+    """Split the indices of sentences into ranges of chunksize sentences."""
+    for start in range(0, len(sentences), chunksize):
+        yield sentences, start, min(start + chunksize, len(sentences))
+
+
+def iter_chunks(items: Iterable, chunksize: int) -> Iterator[List]:
+    """Split items into lists of chunksize items."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def map_sentences(func: Callable, sentences: Iterable, workers: int = 1, chunksize: int = CHUNKSIZE) -> Iterator:
+    """
+    Apply a function to every sentence and yield the results in the order of the input sentences.
+
+    If more than one worker is requested, the sentences are sent to a pool of worker processes a chunk at a time. The
+    function needs to be picklable, i.e. defined at the top level of a module (functools.partial can be used to fix
+    its other arguments).
+
+    Sentences in a corpus mapped from a compiled file (see corpus.open_compiled_corpus) aren't sent at all: the
+    workers map the same file and are only sent ranges of sentence indices.
+    """
+    if workers <= 1:
+        yield from map(func, sentences)
+        return
+    if getattr(sentences, 'mapped_path', None) is not None:
+        chunks, apply = iter_ranges(sentences, chunksize), apply_to_range
+    else:
+        chunks, apply = iter_chunks(sentences, chunksize), apply_to_chunk
+    with Pool(workers) as pool:
+        for results in imap_bounded(pool, partial(apply, func), chunks, workers * PENDING_PER_WORKER):
+            yield from results
+
+
+def iter_sentence_blocks(path: str, is_boundary: Callable[[str], bool],
+                         sentences_per_block: int = SENTENCES_PER_BLOCK) -> Iterator[str]:
+    """
+    Read in a file in blocks of lines containing sentences_per_block sentences each. Blocks are only split after a
+    line for which is_boundary returns True, so every block can be parsed on its own.
+    """
+    with open_file(path) as infile:
+        lines = []
+        num_sentences = 0
+        for line in infile:
+            lines.append(line)
+            if is_boundary(line):
+                num_sentences += 1
+                if num_sentences == sentences_per_block:
+                    yield ''.join(lines)
+                    lines = []
+                    num_sentences = 0
+        if lines:
+            yield ''.join(lines)
+
+
+def process_file_in_blocks(func: Callable[[Iterable[str], TextIO], None], path: str, output_path: str,
+                           is_boundary: Callable[[str], bool], workers: int = 1, header: str = '') -> None:
+    """
+    Apply a function which reads sentences from lines of text and writes its results to a file object to the input
+    file, writing the results to the output file.
+
+    If more than one worker is requested, the input file is read in blocks of sentences which are processed on a pool
+    of worker processes, and the results are written in the order of the blocks. Only the raw text of a block is sent
+    to a worker and only the text of its output is sent back, which keeps the cost of communication between processes
+    low compared to sending parsed sentences. The function needs to be picklable.
+    """
+    with open_file(output_path, 'w', newline='') as outfile:
+        outfile.write(header)
+        if workers <= 1:
+            with open_file(path) as infile:
+                func(infile, outfile)
+        else:
+            blocks = iter_sentence_blocks(path, is_boundary)
+            with Pool(workers) as pool:
+                for output in imap_bounded(pool, partial(process_block, func), blocks, workers * PENDING_PER_WORKER):
+                    outfile.write(output)
+
+
+def process_block(func: Callable[[Iterable[str], TextIO], None], block: str) -> str:
+    """Apply a function to the lines of a block of text and return the text it writes."""
+    return write_to_string(func, StringIO(block))
+
+
+def write_to_string(write_func: Callable, *args) -> str:
+    """Call a function that writes to a file object with a file object in memory, and return what was written."""
+    output = StringIO(newline='')
+    write_func(*args, output)
+    return output.getvalue()
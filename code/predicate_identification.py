@@ -1,33 +1,52 @@
-from typing import List
-import csv
+from typing import Iterable, Iterator, List, Optional
+from functools import partial
+from parallel import map_sentences, process_file_in_blocks
+from cache import StageCache, run_file_stage
+from fileio import open_file, strip_compression, get_compression, write_sentences
+from profiling import profiled, count_sentences
 import os
+import sys
 
 
+def parse_sentences_from_connlu(lines: Iterable[str]) -> Iterator[List[List[str]]]:
+    """Parse sentences from the lines of a connlu file one at a time"""
+    sentence = []
+    for line in lines:
+        if line.startswith('#'):
+            continue
+        else:
+            row = line.split()
+            if not sentence:
+                length = len(row)  # memorize the length of the first token
+            if not row:  # if the row is empty, indicating sentence boundary
+                yield sentence
+                sentence = []
+            elif len(row) > 11:  # sentence has 1 or more predicates
+                sentence.append(row)
+            else:  # sentence doesn't have predicates
+                while len(row) < 12:
+                    row.append('_')
+                while len(row) < length:  # there are some weird sentences starting with indexes containing .
+                    # this accounts for them
+                    row.append('_')
+                sentence.append(row)
+
+
+def is_connlu_sentence_boundary(line: str) -> bool:
+    """Check whether a line of a connlu file is the empty line ending a sentence"""
+    return line.isspace()
+
+
+def iter_sentences_from_connlu(path) -> Iterator[List[List[str]]]:
+    """Read in sentences from a connlu file one at a time"""
+    with open_file(path) as infile:
+        yield from parse_sentences_from_connlu(infile)
+
+
+@profiled(counts=count_sentences)
 def read_sentences_from_connlu(path):
     """Read in all sentences from a connlu file"""
-    sentences = []
-    with open(path, encoding='utf-8') as infile:
-        sentence = []
-        for line in infile:
-            if line.startswith('#'):
-                continue
-            else:
-                row = line.split()
-                if not sentence:
-                    length = len(row)  # memorize the length of the first token
-                if not row:  # if the row is empty, indicating sentence boundary
-                    sentences.append(sentence)
-                    sentence = []
-                elif len(row) > 11:  # sentence has 1 or more predicates
-                    sentence.append(row)
-                else:  # sentence doesn't have predicates
-                    while len(row) < 12:
-                        row.append('_')
-                    while len(row) < length:  # there are some weird sentences starting with indexes containing .
-                        # this accounts for them
-                        row.append('_')
-                    sentence.append(row)
-    return sentences
+    return list(iter_sentences_from_connlu(path))
 
 
 def identify_predicates(sent: List[List], method: str) -> List[List]:
@@ -37,7 +56,7 @@ def identify_predicates(sent: List[List], method: str) -> List[List]:
     """
     sent_with_pred = []
     for row in sent:
-        row.insert(11, "_")
+        row = row[:11] + ["_"] + row[11:]  # copy the row, so the same sentences can be processed with both methods
         if (row[10] != "") and (row[10] != "_"):
             row[10] = "PRED"
         if method == "gold":
@@ -54,22 +73,55 @@ def identify_predicates(sent: List[List], method: str) -> List[List]:
     return sent_with_pred
 
 
+def write_pred_ident_results(all_sent_output: Iterable, csvfile) -> None:
+    """Write results of predicate identification to an open file"""
+    write_sentences(csvfile, all_sent_output)
+
+
+@profiled()
 def write_results_pred_ident_to_tsv(output_path: str, all_sent_output: List) -> None:
     """Write results of predicate identification to a file"""
-    with open(output_path, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile, delimiter='\t',
-                            quotechar='\\', quoting=csv.QUOTE_MINIMAL)
-        for sent in all_sent_output:
-            for row in sent:
-                writer.writerow(row)
-            writer.writerow([])  # keep an empty line between every sentence
+    with open_file(output_path, 'w', newline='') as csvfile:
+        write_pred_ident_results(all_sent_output, csvfile)
+
 
+def identify_predicates_in_lines(lines: Iterable[str], outfile, method: str) -> None:
+    """Identify predicates in the sentences in lines of a connlu file and write the results to an open file."""
+    write_pred_ident_results(iter_identify_predicates(parse_sentences_from_connlu(lines), method), outfile)
 
-def identify_predicates_and_return_output_path(path: str, method: str) -> str:
+
+def iter_identify_predicates(sents: Iterable[List], method: str, workers: int = 1) -> Iterator[List]:
+    """For each sentence, identify predicates using a rule-based approach or gold labels and yield the results one
+    sentence at a time. Sentences are processed on a pool of worker processes if more than one worker is requested."""
+    return map_sentences(partial(identify_predicates, method=method), sents, workers)
+
+
+@profiled(counts=count_sentences)
+def identify_predicates_in_sentences(sents: Iterable[List], method: str, workers: int = 1) -> List[List]:
+    """For each sentence, identify predicates using a rule-based approach or gold labels and return the results."""
+    return list(iter_identify_predicates(sents, method, workers))
+
+
+def get_pred_ident_output_path(path: str, method: str) -> str:
+    """Return the path of the file the results of predicate identification on the input file are written to. It is
+    compressed the same way as the input file."""
+    base_path = strip_compression(path)
+    return base_path.replace(os.path.splitext(base_path)[1], f'-pred_iden-{method}.tsv') + get_compression(path)
+
+
+@profiled()
+def identify_predicates_and_return_output_path(path: str, method: str, workers: int = 1,
+                                               stage_cache: Optional[StageCache] = None) -> str:
     """Read in all sentences from the file and for each sentence, identify predicates using a rule-based approach or
     gold labels. Write the predictions to a file and return the file path."""
-    sents = read_sentences_from_connlu(path)
-    all_sent_output = [identify_predicates(sent, method) for sent in sents]
-    output_path = path.replace(os.path.splitext(path)[1], f'-pred_iden-{method}.tsv')
-    write_results_pred_ident_to_tsv(output_path, all_sent_output)
+    output_path = get_pred_ident_output_path(path, method)
+
+    def identify_predicates_in_file():
+        # the file is read, processed and written in blocks of sentences, on a pool of worker processes if requested
+        process_file_in_blocks(partial(identify_predicates_in_lines, method=method), path, output_path,
+                               is_connlu_sentence_boundary, workers)
+
+    # the output file is copied from the stage cache if the input file, method and code haven't changed
+    run_file_stage(stage_cache, 'predicate_identification', path, output_path, {'method': method},
+                   [sys.modules[__name__]], identify_predicates_in_file)
     return output_path
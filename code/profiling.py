@@ -0,0 +1,217 @@
+import cProfile
+import functools
+import json
+import pstats
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+_profiler = None  # the active Profiler, or None if profiling is off
+TOP_ALLOCATIONS = 10  # number of lines allocating the most memory reported for every stage with memory tracing
+TOP_FUNCTIONS = 30  # number of functions with the most cumulative time reported with cProfile
+
+
+def get_max_rss_mb() -> Optional[float]:
+    """Return the peak resident memory of the process so far in MB, if it can be measured."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 1024 ** 2 if sys.platform == 'darwin' else max_rss / 1024  # bytes on macOS, KB elsewhere
+
+
+def count_sentences(sentences) -> Dict[str, int]:
+    """Count the sentences and tokens in a list of sentences or a columnar corpus."""
+    if hasattr(sentences, 'num_tokens'):
+        return {'sentences': len(sentences), 'tokens': sentences.num_tokens}
+    return {'sentences': len(sentences), 'tokens': sum(map(len, sentences))}
+
+
+class StageFrame:
+    """The measurements of a stage which is running."""
+
+    def __init__(self, path: str, snapshot: Optional[tracemalloc.Snapshot], overhead: List[float]):
+        self.path = path
+        self.max_rss = get_max_rss_mb() if snapshot is None else None
+        self.peak = 0
+        self.start_memory = tracemalloc.get_traced_memory()[0] if snapshot is not None else 0
+        self.snapshot = snapshot
+        self.overhead = list(overhead)  # the time spent on snapshots of the memory so far, which isn't counted
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+
+
+class Profiler:
+    """
+    Record the wall time, CPU time, counts of items processed and peak memory of every call to a stage. Stages called
+    from other stages are recorded under the path of the stages they are called from, e.g. 'run_classification/fit'.
+
+    By default, the peak resident memory of the process is recorded after every stage (process_max_rss_mb, which is
+    the peak of the whole process so far, not of the stage), with how much the stage raised it (rss_growth_mb, summed
+    over its calls). If memory is traced (which slows everything down), the peak memory allocated by Python during the
+    stage is recorded instead, and the lines allocating the most memory too. If cProfile is used, the functions taking
+    the most time in the whole run are reported.
+    """
+
+    def __init__(self, trace_memory: bool = False, use_cprofile: bool = False):
+        self.trace_memory = trace_memory
+        self.records = {}  # path of a stage -> its measurements, summed over all its calls
+        self.stack = []
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.cprofile = cProfile.Profile() if use_cprofile else None
+        self.overhead = [0.0, 0.0]  # wall and CPU time spent on taking and comparing snapshots of the memory
+
+    def start(self) -> None:
+        if self.trace_memory:
+            tracemalloc.start()
+        if self.cprofile is not None:
+            self.cprofile.enable()
+
+    def stop(self) -> None:
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        if self.trace_memory:
+            tracemalloc.stop()
+
+    def enter(self, stage: str) -> StageFrame:
+        path = f'{self.stack[-1].path}/{stage}' if self.stack else stage
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            if self.stack:  # the peak so far belongs to the stage this one is called from
+                self.stack[-1].peak = max(self.stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+        snapshot = None
+        if self.trace_memory:
+            with self.untimed():
+                snapshot = tracemalloc.take_snapshot()
+        frame = StageFrame(path, snapshot, self.overhead)
+        self.stack.append(frame)
+        return frame
+
+    @contextmanager
+    def untimed(self):
+        """Keep track of the time a block of work on snapshots of the memory takes, so it isn't counted for the stage
+        or any of the stages it is called from."""
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.overhead[0] += time.perf_counter() - wall
+            self.overhead[1] += time.process_time() - cpu
+
+    def exit(self, frame: StageFrame) -> Dict:
+        self.stack.pop()
+        record = self.records.setdefault(frame.path, {'stage': frame.path, 'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+                                                      'counts': {}})
+        record['calls'] += 1
+        record['wall_s'] += time.perf_counter() - frame.wall - (self.overhead[0] - frame.overhead[0])
+        record['cpu_s'] += time.process_time() - frame.cpu - (self.overhead[1] - frame.overhead[1])
+        if self.trace_memory:
+            frame.peak = max(frame.peak, tracemalloc.get_traced_memory()[1])
+            if self.stack:
+                self.stack[-1].peak = max(self.stack[-1].peak, frame.peak)
+            peak_mb = (frame.peak - frame.start_memory) / 1024 ** 2
+            if peak_mb >= record.get('peak_memory_mb', 0):
+                record['peak_memory_mb'] = peak_mb
+                with self.untimed():
+                    statistics = tracemalloc.take_snapshot().compare_to(frame.snapshot, 'lineno')[:TOP_ALLOCATIONS]
+                    record['top_allocations'] = [{'line': str(stat.traceback), 'size_mb': stat.size_diff / 1024 ** 2,
+                                                  'count': stat.count_diff} for stat in statistics]
+        else:
+            max_rss = get_max_rss_mb()
+            record['process_max_rss_mb'] = max_rss
+            if max_rss is not None:
+                record['rss_growth_mb'] = record.get('rss_growth_mb', 0.0) + max_rss - frame.max_rss
+        return record
+
+    def call(self, stage: str, counts: Optional[Callable], func: Callable, args, kwargs):
+        frame = self.enter(stage)
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            record = self.exit(frame)
+        if counts is not None:
+            add_counts(record, counts(result))
+        return result
+
+    def report(self) -> Dict:
+        """Return the measurements of all stages, with the throughput of every count, and of the whole run."""
+        stages = []
+        for record in self.records.values():
+            record = dict(record)
+            record['per_second'] = {name: count / record['wall_s'] for name, count in record['counts'].items()
+                                    if record['wall_s'] > 0}
+            stages.append(record)
+        report = {'command': sys.argv, 'wall_s': time.perf_counter() - self.wall,
+                  'cpu_s': time.process_time() - self.cpu, 'process_max_rss_mb': get_max_rss_mb(), 'stages': stages}
+        if self.cprofile is not None:
+            stats = pstats.Stats(self.cprofile)
+            functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP_FUNCTIONS]
+            report['cprofile'] = [{'function': f'{filename}:{line}({name})', 'calls': calls, 'tottime_s': tottime,
+                                   'cumtime_s': cumtime}
+                                  for (filename, line, name), (_, calls, tottime, cumtime, _) in functions]
+        return report
+
+
+def add_counts(record: Dict, counts: Dict[str, int]) -> None:
+    for name, count in counts.items():
+        record['counts'][name] = record['counts'].get(name, 0) + count
+
+
+def profiled(stage: Optional[str] = None, counts: Optional[Callable] = None) -> Callable:
+    """
+    Decorate a stage function so that its calls are recorded while profiling is on. counts is called with the result
+    of the function and returns the number of items (e.g. sentences and tokens) processed. When profiling is off, the
+    only overhead is checking whether it is on.
+    """
+    def decorator(func):
+        name = stage or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            return _profiler.call(name, counts, func, args, kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def profile_stage(stage: str, **counts: int):
+    """Record a block of code inside a stage function as a stage of its own, while profiling is on."""
+    if _profiler is None:
+        yield
+        return
+    frame = _profiler.enter(stage)
+    try:
+        yield
+    finally:
+        add_counts(_profiler.exit(frame), counts)
+
+
+def start_profiling(trace_memory: bool = False, use_cprofile: bool = False) -> Profiler:
+    """Turn profiling on in this process."""
+    global _profiler
+    _profiler = Profiler(trace_memory, use_cprofile)
+    _profiler.start()
+    return _profiler
+
+
+def stop_profiling() -> Dict:
+    """Turn profiling off and return the report."""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    profiler.stop()
+    return profiler.report()
+
+
+def write_profile_report(report: Dict, path: str) -> None:
+    with open(path, 'w') as outfile:
+        json.dump(report, outfile, indent=2)
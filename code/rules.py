@@ -0,0 +1,152 @@
+import json
+from collections import defaultdict
+from itertools import chain
+from typing import Dict, Iterator, List, Optional, Tuple
+import numpy as np
+from corpus import ColumnarCorpus
+from arg_identification import PredicateInstances, predict_arguments_for_sentences
+from profiling import profiled, count_sentences
+
+# A rule set is a list of rules, and a token matches the rule set if it matches any of its rules. A rule maps names of
+# columns (see corpus.FIXED_COLUMNS) to conditions on the values in those columns, and a token matches the rule if all
+# of the conditions hold. A condition is a dictionary with one or more of the following keys, all of which have to
+# hold: 'in' or 'not_in' (a list of values), 'contains', 'startswith' or 'endswith' (a string), and 'any' or 'all' (a
+# list of conditions, one or all of which have to hold).
+
+# the rules of predicate_identification.identify_predicates
+PREDICATE_RULES = [
+    {'UPOS': {'in': ['VERB']}, 'DEPREL': {'not_in': ['amod', 'case', 'mark']}},
+    {'UPOS': {'in': ['AUX']}, 'FEATS': {'not_in': ['VerbForm=Fin']}},
+    {'XPOS': {'in': ['JJ', 'JJR']}, 'DEPREL': {'any': [{'contains': 'cl'}, {'endswith': 'comp'}]}},
+]
+
+# the rules of arg_identification.identify_arguments: the dependents of a predicate matching them are its arguments
+ARGUMENT_RULES = [
+    {'DEPREL': {'not_in': ['det', 'punct', 'mark', 'parataxis']}},
+]
+
+OPERATORS = {
+    'in': lambda string, values: string in values,
+    'not_in': lambda string, values: string not in values,
+    'contains': lambda string, value: value in string,
+    'startswith': lambda string, value: string.startswith(value),
+    'endswith': lambda string, value: string.endswith(value),
+    'any': lambda string, conditions: any(matches(condition, string) for condition in conditions),
+    'all': lambda string, conditions: all(matches(condition, string) for condition in conditions),
+}
+
+
+def matches(condition: Dict, string: str) -> bool:
+    """Check whether a string satisfies a condition."""
+    for operator, value in condition.items():
+        if operator not in OPERATORS:
+            raise ValueError(f'Unknown operator in rule condition: {operator}')
+        if operator in ('in', 'not_in'):
+            value = set(value)
+        if not OPERATORS[operator](string, value):
+            return False
+    return True
+
+
+def compile_condition(condition: Dict, strings: List[str]) -> np.ndarray:
+    """
+    Evaluate a condition once for every string in a vocabulary. The result can be indexed with the codes of a column
+    to evaluate the condition for every token at once. Missing values (code -1) pick the False appended at the end.
+    """
+    return np.array([matches(condition, string) for string in strings] + [False], dtype=bool)
+
+
+def evaluate_rules(corpus: ColumnarCorpus, rules: List[Dict]) -> np.ndarray:
+    """Return a mask of the tokens in a corpus which match a rule set."""
+    strings = corpus.vocabulary.strings
+    mask = np.zeros(corpus.num_tokens, dtype=bool)
+    for rule in rules:
+        rule_mask = np.ones(corpus.num_tokens, dtype=bool)
+        for column, condition in rule.items():
+            rule_mask &= compile_condition(condition, strings)[corpus.column(column)]
+        mask |= rule_mask
+    return mask
+
+
+@profiled(counts=count_sentences)
+def identify_predicates_in_corpus(corpus: ColumnarCorpus, method: str,
+                                  rules: Optional[List[Dict]] = None) -> ColumnarCorpus:
+    """
+    Identify predicates in all sentences of a corpus at once, using a rule set or gold labels, and return a corpus
+    with the same rows as predicate_identification.identify_predicates produces.
+    """
+    rules = PREDICATE_RULES if rules is None else rules
+    vocabulary = corpus.vocabulary
+    pred_code, empty_code = vocabulary.encode('PRED'), vocabulary.encode('_')  # before compiling any conditions
+    gold_codes = corpus.column('PRED')
+    is_gold = compile_condition({'not_in': ['', '_']}, vocabulary.strings)[gold_codes]
+    if method == 'gold':
+        identified = is_gold
+    elif method == 'rule':
+        identified = evaluate_rules(corpus, rules)
+    else:
+        identified = np.zeros(corpus.num_tokens, dtype=bool)
+    corpus = corpus.with_column('PRED', np.where(is_gold, pred_code, gold_codes).astype(np.int32))
+    return corpus.with_label_column(np.where(identified, pred_code, empty_code).astype(np.int32))
+
+
+def find_argument_heads(corpus: ColumnarCorpus, rules: Optional[List[Dict]] = None) -> np.ndarray:
+    """
+    For every token in a corpus with identified predicates, find the id of the identified predicate it is an argument
+    of, i.e. whose dependent it is, if it matches the rule set. Return 0 for tokens which aren't arguments.
+    """
+    rules = ARGUMENT_RULES if rules is None else rules
+    pred_code = corpus.vocabulary.codes.get('PRED')
+    identified = corpus.label_column(0) == pred_code  # the column added by predicate identification
+    heads = corpus.integer_column('HEAD')
+    sentence_ids = corpus.sentence_ids()
+    starts = corpus.sentence_offsets[sentence_ids]
+    lengths = np.diff(corpus.sentence_offsets)[sentence_ids]
+    # like arg_identification.identify_arguments, a predicate's id is its position in the sentence
+    candidates = evaluate_rules(corpus, rules) & (heads >= 1) & (heads <= lengths)
+    head_positions = np.where(candidates, starts + heads - 1, 0)
+    is_argument = candidates & identified[head_positions]
+    return np.where(is_argument, heads, 0)
+
+
+def iter_predicate_sentence_groups(corpus: ColumnarCorpus, method: str,
+                                   rules: Optional[List[Dict]] = None) -> Iterator[PredicateInstances]:
+    """
+    Identify arguments for each predicate in a corpus with identified predicates using a rule set or gold labels. The
+    rules are evaluated for all sentences at once. Yield the same per-predicate sentences as
+    arg_identification.predict_arguments_for_sentences produces, sharing the rows of every sentence of the corpus.
+    """
+    heads = find_argument_heads(corpus, rules)
+    argument_tokens = np.flatnonzero(heads)
+    arguments_by_sentence = defaultdict(dict)
+    for sentence_id, token, head in zip(corpus.sentence_ids()[argument_tokens].tolist(), argument_tokens.tolist(),
+                                        heads[argument_tokens].tolist()):
+        arguments_by_sentence[sentence_id].setdefault(head, []).append(token)
+
+    for i, sentence in enumerate(corpus):
+        start = corpus.sentence_offsets[i]
+        # like arg_identification.identify_arguments, use the ids in the first column of the arguments' rows
+        arguments = {head: [int(sentence[token - start][0]) for token in tokens]
+                     for head, tokens in arguments_by_sentence.get(i, {}).items()}
+        yield predict_arguments_for_sentences(sentence, 10, 11, method, arguments)
+
+
+@profiled(counts=count_sentences)
+def identify_arguments_in_corpus(corpus: ColumnarCorpus, method: str,
+                                 rules: Optional[List[Dict]] = None) -> ColumnarCorpus:
+    """
+    Identify arguments for each predicate in a corpus with identified predicates using a rule set or gold labels.
+    Return a corpus of the same per-predicate sentences as arg_identification.predict_arguments_for_sentences produces.
+    """
+    return ColumnarCorpus.from_sentences(chain.from_iterable(iter_predicate_sentence_groups(corpus, method, rules)),
+                                         corpus.vocabulary)
+
+
+def load_rules(path: str) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Load rule sets from a .json file with a 'predicates' and/or an 'arguments' key. Return the predicate and argument
+    rule sets, using the default rules for a missing key.
+    """
+    with open(path, encoding='utf-8') as infile:
+        rules = json.load(infile)
+    return rules.get('predicates', PREDICATE_RULES), rules.get('arguments', ARGUMENT_RULES)
@@ -0,0 +1,158 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+
+class Stage(NamedTuple):
+    func: Callable
+    inputs: Tuple[str, ...]  # names of the stages whose outputs are passed to func, in this order
+    args: Tuple  # further arguments passed to func after the outputs of the inputs
+
+
+def run_stage(func: Callable, inputs: List, args: Tuple, context: Any) -> Any:
+    """Call the function of a stage with the outputs of its inputs, its arguments and the context, if there is one."""
+    if context is None:
+        return func(*inputs, *args)
+    return func(*inputs, *args, context)
+
+
+def run_stage_in_worker(func: Callable, inputs: List, args: Tuple, context: Any) -> Tuple[Any, Any]:
+    """Run a stage on a worker process and return its output with the worker's copy of the context."""
+    return run_stage(func, inputs, args, context), context
+
+
+class StageGraph:
+    """
+    A graph of named stages, each computed by a function from the outputs of the stages it depends on. A stage is only
+    added once, however many experiments use it, so stages shared by several experiments are computed once.
+
+    The stages needed for a list of targets are run in an order that respects their dependencies, on a pool of worker
+    processes if more than one job is requested: every stage is started as soon as its inputs are ready, those on the
+    longest chain of stages still to run first, so the total time is close to the time of the longest chain. Outputs
+    are dropped as soon as no stage or target needs them anymore.
+
+    A context (e.g. the options of the experiment) can be passed as the last argument to every stage. A stage run on a
+    worker process gets a copy of it, which is sent back with its output and merged into the context with
+    merge_context, e.g. to keep track of what the stages added to a cache.
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, Stage] = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.stages
+
+    def add(self, name: str, func: Callable, inputs: Sequence[str] = (), args: Sequence = ()) -> str:
+        """
+        Add a stage, unless the same stage has been added already, and return its name. The stages it depends on need
+        to have been added before.
+        """
+        stage = Stage(func, tuple(inputs), tuple(args))
+        if name in self.stages:
+            if self.stages[name] != stage:
+                raise ValueError(f'Stage {name} has already been added with another function, inputs or arguments')
+            return name
+        missing = [input_name for input_name in stage.inputs if input_name not in self.stages]
+        if missing:
+            raise ValueError(f'Stage {name} depends on stages which haven\'t been added: {", ".join(missing)}')
+        self.stages[name] = stage
+        return name
+
+    def get_order(self, targets: Sequence[str]) -> List[str]:
+        """Return the stages needed for the targets, each one after the stages it depends on."""
+        order, seen = [], set()
+
+        def visit(name):
+            if name in seen:
+                return
+            seen.add(name)
+            for input_name in self.stages[name].inputs:
+                visit(input_name)
+            order.append(name)
+
+        for target in targets:
+            visit(target)
+        return order
+
+    def get_heights(self, order: List[str]) -> Dict[str, int]:
+        """Return the number of stages on the longest chain from every stage to a stage nothing depends on."""
+        heights = {name: 1 for name in order}
+        for name in reversed(order):  # every stage comes after its inputs, so its height is known before theirs
+            for input_name in self.stages[name].inputs:
+                heights[input_name] = max(heights[input_name], heights[name] + 1)
+        return heights
+
+    def run(self, targets: Sequence[str], jobs: int = 1, context: Any = None,
+            merge_context: Optional[Callable[[Any, Any], None]] = None) -> Iterator[Tuple[str, Any]]:
+        """
+        Run the stages needed for the targets, on jobs worker processes if there is more than one. Yield the name and
+        output of every target, in the order of the targets, as soon as it and all targets before it are ready.
+        """
+        order = self.get_order(targets)
+        uses = {name: 0 for name in order}  # number of stages and targets still needing the output of a stage
+        for name in order:
+            for input_name in self.stages[name].inputs:
+                uses[input_name] += 1
+        for target in targets:
+            uses[target] += 1
+        outputs = {}
+
+        def add_output(name, output):
+            outputs[name] = output
+            for input_name in self.stages[name].inputs:
+                release(input_name)
+
+        def release(name):
+            uses[name] -= 1
+            if uses[name] == 0:
+                del outputs[name]
+
+        def iter_ready_targets():
+            nonlocal next_target
+            while next_target < len(targets) and targets[next_target] in outputs:
+                target = targets[next_target]
+                next_target += 1
+                output = outputs[target]
+                release(target)
+                yield target, output
+
+        next_target = 0
+        if jobs <= 1:
+            for name in order:
+                stage = self.stages[name]
+                add_output(name, run_stage(stage.func, [outputs[input_name] for input_name in stage.inputs],
+                                           stage.args, context))
+                yield from iter_ready_targets()
+            return
+
+        heights = self.get_heights(order)
+        waiting = {name: set(self.stages[name].inputs) for name in order}
+        dependents = {name: [] for name in order}
+        for name in order:
+            for input_name in set(self.stages[name].inputs):
+                dependents[input_name].append(name)
+        ready = [name for name in order if not waiting[name]]
+        running = {}
+        pool = ProcessPoolExecutor(jobs)
+        try:
+            while ready or running:
+                ready.sort(key=lambda name: heights[name])  # start the stages on the longest chains first
+                while ready and len(running) < jobs:
+                    name = ready.pop()
+                    stage = self.stages[name]
+                    future = pool.submit(run_stage_in_worker, stage.func,
+                                         [outputs[input_name] for input_name in stage.inputs], stage.args, context)
+                    running[future] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    output, worker_context = future.result()
+                    if merge_context is not None:
+                        merge_context(context, worker_context)
+                    add_output(name, output)
+                    for dependent in dependents[name]:
+                        waiting[dependent].discard(name)
+                        if not waiting[dependent]:
+                            ready.append(dependent)
+                yield from iter_ready_targets()
+        finally:
+            pool.shutdown(cancel_futures=True)
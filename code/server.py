@@ -0,0 +1,375 @@
+import argparse
+import json
+import os
+import queue
+import signal
+import socketserver
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO
+import numpy as np
+from predicate_identification import parse_sentences_from_connlu, is_connlu_sentence_boundary
+from feature_extraction import FEATURE_NAMES, extract_features_from_instances, extract_features_from_predicate_instances
+from corpus import ColumnarCorpus, read_corpus_from_connlu, is_compiled_corpus, open_compiled_corpus
+from rules import PREDICATE_RULES, ARGUMENT_RULES, identify_predicates_in_corpus, iter_predicate_sentence_groups, \
+    load_rules
+from classification import MODEL_CACHE_DIR, create_model_cache, hash_feature_rows, load_or_create_classifier
+
+MAX_BATCH_SIZE = 64  # largest number of sentences labeled at once
+MAX_WAIT = 0.005  # seconds the first request of a batch waits for more requests to arrive
+PENDING_BATCHES = 2  # number of batches of requests of a stream read ahead of the responses written
+STATS_INTERVAL = 60  # seconds between reports of the statistics of the server
+LATENCY_WINDOW = 10000  # number of most recent requests the latency percentiles are computed over
+
+
+class Labeler:
+    """
+    The rules and the trained classifier, loaded once. Labels batches of sentences by passing them through predicate
+    identification, argument identification, feature extraction and argument classification together.
+    """
+
+    def __init__(self, classifier, encoder, predicate_rules: Optional[List[Dict]] = None,
+                 argument_rules: Optional[List[Dict]] = None):
+        self.classifier = classifier
+        self.encoder = encoder
+        self.predicate_rules = predicate_rules or PREDICATE_RULES
+        self.argument_rules = argument_rules or ARGUMENT_RULES
+
+    @classmethod
+    def train(cls, train_path: str, predicate_rules: Optional[List[Dict]] = None,
+              argument_rules: Optional[List[Dict]] = None, model_cache=None,
+              n_hashed_features: Optional[int] = None) -> 'Labeler':
+        """
+        Train the classifier on the arguments identified by the rules in a .conllu (or compiled corpus) file, like
+        main.py does, or load it from the model cache if it has been trained on the same features before.
+        """
+        corpus = open_compiled_corpus(train_path) if is_compiled_corpus(train_path) else \
+            read_corpus_from_connlu(train_path)
+        predicates = identify_predicates_in_corpus(corpus, 'rule', predicate_rules)
+        arguments = iter_predicate_sentence_groups(predicates, 'rule', argument_rules)
+        rows = [row for sentence in extract_features_from_predicate_instances(arguments) for row in sentence]
+        classifier, encoder = load_or_create_classifier(
+            hash_feature_rows(rows, FEATURE_NAMES) if model_cache is not None else None, lambda: rows,
+            FEATURE_NAMES, model_cache, n_hashed_features)
+        return cls(classifier, encoder, predicate_rules, argument_rules)
+
+    def label_sentences(self, sentences: List[List[List[str]]]) -> List[List[List[str]]]:
+        """
+        Label a batch of sentences. Return every sentence with its 10 CoNLL-U columns, a column marking the identified
+        predicates with PRED, and a column for every identified predicate, with V for the predicate, the predicted
+        role of each of its arguments and _ for all other tokens.
+        """
+        if not sentences:
+            return []
+        predicates = identify_predicates_in_corpus(ColumnarCorpus.from_sentences(sentences), 'rule',
+                                                   self.predicate_rules)
+        groups = list(iter_predicate_sentence_groups(predicates, 'rule', self.argument_rules))
+        rows = [row for group in groups for features in extract_features_from_instances(group) for row in features]
+        # the features of all arguments in the batch are classified at once
+        predictions = iter(self.classifier.predict(self.encoder.transform(rows)) if rows else [])
+        labeled = []
+        for sentence, group in zip(predicates, groups):
+            columns = []
+            for i in range(len(group)):
+                labels = group.get_column(i, -1)
+                if 'V' not in labels:  # a gold predicate which wasn't identified, or no predicates at all
+                    continue
+                # features were extracted for the arguments in the order of the tokens
+                columns.append([next(predictions) if label == 'ARG' else label for label in labels])
+            labeled.append([token[:10] + [token[11]] + [column[i] for column in columns]
+                            for i, token in enumerate(sentence)])
+        return labeled
+
+
+class ServerStats:
+    """Count the requests, sentences and batches handled by the server and keep track of the latency of requests."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.sentences = 0
+        self.batches = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)  # seconds from receiving a request to its response being ready
+
+    def add_batch(self, num_sentences: int) -> None:
+        with self.lock:
+            self.batches += 1
+            self.sentences += num_sentences
+
+    def add_request(self, latency: float) -> None:
+        with self.lock:
+            self.requests += 1
+            self.latencies.append(latency)
+
+    def report(self) -> Dict:
+        """Return the statistics: totals, throughput since the start and latency percentiles in milliseconds."""
+        with self.lock:
+            elapsed = time.perf_counter() - self.start
+            latencies = np.array(self.latencies) * 1000
+            report = {'requests': self.requests, 'sentences': self.sentences, 'batches': self.batches,
+                      'uptime_s': round(elapsed, 3),
+                      'sentences_per_s': round(self.sentences / elapsed, 1) if elapsed else 0.0,
+                      'mean_batch_size': round(self.sentences / self.batches, 2) if self.batches else 0.0}
+        if len(latencies):
+            report.update({f'latency_{name}_ms': round(float(value), 3) for name, value in
+                           zip(['p50', 'p90', 'p99', 'max'], np.percentile(latencies, [50, 90, 99, 100]))})
+        return report
+
+
+class MicroBatcher:
+    """
+    Collect requests submitted concurrently (from several connections, or one after another from one stream) into
+    batches, which are labeled together by a single thread. A batch is started by the first waiting request and
+    closed when it holds max_batch_size sentences or max_wait seconds have passed, so under low load a request only
+    waits max_wait seconds, and under high load the cost of a call to the classifier is shared by many sentences.
+    """
+
+    def __init__(self, labeler: Labeler, stats: ServerStats, max_batch_size: int = MAX_BATCH_SIZE,
+                 max_wait: float = MAX_WAIT):
+        self.labeler = labeler
+        self.stats = stats
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, block: str) -> Future:
+        """Submit the lines of a sentence in CoNLL-U format. Return a future for its labeled lines."""
+        future = Future()
+        self.requests.put((block, future, time.perf_counter()))
+        return future
+
+    def next_batch(self) -> List:
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self) -> None:
+        while True:
+            batch = self.next_batch()
+            requests = []
+            for block, future, received in batch:
+                try:
+                    requests.append((block, future, received, parse_request(block)))
+                except Exception as error:  # only this request fails
+                    future.set_exception(error)
+            try:
+                self.label_requests(requests)
+            except Exception as error:  # the server keeps running, only the requests of this batch fail
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(error)
+
+    def label_requests(self, requests: List) -> None:
+        """
+        Label the sentences of parsed requests together and set the results of their futures. If labeling fails for
+        several requests, each is labeled on its own, so a malformed request does not fail the others of its batch.
+        """
+        if not requests:
+            return
+        try:
+            labeled = iter(self.labeler.label_sentences([sentence[0] for *_, sentence in requests if sentence]))
+        except Exception as error:
+            if len(requests) == 1:
+                requests[0][1].set_exception(error)
+            else:
+                for request in requests:
+                    self.label_requests([request])
+            return
+        self.stats.add_batch(sum(len(sentence) for *_, sentence in requests))
+        for block, future, received, sentence in requests:
+            # comment lines are passed through
+            comments = [line for line in block.splitlines(keepends=True) if line.startswith('#')]
+            future.set_result(format_sentence(comments, next(labeled) if sentence else []))
+            self.stats.add_request(time.perf_counter() - received)
+
+
+def parse_request(block: str) -> List[List[List[str]]]:
+    """Parse the sentence in the lines of a request into a list of (at most) one sentence, which is empty for a block
+    of only comments."""
+    lines = block.splitlines(keepends=True) + ['\n']
+    return [sentence for sentence in parse_sentences_from_connlu(lines) if sentence][:1]
+
+
+def format_sentence(comments: List[str], rows: List[List[str]]) -> str:
+    """Return the lines of a labeled sentence in CoNLL-U format, ending with an empty line."""
+    return ''.join(comments) + ''.join('\t'.join(row) + '\n' for row in rows) + '\n'
+
+
+def iter_request_blocks(lines: Iterable[str]) -> Iterator[str]:
+    """Split lines of CoNLL-U text into blocks of lines holding one sentence each."""
+    block = []
+    for line in lines:
+        if is_connlu_sentence_boundary(line):
+            if block:
+                yield ''.join(block)
+                block = []
+        else:
+            block.append(line)
+    if block:
+        yield ''.join(block)
+
+
+def serve_stream(infile: TextIO, outfile: TextIO, batcher: MicroBatcher) -> None:
+    """
+    Label the sentences read from a stream and write them to another one in the same order. Sentences are submitted
+    as soon as they are read, so those of one stream can be labeled in the same batch too, and the responses are
+    written by a thread of their own as soon as they are ready, so a client waiting for the response to a request
+    before sending the next one gets it without sending anything more. Reading stops when PENDING_BATCHES batches of
+    requests are waiting for their responses to be written.
+    """
+    pending = queue.Queue(maxsize=batcher.max_batch_size * PENDING_BATCHES)
+    errors = []
+    writer = threading.Thread(target=write_responses, args=(pending, outfile, errors), daemon=True)
+    writer.start()
+    try:
+        for block in iter_request_blocks(infile):
+            pending.put(batcher.submit(block))
+    finally:
+        pending.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+
+
+def write_responses(pending: queue.Queue, outfile: TextIO, errors: List[Exception]) -> None:
+    """
+    Write the responses of the futures in a queue in order, until the queue holds None, flushing the output whenever
+    no more requests are waiting. If writing fails (e.g. the client is gone), the error is added to errors and the
+    remaining futures are only taken from the queue, so the reading thread isn't blocked.
+    """
+    while True:
+        future = pending.get()
+        if future is None:
+            break
+        if errors:
+            continue
+        try:
+            outfile.write(get_response(future))
+            if pending.empty():
+                outfile.flush()
+        except Exception as error:
+            errors.append(error)
+    if not errors:
+        try:
+            outfile.flush()
+        except Exception as error:
+            errors.append(error)
+
+
+def get_response(future: Future) -> str:
+    """Return the labeled sentence of a request, or a comment with the error if it failed."""
+    try:
+        return future.result()
+    except Exception as error:
+        return f'# error = {type(error).__name__}: {error}\n\n'
+
+
+class StreamHandler(socketserver.StreamRequestHandler):
+    """Serve a connection to the socket like a stream of sentences."""
+
+    def handle(self):
+        infile = (line.decode('utf-8') for line in self.rfile)
+        outfile = StreamWriter(self.wfile)
+        serve_stream(infile, outfile, self.server.batcher)
+
+
+class StreamWriter:
+    """Write text to the binary file of a socket connection."""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, text: str) -> None:
+        self.wfile.write(text.encode('utf-8'))
+
+    def flush(self) -> None:
+        self.wfile.flush()
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def report_stats_periodically(stats: ServerStats, interval: float) -> None:
+    while True:
+        time.sleep(interval)
+        print(json.dumps(stats.report()), file=sys.stderr, flush=True)
+
+
+def main():
+    """
+    Load the rules and train the classifier (or load it from the model cache) once, then label CoNLL-U sentences read
+    from stdin, or sent by clients over a Unix or TCP socket, until the input ends or the server is stopped.
+    Statistics are reported to stderr periodically and at the end.
+    """
+    parser = argparse.ArgumentParser(description='Label CoNLL-U sentences with semantic roles in a long-lived process.')
+    parser.add_argument('train_path', help='path to the .conllu file (or compiled corpus file) the classifier is '
+                                           'trained on')
+    parser.add_argument('--rules', help='path to a .json file with the rules for predicate and argument '
+                                        'identification (see rules.py)')
+    listen = parser.add_mutually_exclusive_group()
+    listen.add_argument('--socket', help='path of a Unix socket to listen on, instead of reading from stdin')
+    listen.add_argument('--port', type=int, help='TCP port to listen on, instead of reading from stdin')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on with --port')
+    parser.add_argument('--max-batch-size', type=int, default=MAX_BATCH_SIZE,
+                        help='largest number of sentences labeled at once')
+    parser.add_argument('--max-wait-ms', type=float, default=MAX_WAIT * 1000,
+                        help='milliseconds a request waits for others to be labeled in the same batch')
+    parser.add_argument('--stats-interval', type=float, default=STATS_INTERVAL,
+                        help='seconds between reports of the statistics to stderr')
+    parser.add_argument('--hash-features', type=int, metavar='N',
+                        help='encode the features of the classifier by hashing them into N columns')
+    parser.add_argument('--no-model-cache', action='store_true', help='always train the classifier')
+    parser.add_argument('--model-cache-dir', default=MODEL_CACHE_DIR, help='directory of the model cache')
+    args = parser.parse_args()
+
+    predicate_rules, argument_rules = load_rules(args.rules) if args.rules else (None, None)
+    model_cache = None if args.no_model_cache else create_model_cache(args.model_cache_dir)
+    labeler = Labeler.train(args.train_path, predicate_rules, argument_rules, model_cache, args.hash_features)
+    stats = ServerStats()
+    batcher = MicroBatcher(labeler, stats, args.max_batch_size, args.max_wait_ms / 1000)
+    threading.Thread(target=report_stats_periodically, args=(stats, args.stats_interval), daemon=True).start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # report the statistics when stopped, too
+    try:
+        if args.socket is None and args.port is None:
+            serve_stream(sys.stdin, sys.stdout, batcher)
+        else:
+            if args.socket is not None:
+                if os.path.exists(args.socket):
+                    os.remove(args.socket)
+                server = ThreadingUnixServer(args.socket, StreamHandler)
+            else:
+                server = ThreadingTCPServer((args.host, args.port), StreamHandler)
+            server.batcher = batcher
+            print(f'Listening on {args.socket or f"{args.host}:{args.port}"}', file=sys.stderr, flush=True)
+            with server:
+                server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+        print(json.dumps(stats.report()), file=sys.stderr, flush=True)
+
+
+if __name__ == '__main__':
+    main()
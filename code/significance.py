@@ -0,0 +1,254 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from evaluation import divide, get_task_of_path, iter_file_rows, iter_gold_and_pred
+from profiling import profiled
+
+RESAMPLES = 10000
+BATCH_SIZE = 1000  # number of resamples whose scores are computed at once
+CONFIDENCE = 0.95
+MACRO = 'macro avg'
+
+
+class LabelTable:
+    """
+    The gold labels of instances and the labels predicted for them by one or more systems, aggregated into the
+    distinct combinations of labels and the number of instances with each combination. A resample of the instances is
+    then just a number of instances for every combination, and the true positives, gold and predicted labels of every
+    label in a batch of resamples are a single matrix product of those numbers with indicators of the combinations.
+
+    A prediction of None leaves an instance out of the evaluation of that system, like the rows iter_gold_and_pred
+    skips. The labels are the gold and predicted labels of the instances the systems evaluate, and the macro average is
+    taken over all of them in every resample.
+    """
+
+    def __init__(self, gold_labels: Sequence[str], *predictions: Sequence[Optional[str]]):
+        if any(len(pred) != len(gold_labels) for pred in predictions):
+            raise ValueError('Every system needs a prediction for every gold label')
+        evaluated = [np.array([label is not None for label in pred], dtype=bool) for pred in predictions]
+        included = np.logical_or.reduce(evaluated)
+        if not included.any():
+            raise ValueError('No instances to evaluate')
+        labels = {label for label, include in zip(gold_labels, included) if include}
+        labels.update(label for pred in predictions for label in pred if label is not None)
+        self.labels = sorted(labels)
+        codes = {label: code for code, label in enumerate(self.labels)}
+        codes[None] = -1
+        columns = [np.fromiter((codes.get(label, -1) for label in gold_labels), dtype=np.intp, count=len(gold_labels))]
+        columns.extend(np.fromiter((codes[label] for label in pred), dtype=np.intp, count=len(pred))
+                       for pred in predictions)
+        combinations, counts = np.unique(np.stack(columns, axis=1)[included], axis=0, return_counts=True)
+        self.counts = counts.astype(float)
+        self.num_instances = int(counts.sum())
+        self.indicators = [self.get_indicators(combinations[:, 0], combinations[:, i])
+                           for i in range(1, combinations.shape[1])]
+
+    def get_indicators(self, gold: np.ndarray, pred: np.ndarray) -> np.ndarray:
+        """
+        Return a matrix with a row for every combination of labels, with the number of true positives, gold labels and
+        predicted labels of every label (in three blocks of columns) for a single instance with the combination.
+        """
+        labels = np.arange(len(self.labels))
+        is_gold = (gold[:, None] == labels) & (pred >= 0)[:, None]
+        is_pred = pred[:, None] == labels
+        return np.hstack([is_gold & is_pred, is_gold, is_pred]).astype(float)
+
+    def get_f1_scores(self, label_counts: np.ndarray) -> np.ndarray:
+        """
+        Return the F1-score of every label and their macro average (in the last column) from the numbers of true
+        positives, gold and predicted labels of every label, with a row for every resample.
+        """
+        true_positives, gold, predicted = np.split(label_counts, 3, axis=1)
+        f1 = divide(2 * true_positives, gold + predicted)
+        return np.hstack([f1, f1.mean(axis=1, keepdims=True)])
+
+    def score(self, weights: np.ndarray, system: int = 0) -> np.ndarray:
+        """Return the F1-scores of a system for every row of weights, the number of instances of every combination."""
+        return self.get_f1_scores(weights @ self.indicators[system])
+
+    def score_all(self) -> np.ndarray:
+        """Return the F1-scores of every system on all instances, with a row for every system."""
+        return np.vstack([self.score(self.counts[None], system) for system in range(len(self.indicators))])
+
+    def bootstrap(self, rng: np.random.Generator, size: int) -> np.ndarray:
+        """
+        Draw size resamples of the instances with replacement, as multinomial draws of the number of instances of every
+        combination, and return the F1-scores of every system on them as an array of shape (size, systems, labels + 1).
+        """
+        weights = rng.multinomial(self.num_instances, self.counts / self.num_instances, size=size).astype(float)
+        return np.stack([self.score(weights, system) for system in range(len(self.indicators))], axis=1)
+
+    def permute(self, rng: np.random.Generator, size: int) -> np.ndarray:
+        """
+        Draw size random swaps of the predictions of two systems, where the predictions for every instance are swapped
+        with a probability of 1/2, as binomial draws of the number of swapped instances of every combination, and
+        return the F1-scores of both systems after the swaps as an array of shape (size, 2, labels + 1). Only the
+        combinations the systems predict different labels for are drawn, since swapping the others changes nothing.
+        """
+        first, second = self.indicators
+        differs = (first != second).any(axis=1)
+        swapped = rng.binomial(self.counts[differs].astype(np.int64), 0.5, size=(size, differs.sum())).astype(float)
+        change = swapped @ (second[differs] - first[differs])
+        return np.stack([self.get_f1_scores(self.counts @ first + change),
+                         self.get_f1_scores(self.counts @ second - change)], axis=1)
+
+
+def resample_batch(table: LabelTable, method: str, seed: np.random.SeedSequence, size: int) -> np.ndarray:
+    """Draw a batch of resamples with a method of the table and return the F1-scores of the systems on them."""
+    return getattr(table, method)(np.random.default_rng(seed), size)
+
+
+@profiled()
+def resample(table: LabelTable, method: str, resamples: int = RESAMPLES, seed: Optional[int] = None,
+             jobs: int = 1) -> np.ndarray:
+    """
+    Compute the F1-scores of the systems on resamples drawn with a method of the table ('bootstrap' or 'permute'), in
+    batches of BATCH_SIZE resamples which are spread over a pool of worker processes if more than one job is requested.
+    Every batch gets a seed of its own spawned from the seed, so the results don't depend on the number of jobs.
+    """
+    sizes = [min(BATCH_SIZE, resamples - start) for start in range(0, resamples, BATCH_SIZE)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    func = partial(resample_batch, table, method)
+    if jobs <= 1 or len(sizes) <= 1:
+        return np.concatenate(list(map(func, seeds, sizes)))
+    with ProcessPoolExecutor(min(jobs, len(sizes))) as pool:
+        return np.concatenate(list(pool.map(func, seeds, sizes)))
+
+
+def get_interval(scores: np.ndarray, confidence: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the lower and upper bounds of the percentile confidence interval of every column of scores."""
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(scores, [alpha, 1 - alpha], axis=0)
+    return low, high
+
+
+def get_p_values(statistics: np.ndarray, observed: np.ndarray) -> np.ndarray:
+    """Return the two-sided p-value of every column: the share of resampled statistics at least as extreme as the
+    observed one, counting the observed one itself."""
+    extreme = np.abs(statistics) >= np.abs(observed) - 1e-12
+    return (extreme.sum(axis=0) + 1) / (len(statistics) + 1)
+
+
+def bootstrap_confidence_intervals(gold_labels: Sequence[str], predictions: Sequence[Optional[str]],
+                                   resamples: int = RESAMPLES, confidence: float = CONFIDENCE,
+                                   seed: Optional[int] = None, jobs: int = 1) -> Dict:
+    """
+    Return the F1-score of every label and their macro average with a bootstrap percentile confidence interval, as
+    {label: {'f1-score': ..., 'low': ..., 'high': ...}, ..., 'macro avg': {...}}.
+    """
+    table = LabelTable(gold_labels, predictions)
+    observed = table.score_all()[0]
+    low, high = get_interval(resample(table, 'bootstrap', resamples, seed, jobs)[:, 0], confidence)
+    return {label: {'f1-score': float(f1), 'low': float(lower), 'high': float(upper)}
+            for label, f1, lower, upper in zip(table.labels + [MACRO], observed, low, high)}
+
+
+def compare_systems(gold_labels: Sequence[str], predictions_a: Sequence[Optional[str]],
+                    predictions_b: Sequence[Optional[str]], resamples: int = RESAMPLES, confidence: float = CONFIDENCE,
+                    seed: Optional[int] = None, jobs: int = 1) -> Dict:
+    """
+    Compare the F1-score of every label and their macro average of two systems on the same instances. The difference
+    (b - a) gets a paired bootstrap confidence interval and two p-values of the null hypothesis that the systems are
+    equally good: one from the paired bootstrap (the share of resampled differences, shifted by the observed
+    difference, at least as large as the observed difference) and one from approximate randomization (the share of
+    random swaps of the predictions of the systems giving a difference at least as large).
+    """
+    table = LabelTable(gold_labels, predictions_a, predictions_b)
+    scores_a, scores_b = table.score_all()
+    observed = scores_b - scores_a
+    bootstrapped = resample(table, 'bootstrap', resamples, seed, jobs)
+    differences = bootstrapped[:, 1] - bootstrapped[:, 0]
+    low, high = get_interval(differences, confidence)
+    p_bootstrap = get_p_values(differences - observed, observed)
+    permuted = resample(table, 'permute', resamples, None if seed is None else seed + 1, jobs)
+    p_randomization = get_p_values(permuted[:, 1] - permuted[:, 0], observed)
+    return {label: dict(zip(['f1-score a', 'f1-score b', 'difference', 'low', 'high', 'p bootstrap',
+                             'p randomization'], map(float, scores)))
+            for label, *scores in zip(table.labels + [MACRO], scores_a, scores_b, observed, low, high, p_bootstrap,
+                                      p_randomization)}
+
+
+def read_labels(path: str, task: str) -> Tuple[List[Optional[str]], List[Optional[str]]]:
+    """
+    Read the gold and predicted labels of every row of the output of a task, where rows which aren't evaluated (see
+    iter_gold_and_pred) get None for both, so the labels of the files of two systems with the same rows line up.
+    """
+    gold, pred = [], []
+    for row in iter_file_rows(path, task):
+        if row:
+            gold_label, pred_label = next(iter_gold_and_pred((row,), task), (None, None))
+            gold.append(gold_label)
+            pred.append(pred_label)
+    return gold, pred
+
+
+def read_paired_labels(path_a: str, path_b: str, task: str) -> Tuple[List[str], List[Optional[str]],
+                                                                    List[Optional[str]]]:
+    """Read the gold labels and the predictions of two systems from their output of a task for the same rows."""
+    gold_a, pred_a = read_labels(path_a, task)
+    gold_b, pred_b = read_labels(path_b, task)
+    if len(gold_a) != len(gold_b) or any(a != b for a, b in zip(gold_a, gold_b) if a is not None and b is not None):
+        raise ValueError(f'{path_a} and {path_b} don\'t contain the same instances with the same gold labels')
+    gold = [b if a is None else a for a, b in zip(gold_a, gold_b)]
+    return gold, pred_a, pred_b
+
+
+def print_intervals(results: Dict, confidence: float) -> None:
+    width = max(map(len, results))
+    print(f"{'':<{width}}{'f1-score':>10}{f'{confidence:.0%} interval':>20}")
+    for label, result in results.items():
+        print(f"{label:<{width}}{result['f1-score']:>10.3f}{result['low']:>10.3f}{result['high']:>10.3f}")
+
+
+def print_comparison(results: Dict, confidence: float) -> None:
+    width = max(map(len, results))
+    print(f"{'':<{width}}{'a':>8}{'b':>8}{'b - a':>9}{f'{confidence:.0%} interval':>20}{'p bootstrap':>13}"
+          f"{'p random':>10}")
+    for label, result in results.items():
+        print(f"{label:<{width}}{result['f1-score a']:>8.3f}{result['f1-score b']:>8.3f}{result['difference']:>+9.3f}"
+              f"{result['low']:>+10.3f}{result['high']:>+10.3f}{result['p bootstrap']:>13.4f}"
+              f"{result['p randomization']:>10.4f}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Put confidence intervals on the F1-scores of the output of a task in a file, or compare the output of two systems
+    for the same instances (e.g. before and after a change to the rules) with significance tests.
+    """
+    parser = argparse.ArgumentParser(description='Compute bootstrap confidence intervals of the F1-scores of the '
+                                                 'output of a task, or test whether the output of a second system is '
+                                                 'significantly different.')
+    parser.add_argument('path', help='path to the output of a task, as the pipeline writes it')
+    parser.add_argument('other_path', nargs='?', help='path to the output of a second system for the same instances')
+    parser.add_argument('--task', choices=['predicate_identification', 'argument_identification',
+                                           'argument_classification'],
+                        help='task whose output is in the files, by default told from the names of the files')
+    parser.add_argument('--resamples', type=int, default=RESAMPLES, help='number of resamples')
+    parser.add_argument('--confidence', type=float, default=CONFIDENCE, help='confidence level of the intervals')
+    parser.add_argument('--seed', type=int, help='seed of the random number generator')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='number of worker processes')
+    args = parser.parse_args(argv)
+
+    task = args.task or get_task_of_path(args.path)
+    start = time.perf_counter()
+    if args.other_path is None:
+        gold, pred = read_labels(args.path, task)
+        results = bootstrap_confidence_intervals(gold, pred, args.resamples, args.confidence, args.seed, args.jobs)
+        print(args.path)
+        print_intervals(results, args.confidence)
+    else:
+        gold, pred_a, pred_b = read_paired_labels(args.path, args.other_path, task)
+        results = compare_systems(gold, pred_a, pred_b, args.resamples, args.confidence, args.seed, args.jobs)
+        print(f'a: {args.path}\nb: {args.other_path}')
+        print_comparison(results, args.confidence)
+    print(f'{args.resamples} resamples in {time.perf_counter() - start:.2f} s')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
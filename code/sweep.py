@@ -0,0 +1,244 @@
+import argparse
+import json
+import os
+import pickle
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+import numpy as np
+from scipy.sparse import csr_matrix, load_npz, save_npz
+from cache import CACHE_DIR, hash_file, hash_json, write_atomically
+from classification import MODELS, create_encoder, create_model, read_feature_rows, get_labels
+from evaluation import ConfusionAccumulator
+from profiling import profiled
+import sklearn
+
+MATRIX_CACHE_DIR = os.path.join(CACHE_DIR, 'matrices')
+C_VALUES = [0.01, 0.1, 1.0, 10.0]
+CLASS_WEIGHTS = [None, 'balanced']
+
+_data = None  # the matrices and labels loaded by load_worker_data in this process
+
+
+def get_matrices_key(train_path: str, test_path: str, n_hashed_features: Optional[int] = None) -> str:
+    """Return the key of the matrices encoded from the features in two files, which also depends on the encoder."""
+    return hash_json({'train': hash_file(train_path), 'test': hash_file(test_path),
+                      'encoder': create_encoder([], n_hashed_features).get_params(), 'sklearn': sklearn.__version__})
+
+
+@profiled()
+def vectorize_features(train_path: str, test_path: str, n_hashed_features: Optional[int] = None,
+                       cache_dir: str = MATRIX_CACHE_DIR) -> str:
+    """
+    Encode the training and test set features in two files as sparse matrices and store them as .npz files in a
+    directory of the cache, with the labels and the encoder fitted on the training set. The directory is reused as long
+    as the files and the encoder haven't changed. Return its path.
+    """
+    directory = os.path.join(cache_dir, get_matrices_key(train_path, test_path, n_hashed_features))
+    if os.path.exists(os.path.join(directory, 'encoder.pkl')):  # written last, so the directory is complete
+        return directory
+    os.makedirs(directory, exist_ok=True)
+    feature_names, train_rows = read_feature_rows(train_path)
+    encoder = create_encoder(feature_names, n_hashed_features)
+    train_matrix = encoder.fit_transform(train_rows)
+    test_rows = read_feature_rows(test_path)[1]
+    test_matrix = encoder.transform(test_rows)
+    write_atomically(os.path.join(directory, 'train.npz'), lambda outfile: save_npz(outfile, train_matrix))
+    write_atomically(os.path.join(directory, 'test.npz'), lambda outfile: save_npz(outfile, test_matrix))
+    write_atomically(os.path.join(directory, 'labels.npz'),
+                     lambda outfile: np.savez(outfile, train=np.array(get_labels(train_rows), dtype=str),
+                                              test=np.array(get_labels(test_rows), dtype=str)))
+    write_atomically(os.path.join(directory, 'encoder.pkl'),
+                     lambda outfile: pickle.dump(encoder, outfile, protocol=pickle.HIGHEST_PROTOCOL))
+    return directory
+
+
+def load_matrices(directory: str) -> Tuple[csr_matrix, np.ndarray, csr_matrix, np.ndarray]:
+    """Load the training set matrix and labels and the test set matrix and labels stored by vectorize_features."""
+    labels = np.load(os.path.join(directory, 'labels.npz'))
+    return (load_npz(os.path.join(directory, 'train.npz')), labels['train'],
+            load_npz(os.path.join(directory, 'test.npz')), labels['test'])
+
+
+def load_encoder(directory: str):
+    with open(os.path.join(directory, 'encoder.pkl'), 'rb') as infile:
+        return pickle.load(infile)
+
+
+def load_worker_data(directory: str) -> None:
+    """Load the matrices once in every worker process, so they aren't sent along with every model to fit."""
+    global _data
+    _data = load_matrices(directory)
+
+
+def get_configs(models: Sequence[str] = tuple(MODELS), c_values: Sequence[float] = C_VALUES,
+                class_weights: Sequence[Optional[str]] = CLASS_WEIGHTS) -> List[Dict]:
+    """Return the grid of hyperparameters: every model with every regularization strength C and class weight."""
+    return [{'model': model, 'C': c, 'class_weight': class_weight}
+            for model in models for c in c_values for class_weight in class_weights]
+
+
+def create_sweep_model(config: Dict, n_samples: int):
+    """
+    Create the (untrained) classifier of a configuration. The SGD classifier is regularized by alpha instead of C, which
+    is converted so the objective is the same as the one of LinearSVC with that C.
+    """
+    if config['model'] == 'sgd':
+        return create_model('sgd', loss='hinge', average=True, alpha=1 / (config['C'] * n_samples),
+                            class_weight=config['class_weight'])
+    if config['model'] == 'logistic':
+        return create_model('logistic', C=config['C'], class_weight=config['class_weight'], max_iter=1000)
+    return create_model(config['model'], C=config['C'], class_weight=config['class_weight'])
+
+
+def fit_config(config: Dict, label: Optional[str] = None):
+    """
+    Fit the classifier of a configuration on the training set loaded in this process, or only its binary classifier
+    telling the given label from all others. Return the classifier and the time fitting it took.
+    """
+    train_matrix, train_labels = _data[0], _data[1]
+    model = create_sweep_model(config, train_matrix.shape[0])
+    start = time.perf_counter()
+    model.fit(train_matrix, train_labels if label is None else train_labels == label)
+    return model, time.perf_counter() - start
+
+
+class OneVsRestModel:
+    """A classifier made of a binary classifier for every label, fitted separately, which predicts the label whose
+    classifier gives the highest score."""
+
+    def __init__(self, classes: Sequence[str], estimators: List):
+        self.classes_ = np.array(classes)
+        self.estimators = estimators
+
+    def decision_function(self, matrix: csr_matrix) -> np.ndarray:
+        return np.column_stack([estimator.decision_function(matrix) for estimator in self.estimators])
+
+    def predict(self, matrix: csr_matrix) -> np.ndarray:
+        return self.classes_[np.argmax(self.decision_function(matrix), axis=1)]
+
+
+def iter_sweep(directory: str, configs: List[Dict], jobs: int = 1,
+               one_vs_rest: bool = False) -> Iterator[Tuple[int, Dict, object]]:
+    """
+    Fit the classifier of every configuration on the matrices stored in a directory, on a pool of jobs worker
+    processes, and evaluate it on the test set. With one_vs_rest, the binary classifier of every label is fitted as a
+    task of its own, so the labels of a single configuration are fitted in parallel too. Yield the index, the results
+    (scores and timings) and the classifier of every configuration as soon as it is done.
+    """
+    load_worker_data(directory)
+    _, train_labels, test_matrix, test_labels = _data
+    classes = sorted(set(train_labels))
+    tasks = [(i, config, label) for i, config in enumerate(configs)
+             for label in (classes if one_vs_rest else [None])]
+    fitted = {i: [] for i in range(len(configs))}
+
+    def evaluate(i):
+        estimators = sorted(fitted.pop(i), key=lambda item: item[0] or '')
+        if one_vs_rest:
+            model = OneVsRestModel([label for label, _, _ in estimators], [model for _, model, _ in estimators])
+        else:
+            model = estimators[0][1]
+        start = time.perf_counter()
+        predictions = model.predict(test_matrix)
+        predict_seconds = time.perf_counter() - start
+        report = ConfusionAccumulator.from_labels(test_labels, predictions).get_report()
+        return i, dict(configs[i], accuracy=report['accuracy'], precision=report['macro avg']['precision'],
+                    recall=report['macro avg']['recall'], f1=report['macro avg']['f1-score'],
+                    fit_s=sum(seconds for _, _, seconds in estimators), predict_s=predict_seconds), model
+
+    def add_fitted(i, label, model, seconds):
+        fitted[i].append((label, model, seconds))
+        if len(fitted[i]) == (len(classes) if one_vs_rest else 1):
+            yield evaluate(i)
+
+    if jobs <= 1:
+        for i, config, label in tasks:
+            yield from add_fitted(i, label, *fit_config(config, label))
+        return
+    pool = ProcessPoolExecutor(jobs, initializer=load_worker_data, initargs=(directory,))
+    try:
+        running = {pool.submit(fit_config, config, label): (i, label) for i, config, label in tasks}
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i, label = running.pop(future)
+                yield from add_fitted(i, label, *future.result())
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def run_sweep(directory: str, configs: List[Dict], jobs: int = 1, one_vs_rest: bool = False,
+              metric: str = 'f1') -> Tuple[List[Dict], Optional[Dict], object]:
+    """
+    Run the sweep and return the results of all configurations, in the order of the configurations, and the results
+    and the classifier of the configuration scoring best on the metric (macro-averaged over the labels). Of
+    configurations with the same score, the first one is best, whichever order they finish in.
+    """
+    results, best, best_model, best_index = [None] * len(configs), None, None, -1
+    for i, result, model in iter_sweep(directory, configs, jobs, one_vs_rest):
+        results[i] = result
+        if best is None or (result[metric], -i) > (best[metric], -best_index):
+            best, best_model, best_index = result, model, i
+    return results, best, best_model
+
+
+def print_results(results: List[Dict]) -> None:
+    print(f"{'model':<10}{'C':>8}{'class weight':>14}{'accuracy':>10}{'precision':>11}{'recall':>8}{'f1':>8}"
+          f"{'fit s':>9}{'predict s':>11}")
+    for result in results:
+        print(f"{result['model']:<10}{result['C']:>8g}{str(result['class_weight']):>14}{result['accuracy']:>10.3f}"
+              f"{result['precision']:>11.3f}{result['recall']:>8.3f}{result['f1']:>8.3f}{result['fit_s']:>9.2f}"
+              f"{result['predict_s']:>11.3f}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Sweep over the hyperparameters of the classifier: encode the training and test set features once (or load the
+    matrices from the cache), fit a classifier for every configuration in parallel and evaluate it on the test set.
+    """
+    parser = argparse.ArgumentParser(description='Fit a grid of classifiers on training set features in parallel and '
+                                                 'evaluate them on test set features.')
+    parser.add_argument('train_path', help='path to the file with the training set features')
+    parser.add_argument('test_path', help='path to the file with the test set features')
+    parser.add_argument('--models', nargs='+', choices=list(MODELS), default=list(MODELS), help='linear models to fit')
+    parser.add_argument('--C', nargs='+', type=float, default=C_VALUES, dest='c_values',
+                        help='values of the regularization strength C')
+    parser.add_argument('--class-weights', nargs='+', choices=['none', 'balanced'], default=['none', 'balanced'],
+                        help='class weights: none, or balanced to weigh classes inversely to their frequency')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--one-vs-rest', action='store_true',
+                        help='fit the binary classifier of every label as a parallel task of its own')
+    parser.add_argument('--hash-features', type=int, metavar='N',
+                        help='hash the features into N columns instead of fitting a vocabulary')
+    parser.add_argument('--metric', choices=['accuracy', 'precision', 'recall', 'f1'], default='f1',
+                        help='metric the best classifier is chosen by (macro-averaged over the labels)')
+    parser.add_argument('--cache-dir', default=MATRIX_CACHE_DIR, help='directory the matrices are stored in')
+    parser.add_argument('--report', help='path to a .json file the results are written to')
+    parser.add_argument('--output-model', help='path to a .pkl file the best classifier and its encoder are saved to')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    directory = vectorize_features(args.train_path, args.test_path, args.hash_features, args.cache_dir)
+    print(f'Matrices in {directory} ({time.perf_counter() - start:.2f} s)')
+    class_weights = [None if class_weight == 'none' else class_weight for class_weight in args.class_weights]
+    configs = get_configs(args.models, args.c_values, class_weights)
+    start = time.perf_counter()
+    results, best, model = run_sweep(directory, configs, args.jobs, args.one_vs_rest, args.metric)
+    print_results(results)
+    print(f"Best {args.metric}: {best[args.metric]:.3f} ({best['model']}, C={best['C']:g}, class weight "
+          f"{best['class_weight']}); {len(configs)} configurations in {time.perf_counter() - start:.2f} s")
+    if args.report:
+        with open(args.report, 'w') as outfile:
+            json.dump({'matrices': directory, 'one_vs_rest': args.one_vs_rest, 'results': results}, outfile, indent=2)
+    if args.output_model:
+        encoder = load_encoder(directory)
+        write_atomically(args.output_model,
+                         lambda outfile: pickle.dump((model, encoder), outfile, protocol=pickle.HIGHEST_PROTOCOL))
+        print(f'Best classifier written to {args.output_model}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules in code/ import each other by their bare names, like when they are run as scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'code'))
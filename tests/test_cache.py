@@ -0,0 +1,83 @@
+import os
+import shutil
+import types
+import pytest
+from cache import SOURCE_DIR, DiskCache, StageCache, get_source_files, hash_source
+
+
+def copy_source(tmp_path):
+    directory = str(tmp_path / 'code')
+    shutil.copytree(SOURCE_DIR, directory, ignore=shutil.ignore_patterns('__pycache__'))
+    return directory
+
+
+def get_module(directory, name):
+    """Return a module object pointing to the source of a module, without running it."""
+    module = types.ModuleType(name)
+    module.__file__ = os.path.join(directory, f'{name}.py')
+    return module
+
+
+def append_comment(directory, name):
+    with open(os.path.join(directory, f'{name}.py'), 'a') as outfile:
+        outfile.write('\n# edited\n')
+
+
+def test_source_files_include_modules_imported_indirectly_and_inside_functions():
+    names = {os.path.basename(path) for path in get_source_files([os.path.join(SOURCE_DIR, 'feature_extraction.py')])}
+    assert {'feature_extraction.py', 'arg_identification.py', 'parallel.py', 'fileio.py'} <= names
+    assert 'server.py' not in names
+    names = {os.path.basename(path) for path in get_source_files([os.path.join(SOURCE_DIR, 'main.py')])}
+    assert 'evaluation.py' in names  # only imported inside the functions of main
+
+
+def test_editing_an_imported_module_changes_the_code_hash(tmp_path):
+    directory = copy_source(tmp_path)
+    module = get_module(directory, 'predicate_identification')
+    original = hash_source(module, directory=directory)
+    append_comment(directory, 'server')  # not imported by predicate identification
+    assert hash_source(module, directory=directory) == original
+    append_comment(directory, 'parallel')
+    assert hash_source(module, directory=directory) != original
+
+
+def test_editing_an_imported_module_invalidates_the_stage_cache(tmp_path):
+    directory = copy_source(tmp_path)
+    module = get_module(directory, 'feature_extraction')
+    input_path = str(tmp_path / 'input.tsv')
+    with open(input_path, 'w') as outfile:
+        outfile.write('input')
+    stage_cache = StageCache(DiskCache(str(tmp_path / 'cache')), directory)
+    runs = []
+
+    def run_stage():
+        return stage_cache.run('feature_extraction', 'output', [input_path], {}, [module],
+                               lambda: runs.append(len(runs)) or len(runs))
+
+    assert run_stage() == 1
+    assert run_stage() == 1 and len(runs) == 1  # served from the cache
+    append_comment(directory, 'arg_identification')
+    assert run_stage() == 2 and len(runs) == 2
+
+
+@pytest.mark.parametrize('name', ['predicate_identification', 'arg_identification', 'feature_extraction'])
+def test_editing_the_file_format_invalidates_the_file_stages(tmp_path, name):
+    directory = copy_source(tmp_path)
+    module = get_module(directory, name)
+    input_path, output_path = str(tmp_path / 'input.tsv'), str(tmp_path / 'output.tsv')
+    with open(input_path, 'w') as outfile:
+        outfile.write('input')
+    stage_cache = StageCache(DiskCache(str(tmp_path / 'cache')), directory)
+
+    def run_stage(text):
+        def compute():
+            with open(output_path, 'w', newline='') as outfile:
+                outfile.write(text)
+        stage_cache.run_file(name, input_path, output_path, {}, [module], compute)
+        with open(output_path, newline='') as infile:
+            return infile.read()
+
+    assert run_stage('a\r\n') == 'a\r\n'
+    assert run_stage('a\n') == 'a\r\n'  # served from the cache
+    append_comment(directory, 'fileio')  # e.g. a change of the line endings of the written files
+    assert run_stage('a\n') == 'a\n'
@@ -0,0 +1,39 @@
+import pickle
+from classification import train_classifier_incrementally
+
+FEATURE_NAMES = ['lemma', 'dep_rel']
+ROWS = [['eat', 'nsubj', 'ARG0'], ['apple', 'obj', 'ARG1'], ['quickly', 'advmod', 'ARGM-MNR']] * 4
+OTHER_ROWS = [['run', 'nsubj', 'ARG0'], ['home', 'obl', 'ARGM-DIR'], ['now', 'advmod', 'ARGM-TMP']] * 4
+
+
+def train(rows, epochs, checkpoint_path):
+    return train_classifier_incrementally(lambda: iter([rows]), FEATURE_NAMES, epochs=epochs,
+                                          checkpoint_path=checkpoint_path)
+
+
+def load_epoch(checkpoint_path):
+    with open(checkpoint_path, 'rb') as infile:
+        return pickle.load(infile)['epoch']
+
+
+def test_checkpoint_is_resumed_on_the_same_rows(tmp_path):
+    checkpoint_path = str(tmp_path / 'model.pkl')
+    train(ROWS, 1, checkpoint_path)
+    classifier, encoder = train(ROWS, 2, checkpoint_path)
+    assert load_epoch(checkpoint_path) == 2
+    assert list(classifier.classes_) == ['ARG0', 'ARG1', 'ARGM-MNR']
+
+
+def test_checkpoint_of_other_rows_is_not_resumed(tmp_path):
+    checkpoint_path = str(tmp_path / 'model.pkl')
+    train(ROWS, 1, checkpoint_path)
+    classifier, encoder = train(OTHER_ROWS, 1, checkpoint_path)
+    assert list(classifier.classes_) == ['ARG0', 'ARGM-DIR', 'ARGM-TMP']
+    assert 'lemma=run' in encoder.feature_names_ and 'lemma=eat' not in encoder.feature_names_
+
+
+def test_checkpoint_of_more_epochs_is_not_resumed(tmp_path):
+    checkpoint_path = str(tmp_path / 'model.pkl')
+    train(ROWS, 3, checkpoint_path)
+    train(ROWS, 1, checkpoint_path)
+    assert load_epoch(checkpoint_path) == 1
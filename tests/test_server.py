@@ -0,0 +1,68 @@
+import io
+import socket
+import threading
+from server import Labeler, MicroBatcher, ServerStats, StreamHandler, ThreadingUnixServer, serve_stream
+
+SENTENCE = ('# sent_id = s1\n'
+            '1\tHe\the\tPRON\tPRP\t_\t2\tnsubj\t_\t_\t_\n'
+            '2\teats\teat\tVERB\tVBZ\tVerbForm=Fin\t0\troot\t_\t_\t_\n'
+            '3\tapples\tapple\tNOUN\tNNS\t_\t2\tobj\t_\t_\t_\n'
+            '\n')
+
+
+class ConstantClassifier:
+    def predict(self, rows):
+        return ['ARG0'] * len(rows)
+
+
+class IdentityEncoder:
+    def transform(self, rows):
+        return rows
+
+
+def create_batcher():
+    return MicroBatcher(Labeler(ConstantClassifier(), IdentityEncoder()), ServerStats())
+
+
+def test_socket_responds_to_a_single_request_without_more_input(tmp_path):
+    path = str(tmp_path / 'server.sock')
+    server = ThreadingUnixServer(path, StreamHandler)
+    server.batcher = create_batcher()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(5)
+            client.connect(path)
+            client.sendall(SENTENCE.encode('utf-8'))
+            response = b''
+            while not response.endswith(b'\n\n'):  # the connection stays open, so this times out without a response
+                chunk = client.recv(65536)
+                assert chunk
+                response += chunk
+    finally:
+        server.shutdown()
+        server.server_close()
+    lines = response.decode('utf-8').splitlines()
+    assert lines[0] == '# sent_id = s1'
+    assert [line.split('\t')[1] for line in lines[1:4]] == ['He', 'eats', 'apples']
+
+
+def test_block_of_only_comments_is_not_labeled_as_a_sentence():
+    batcher = create_batcher()
+    outfile = io.StringIO()
+    serve_stream(io.StringIO('# newdoc\n\n' + SENTENCE), outfile, batcher)
+    assert outfile.getvalue().startswith('# newdoc\n\n# sent_id = s1\n1\tHe\t')
+    assert batcher.stats.report()['sentences'] == 1
+
+
+def test_malformed_request_only_fails_itself_in_a_batch():
+    batcher = MicroBatcher(Labeler(ConstantClassifier(), IdentityEncoder()), ServerStats(), max_batch_size=3,
+                           max_wait=5)
+    malformed = SENTENCE.replace('# sent_id = s1', '# sent_id = s2').replace('\n2\teats', '\nx\teats')
+    outfile = io.StringIO()
+    serve_stream(io.StringIO(SENTENCE + malformed + SENTENCE), outfile, batcher)
+    responses = outfile.getvalue().split('\n\n')
+    assert responses[0].startswith('# sent_id = s1\n1\tHe\t')
+    assert responses[1].startswith('# error = ValueError:')
+    assert responses[2].startswith('# sent_id = s1\n1\tHe\t')
+    assert batcher.stats.report()['sentences'] == 2